@@ -0,0 +1,259 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+
+import waste_pickup_sim
+from scenario_generator import write_feature_collection
+
+# Scaling benchmark of the simulation on synthetic scenarios of different numbers of pickup sites, vehicles and days.
+# Runs offline, with the haversine matrix backend and the heuristic router. Each scenario is run in a fresh process, and
+# preprocessing, the simulation, routing calls and the export of the logs are timed separately. The results are saved
+# as JSON and compared against a baseline of earlier results, flagging regressions.
+
+try:
+	import resource
+except ImportError:
+	resource = None # Not available on Windows, peak RSS is then not measured
+
+# Center of the synthetic scenarios, and the area per pickup site of the test area, about 60 sites in 1.2 x 0.5 deg
+center_lonlat = (24.2, 60.9)
+area_per_site = 1.2*0.5/60 # deg^2
+
+# Scenarios by name: number of pickup sites, vehicles and depots, and simulated days
+scenarios = {
+	'1x': {'num_pickup_sites': 60, 'num_vehicles': 2, 'num_depots': 2, 'sim_runtime_days': 14},
+	'1x_28d': {'num_pickup_sites': 60, 'num_vehicles': 2, 'num_depots': 2, 'sim_runtime_days': 28},
+	'10x': {'num_pickup_sites': 600, 'num_vehicles': 20, 'num_depots': 4, 'sim_runtime_days': 14},
+	'10x_fleet': {'num_pickup_sites': 600, 'num_vehicles': 50, 'num_depots': 4, 'sim_runtime_days': 14},
+	'100x': {'num_pickup_sites': 6000, 'num_vehicles': 200, 'num_depots': 10, 'sim_runtime_days': 14}
+}
+default_scenario_names = ('1x', '1x_28d', '10x', '10x_fleet', '100x')
+
+# Measured metrics, and whether a larger value is better. Others are not compared against the baseline
+metric_directions = {
+	'preprocess_time': 'lower',
+	'init_time': 'lower',
+	'sim_time': 'lower',
+	'events_per_second': 'higher',
+	'routing_time': 'lower',
+	'routing_call_max_time': 'lower',
+	'export_time': 'lower',
+	'peak_rss_mb': 'lower'
+}
+
+# Settings of a run that make its times incomparable to a baseline of other settings
+environment_keys = ('engine', 'platform', 'cpu_count')
+
+
+def create_scenario(directory, num_pickup_sites, num_vehicles, num_depots, sim_runtime_days, seed = 0):
+	"""
+	Write GeoJSON files of a synthetic scenario to directory, with pickup sites and depots at random in a square of the
+	density of the test area. The depots are also the terminals. Returns a sim config for preprocess_sim_config
+	"""
+	rng = np.random.default_rng(seed)
+	half_side = math.sqrt(area_per_site*num_pickup_sites)/2
+	def random_lonlats(num_lonlats):
+		# Equal lon and lat spans in km
+		offsets = rng.uniform(-half_side, half_side, size=(num_lonlats, 2))
+		offsets[:, 0] /= math.cos(math.radians(center_lonlat[1]))
+		return (np.array(center_lonlat) + offsets).tolist()
+
+	pickup_sites_filename = os.path.join(directory, 'sites.geojson')
+	depots_filename = os.path.join(directory, 'depots.geojson')
+	write_feature_collection(pickup_sites_filename, 'sites', random_lonlats(num_pickup_sites), [{'ID': f"S{index}"} for index in range(num_pickup_sites)])
+	write_feature_collection(depots_filename, 'depots', random_lonlats(num_depots), [{'name': f"D{index}"} for index in range(num_depots)])
+	return {
+		'sim_name': f"Benchmark {num_pickup_sites} sites {num_vehicles} vehicles {sim_runtime_days} days",
+		'sim_runtime_days': sim_runtime_days,
+		'pickup_sites_filename': pickup_sites_filename,
+		'depots_filename': depots_filename,
+		'terminals_filename': depots_filename,
+		'vehicle_template': {
+			'load_capacity': 18,
+			'max_route_duration': 8*60 + 15,
+			'pickup_duration': 15
+		},
+		'depots': [{'num_vehicles': num_vehicles//num_depots + (1 if index < num_vehicles % num_depots else 0)} for index in range(num_depots)],
+		'matrix_backend': 'haversine',
+		'matrix_store_dir': os.path.join(directory, 'matrix_store'),
+		'router': 'heuristic',
+		'seed': seed,
+		'log_dir': os.path.join(directory, 'log'),
+		'log_quiet': True
+	}
+
+def get_peak_rss_mb():
+	if resource is None:
+		return None
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak_rss/(1 << 20) if sys.platform == 'darwin' else peak_rss/(1 << 10) # Bytes on macOS, KiB elsewhere
+
+def run_scenario(scenario, seed = 0, engine = 'simpy'):
+	"""Run a scenario in this process with a simulation engine, 'simpy' or 'kernel'. Returns its measurements"""
+	with tempfile.TemporaryDirectory(prefix='benchmark_') as directory:
+		random.seed(seed)
+		np.random.seed(seed)
+		sim_config = create_scenario(directory, **scenario, seed=seed)
+		sim_config['engine'] = engine
+
+		start_time = time.perf_counter()
+		waste_pickup_sim.preprocess_sim_config(sim_config, os.path.join(directory, 'sim_preprocessed_config.json'))
+		preprocess_time = time.perf_counter() - start_time
+
+		start_time = time.perf_counter()
+		sim = waste_pickup_sim.WastePickupSimulation(sim_config)
+		init_time = time.perf_counter() - start_time
+
+		# Time the routing calls
+		routing_call_times = []
+		router = sim.router
+		def timed_router(routing_input):
+			start_time = time.perf_counter()
+			routing_output = router(routing_input)
+			routing_call_times.append(time.perf_counter() - start_time)
+			return routing_output
+		sim.router = timed_router
+
+		# Run without exporting the logs, and export them separately
+		sim.write_sample_logs = False
+		sim.sim_run()
+		start_time = time.perf_counter()
+		sim.write_sample_logs_to_files()
+		sim.save_log()
+		sim.sim_record()
+		export_time = time.perf_counter() - start_time
+
+		routing_time = sum(routing_call_times)
+		num_events = sim.env.num_events
+		return {
+			**scenario,
+			'num_locations': len(sim_config['location_lonlats']),
+			'preprocess_time': preprocess_time,
+			'init_time': init_time,
+			'sim_time': sim.total_time,
+			'num_events': num_events,
+			'events_per_second': num_events/max(sim.total_time - routing_time, 1e-9),
+			'peak_queue_length': sim.env.peak_queue_length,
+			'routing_time': routing_time,
+			'routing_calls': len(routing_call_times),
+			'routing_call_mean_time': routing_time/len(routing_call_times) if len(routing_call_times) > 0 else 0,
+			'routing_call_max_time': max(routing_call_times, default=0),
+			'export_time': export_time,
+			'peak_rss_mb': get_peak_rss_mb(),
+			'cost': sim.sim_records['cost']
+		}
+
+def run_scenario_in_new_process(scenario, seed = 0, engine = 'simpy'):
+	"""Run a scenario in a fresh process, so that its peak RSS is its own"""
+	with multiprocessing.get_context('spawn').Pool(1) as pool:
+		return pool.apply(run_scenario, (scenario, seed, engine))
+
+
+def get_environment_mismatches(results, baseline):
+	"""Environment keys whose values differ between results and baseline. Returns {key: (baseline value, value)}"""
+	return {key: (baseline.get(key), results.get(key)) for key in environment_keys if baseline.get(key) != results.get(key)}
+
+def compare(results, baseline, tolerance = 0.25, min_time = 0.05):
+	"""
+	Compare results against baseline results of the same scenarios. A metric regresses if it is worse by more than the
+	tolerance, as a fraction of the baseline. Times below min_time seconds in both are not compared. Results of another
+	engine than the baseline are not compared at all. Returns a list of regressions {'scenario', 'metric', 'baseline',
+	'value', 'change'}
+	"""
+	regressions = []
+	if 'engine' in get_environment_mismatches(results, baseline):
+		return regressions
+	for scenario_name, scenario_results in results['scenarios'].items():
+		baseline_results = baseline.get('scenarios', {}).get(scenario_name)
+		if baseline_results is None:
+			continue
+		for metric, direction in metric_directions.items():
+			value = scenario_results.get(metric)
+			baseline_value = baseline_results.get(metric)
+			if value is None or baseline_value is None or baseline_value <= 0:
+				continue
+			if metric.endswith('_time') and max(value, baseline_value) < min_time:
+				continue
+			change = value/baseline_value - 1
+			if (change > tolerance) if direction == 'lower' else (change < -tolerance/(1 + tolerance)):
+				regressions.append({'scenario': scenario_name, 'metric': metric, 'baseline': baseline_value, 'value': value, 'change': change})
+	return regressions
+
+def run_benchmark(scenario_names = default_scenario_names, baseline_filename = 'benchmark_baseline.json', results_dir = 'log/benchmark', tolerance = 0.25, update_baseline = False, seed = 0, engine = 'simpy'):
+	"""
+	Run the scenarios, save the results in results_dir and compare them against the baseline file if it exists. With
+	update_baseline, the results are saved as the new baseline. Returns (results, regressions)
+	"""
+	results = {
+		'time': f"{datetime.now()}",
+		'platform': platform.platform(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'cpu_count': os.cpu_count(),
+		'engine': engine,
+		'scenarios': {}
+	}
+	for scenario_name in scenario_names:
+		print(f"Running scenario {scenario_name}: {scenarios[scenario_name]}")
+		results['scenarios'][scenario_name] = run_scenario_in_new_process(scenarios[scenario_name], seed, engine)
+		print_scenario_results(scenario_name, results['scenarios'][scenario_name])
+
+	os.makedirs(results_dir, exist_ok=True)
+	results_filename = os.path.join(results_dir, f"benchmark_{results['time']}.json".replace(':', '-'))
+	with open(results_filename, 'w') as f:
+		json.dump(results, f, indent=4)
+	print(f"Benchmark results saved to {results_filename}")
+
+	regressions = []
+	if os.path.exists(baseline_filename):
+		with open(baseline_filename) as f:
+			baseline = json.load(f)
+		mismatches = get_environment_mismatches(results, baseline)
+		for key, (baseline_value, value) in mismatches.items():
+			print(f"WARNING: {key} {value!r} differs from {baseline_value!r} of {baseline_filename}")
+		if 'engine' in mismatches:
+			print(f"Not compared against {baseline_filename}, which was run with another engine")
+		else:
+			regressions = compare(results, baseline, tolerance)
+			for regression in regressions:
+				print(f"REGRESSION {regression['scenario']} {regression['metric']}: {regression['baseline']:.4g} -> {regression['value']:.4g} ({regression['change']:+.0%})")
+			if len(regressions) == 0:
+				print(f"No regressions against {baseline_filename}")
+	if update_baseline:
+		with open(baseline_filename, 'w') as f:
+			json.dump(results, f, indent=4)
+		print(f"Baseline saved to {baseline_filename}")
+	return results, regressions
+
+def print_scenario_results(scenario_name, scenario_results):
+	print(f"  {scenario_name}: preprocess {scenario_results['preprocess_time']:.3f} s, sim {scenario_results['sim_time']:.3f} s, "
+		f"{scenario_results['num_events']} events at {scenario_results['events_per_second']:.0f}/s, "
+		f"routing {scenario_results['routing_calls']} calls {scenario_results['routing_time']:.3f} s (max {scenario_results['routing_call_max_time']:.3f} s), "
+		f"export {scenario_results['export_time']:.3f} s, peak RSS {scenario_results['peak_rss_mb'] or 0:.0f} MB")
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Scaling benchmark of the waste pickup simulation')
+	parser.add_argument('scenarios', nargs='*', help=f"scenarios to run, of {', '.join(scenarios)}. Default all")
+	parser.add_argument('--baseline', default='benchmark_baseline.json', help='baseline results file')
+	parser.add_argument('--results-dir', default='log/benchmark', help='directory for the results')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fraction of change before flagging a regression')
+	parser.add_argument('--update-baseline', action='store_true', help='save the results as the new baseline')
+	parser.add_argument('--engine', default='simpy', choices=('simpy', 'kernel'), help='simulation engine')
+	parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 if there are regressions')
+	args = parser.parse_args()
+	for scenario_name in args.scenarios:
+		if scenario_name not in scenarios:
+			parser.error(f"unknown scenario {scenario_name!r}")
+	_, regressions = run_benchmark(args.scenarios or default_scenario_names, args.baseline, args.results_dir, args.tolerance, args.update_baseline, engine=args.engine)
+	if args.fail_on_regression and len(regressions) > 0:
+		sys.exit(1)
@@ -0,0 +1,81 @@
+import numpy as np
+
+# A growable table of typed columns stored in NumPy arrays. Rows are appended one at a time or in blocks, and the
+# capacity of the arrays is doubled when full, so appending is amortized constant time.
+class ColumnarBuffer():
+
+	def __init__(self, dtypes, initial_capacity=1024):
+		"""dtypes: dict of column name: NumPy dtype"""
+		self.dtypes = dict(dtypes)
+		self.capacity = max(int(initial_capacity), 1)
+		self.length = 0
+		self.arrays = {name: np.empty(self.capacity, dtype=dtype) for name, dtype in self.dtypes.items()}
+
+	def __len__(self):
+		return self.length
+
+	def reserve(self, capacity):
+		"""Make sure that there is space for at least capacity rows"""
+		if capacity > self.capacity:
+			new_capacity = max(capacity, 2*self.capacity)
+			for name, array in self.arrays.items():
+				new_array = np.empty(new_capacity, dtype=array.dtype)
+				new_array[:self.length] = array[:self.length]
+				self.arrays[name] = new_array
+			self.capacity = new_capacity
+
+	def append(self, **values):
+		"""Append a row. All columns must be given"""
+		if self.length == self.capacity:
+			self.reserve(self.length + 1)
+		for name, value in values.items():
+			self.arrays[name][self.length] = value
+		self.length += 1
+
+	def extend(self, **columns):
+		"""Append a block of rows. All columns must be given, as arrays of equal length or as scalars"""
+		num_rows = max((np.size(column) for column in columns.values() if np.ndim(column) > 0), default=1)
+		self.reserve(self.length + num_rows)
+		for name, column in columns.items():
+			self.arrays[name][self.length:self.length + num_rows] = column
+		self.length += num_rows
+
+	def column(self, name):
+		"""Get a view of the used part of a column"""
+		return self.arrays[name][:self.length]
+
+	def columns(self):
+		"""Get a dict of views of the used parts of all columns"""
+		return {name: self.column(name) for name in self.arrays}
+
+	def truncate(self, length):
+		"""Drop rows from the end so that length rows remain"""
+		self.length = min(self.length, length)
+
+
+# Formats of write_columns
+log_formats = ('csv', 'npz')
+
+def write_columns(filename, columns, format = 'csv', csv_formats = None):
+	"""
+	Write columns in bulk, to a CSV file or to a NumPy .npz file.
+	columns: dict of CSV header name: 1-d array, in column order
+	csv_formats: dict of header name: printf style format, defaults to '%.10g'
+	"""
+	if format == 'npz':
+		np.savez(filename, **columns)
+	elif format == 'csv':
+		names = list(columns.keys())
+		formats = [(csv_formats or {}).get(name, '%.10g') for name in names]
+		num_rows = len(columns[names[0]]) if len(names) else 0
+		with open(filename, 'w') as f:
+			print(",".join(names), file=f)
+			# Format in blocks of rows to bound the memory used by the intermediate strings
+			row_format = ",".join(formats)
+			block_size = 65536
+			for block_start in range(0, num_rows, block_size):
+				rows = zip(*(columns[name][block_start:block_start + block_size].tolist() for name in names))
+				f.write("\n".join(row_format % row for row in rows))
+				f.write("\n")
+	else:
+		raise ValueError(f"Unknown log format: {format}")
@@ -0,0 +1,42 @@
+import os
+import tempfile
+import numpy as np
+from columnar_buffer import ColumnarBuffer, write_columns
+
+# Checks of the columnar buffer of the route and pickup site logs against the rows appended to it, and of the bulk
+# writer against the columns written, in both log formats.
+# Run from the repository root: python columnar_buffer_test.py
+
+def test_columnar_buffer(rng, num_rows = 5000):
+	"""A columnar buffer has the rows appended to it, one at a time or in blocks"""
+	buffer = ColumnarBuffer({'time': np.float64, 'index': np.int32}, initial_capacity=3)
+	times = rng.uniform(0, 1, num_rows)
+	indexes = rng.integers(0, 1000, num_rows).astype(np.int32)
+	position = 0
+	while position < num_rows:
+		block_size = int(rng.integers(1, 100))
+		if block_size == 1:
+			buffer.append(time=times[position], index=indexes[position])
+		else:
+			buffer.extend(time=times[position:position + block_size], index=indexes[position:position + block_size])
+		position = min(position + block_size, num_rows)
+	assert len(buffer) == num_rows and np.array_equal(buffer.column('time'), times) and np.array_equal(buffer.column('index'), indexes), "Columnar buffer differs from the appended rows"
+	buffer.truncate(10)
+	assert np.array_equal(buffer.columns()['index'], indexes[:10])
+	print(f"Columnar buffer matches the appended rows: {num_rows} rows")
+
+def test_write_columns(rng, num_rows = 100000):
+	"""The CSV and .npz files of write_columns have the columns written"""
+	columns = {'t': np.round(rng.uniform(0, 20160, num_rows), 3), 'v': rng.integers(0, 10, num_rows).astype(np.int32)}
+	with tempfile.TemporaryDirectory() as directory:
+		write_columns(os.path.join(directory, 'log.csv'), columns, 'csv', {'t': '%g', 'v': '%d'})
+		csv_columns = np.loadtxt(os.path.join(directory, 'log.csv'), delimiter=',', skiprows=1)
+		assert np.allclose(csv_columns[:, 0], columns['t']) and np.array_equal(csv_columns[:, 1], columns['v']), "CSV log differs from the columns"
+		write_columns(os.path.join(directory, 'log.npz'), columns, 'npz')
+		with np.load(os.path.join(directory, 'log.npz')) as npz_columns:
+			assert all(np.array_equal(npz_columns[name], column) for name, column in columns.items()), ".npz log differs from the columns"
+	print(f"Written logs match the columns: {num_rows} rows")
+
+rng = np.random.default_rng(42)
+test_columnar_buffer(rng)
+test_write_columns(rng)
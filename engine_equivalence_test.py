@@ -0,0 +1,71 @@
+import glob
+import json
+import os
+import random
+import numpy as np
+import waste_pickup_sim
+
+# Check that the event kernel gives the same simulation as SimPy: runs the test scenario with 'engine': 'simpy' and
+# 'engine': 'kernel', and compares the JSON Lines event logs, the route and pickup site logs and the costs. The
+# heuristic router and offline haversine matrixes keep the runs deterministic without a routing API.
+# Run from the repository root: python engine_equivalence_test.py
+
+sim_config = {
+	'sim_name': 'Hämeenlinna and nearby regions',
+	'sim_runtime_days': 14,
+	'pickup_sites_filename': 'geo_data/sim_test_sites.geojson',
+	'depots_filename': 'geo_data/sim_test_terminals.geojson',
+	'terminals_filename': 'geo_data/sim_test_terminals.geojson',
+	'vehicle_template': {
+		'load_capacity': 18,
+		'max_route_duration': 8*60 + 15,
+		'pickup_duration': 15
+	},
+	'depots': [
+		{
+			'num_vehicles': 1
+		},
+		{
+			'num_vehicles': 1
+		}
+	],
+	'matrix_backend': 'haversine',
+	'router': 'heuristic',
+	'daily_growth_rate_noise_sigma': 0.3,
+	'seed': 5,
+	'log_quiet': True
+}
+
+def run_engine(sim_config, engine, log_dir):
+	"""Run a simulation with an engine. Returns its events without the computing time and filenames, its sample logs by name, and its cost"""
+	sim = waste_pickup_sim.WastePickupSimulation({**sim_config, 'engine': engine, 'log_dir': log_dir})
+	sim.sim_run()
+	sim.save_log()
+	sim.sim_record()
+	with open(sim.event_log.filename) as f:
+		events = [event for event in map(json.loads, f) if event['type'] != 'sim_finished']
+	for event in events:
+		event.pop('filename', None) # Snapshot files are named by the start time of the run
+	sample_logs = {}
+	for filename in glob.glob(os.path.join(log_dir, f"*_log_{sim.run_start}.csv")):
+		with open(filename) as f:
+			sample_logs[os.path.basename(filename).split('_log_')[0]] = f.read()
+	return events, sample_logs, sim.sim_records['cost']
+
+def test_engine_equivalence(sim_config, log_dir = 'log/engine_equivalence'):
+	simpy_events, simpy_sample_logs, simpy_cost = run_engine(sim_config, 'simpy', os.path.join(log_dir, 'simpy'))
+	kernel_events, kernel_sample_logs, kernel_cost = run_engine(sim_config, 'kernel', os.path.join(log_dir, 'kernel'))
+	for index, (simpy_event, kernel_event) in enumerate(zip(simpy_events, kernel_events)):
+		assert simpy_event == kernel_event, f"Event {index} differs: {simpy_event} != {kernel_event}"
+	assert len(simpy_events) == len(kernel_events), f"{len(simpy_events)} events with SimPy, {len(kernel_events)} with the kernel"
+	assert simpy_sample_logs.keys() == kernel_sample_logs.keys() and len(simpy_sample_logs) > 0, f"Sample logs {sorted(simpy_sample_logs)} != {sorted(kernel_sample_logs)}"
+	for name in simpy_sample_logs:
+		assert simpy_sample_logs[name] == kernel_sample_logs[name], f"The {name} logs differ"
+	assert simpy_cost == kernel_cost, f"Cost {simpy_cost} with SimPy, {kernel_cost} with the kernel"
+	print(f"Engines match: {len(simpy_events)} events, {', '.join(sorted(simpy_sample_logs))} logs, cost {simpy_cost:.2f}")
+
+random.seed(42)
+np.random.seed(42)
+waste_pickup_sim.preprocess_sim_config(sim_config, 'temp/engine_equivalence_config.json')
+test_engine_equivalence(sim_config)
+test_engine_equivalence({**sim_config, 'async_routing': True, 'snapshot_interval_days': 3}, 'log/engine_equivalence_async')
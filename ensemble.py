@@ -0,0 +1,226 @@
+import json
+import math
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+
+import waste_pickup_sim
+from sparse_travel_matrix import SparseMatrixView
+from routing_executor import RoutingExecutor, run_interleaved
+
+# Monte Carlo ensemble of simulation runs of one preprocessed sim config, in a pool of worker processes. The distance and
+# duration matrixes are put in shared memory once, and the workers use them without copying. Each run gets its own
+# seed and log directory, and returns a few statistics that are aggregated with confidence intervals. Sparse matrixes
+# are small, and are copied to the workers instead. Variants of a config, for example forked from a snapshot, are run
+# in the same way. Alternatively the runs of an ensemble can be interleaved in this process with asynchronous routing,
+# sharing one bounded pool of routing optimizer workers.
+
+# Statistics of a run that are aggregated over the ensemble
+statistic_names = ('cost', 'pickup_site_overflow_days', 'odometer', 'vehicle_run_time', 'overtime', 'num_warnings', 'computational_time', 'wall_time')
+
+# Per worker process state, set by init_worker
+worker_shared_memories = []
+worker_sim_config = None
+
+
+def create_shared_matrix(matrix):
+	"""Copy a matrix into a new shared memory block. Returns the shared memory and a description for attach_shared_matrix"""
+	matrix = np.asarray(matrix, dtype=np.float32)
+	shared_memory_block = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+	np.ndarray(matrix.shape, dtype=np.float32, buffer=shared_memory_block.buf)[:] = matrix
+	return shared_memory_block, {'name': shared_memory_block.name, 'shape': matrix.shape}
+
+def attach_shared_matrix(description):
+	"""Attach to a shared memory matrix, without taking part in its cleanup. Returns the shared memory and the matrix"""
+	try:
+		shared_memory_block = shared_memory.SharedMemory(name=description['name'], track=False)
+	except TypeError:
+		# Before Python 3.13 attaching also registers the shared memory, to the resource tracker that the worker
+		# processes share with the process that created it. That one unlinks it
+		shared_memory_block = shared_memory.SharedMemory(name=description['name'])
+	matrix = np.ndarray(description['shape'], dtype=np.float32, buffer=shared_memory_block.buf)
+	matrix.flags.writeable = False
+	return shared_memory_block, matrix
+
+def init_worker(sim_config, distance_matrix_description, duration_matrix_description, num_threads):
+	global worker_shared_memories, worker_sim_config
+	# Share the cores between the workers' routing optimizer processes too
+	if num_threads is not None:
+		os.environ.setdefault('OMP_NUM_THREADS', str(num_threads))
+	if distance_matrix_description is None:
+		worker_sim_config = sim_config
+		return
+	distance_shared_memory, distance_matrix = attach_shared_matrix(distance_matrix_description)
+	duration_shared_memory, duration_matrix = attach_shared_matrix(duration_matrix_description)
+	worker_shared_memories = [distance_shared_memory, duration_shared_memory]
+	worker_sim_config = {**sim_config, 'distance_matrix': distance_matrix, 'duration_matrix': duration_matrix}
+
+def create_simulation(sim_config, seed, log_dir, overrides = None):
+	return waste_pickup_sim.WastePickupSimulation({
+		**sim_config,
+		**(overrides or {}),
+		'seed': seed,
+		'log_dir': log_dir,
+		'log_quiet': True
+	})
+
+def get_run_statistics(sim, run_index, seed, start_time):
+	"""Save the logs and the record of a finished simulation. Returns the statistics of the run"""
+	sim.save_log()
+	sim.sim_record()
+	return {
+		'run_index': run_index,
+		'seed': seed,
+		'cost': sim.sim_records['cost'],
+		'pickup_site_overflow_days': sim.sim_records['pickup_site_overflow_days'],
+		'odometer': sum(vehicle.vehicle_odometer for vehicle in sim.vehicles),
+		'vehicle_run_time': sum(vehicle.total_run_time for vehicle in sim.vehicles),
+		'overtime': sum(vehicle.overtime for vehicle in sim.vehicles),
+		'num_warnings': len(sim.sim_records['warnings']),
+		'computational_time': sim.total_time,
+		'wall_time': time.time() - start_time
+	}
+
+def run_simulation(sim_config, run_index, seed, log_dir, overrides = None):
+	"""Run one simulation with the given seed and config overrides, logging to log_dir. Returns the statistics of the run"""
+	start_time = time.time()
+	sim = create_simulation(sim_config, seed, log_dir, overrides)
+	sim.sim_run()
+	return get_run_statistics(sim, run_index, seed, start_time)
+
+def run_worker_simulation(run_index, seed, log_dir, overrides = None):
+	return run_simulation(worker_sim_config, run_index, seed, log_dir, overrides)
+
+
+def t_quantile(p, degrees_of_freedom):
+	"""Quantile of Student's t distribution, exact for 1 and 2 degrees of freedom and by a Cornish-Fisher expansion otherwise"""
+	if degrees_of_freedom == 1:
+		return math.tan(math.pi*(p - 0.5))
+	if degrees_of_freedom == 2:
+		return (2*p - 1)/math.sqrt(2*p*(1 - p))
+	z = statistics.NormalDist().inv_cdf(p)
+	n = degrees_of_freedom
+	return (z
+		+ (z**3 + z)/(4*n)
+		+ (5*z**5 + 16*z**3 + 3*z)/(96*n**2)
+		+ (3*z**7 + 19*z**5 + 17*z**3 - 15*z)/(384*n**3)
+		+ (79*z**9 + 776*z**7 + 1482*z**5 - 1920*z**3 - 945*z)/(92160*n**4))
+
+def summarize(values, confidence = 0.95):
+	"""Mean, standard deviation and confidence interval of the mean of a list of values"""
+	values = np.asarray(values, dtype=np.float64)
+	summary = {'n': len(values), 'mean': float(np.mean(values)) if len(values) > 0 else math.nan}
+	if len(values) > 1:
+		std = float(np.std(values, ddof=1))
+		half_width = t_quantile(0.5 + confidence/2, len(values) - 1)*std/math.sqrt(len(values))
+		summary.update({'std': std, 'ci_low': summary['mean'] - half_width, 'ci_high': summary['mean'] + half_width})
+	else:
+		summary.update({'std': math.nan, 'ci_low': math.nan, 'ci_high': math.nan})
+	return summary
+
+def aggregate(runs, confidence = 0.95):
+	"""Summarize each statistic over the runs"""
+	return {name: summarize([run[name] for run in runs], confidence) for name in statistic_names}
+
+
+def run_in_worker_pool(sim_config, jobs, num_workers):
+	"""Run simulations of jobs [(run index, seed, log dir, config overrides), ...] in a pool of worker processes. Returns the statistics of the runs in job order"""
+	if isinstance(sim_config['distance_matrix'], SparseMatrixView):
+		shared_sim_config = dict(sim_config)
+		shared_memory_blocks = []
+		distance_matrix_description = duration_matrix_description = None
+	else:
+		shared_sim_config = {key: value for key, value in sim_config.items() if key not in ('distance_matrix', 'duration_matrix')}
+		distance_shared_memory, distance_matrix_description = create_shared_matrix(sim_config['distance_matrix'])
+		duration_shared_memory, duration_matrix_description = create_shared_matrix(sim_config['duration_matrix'])
+		shared_memory_blocks = [distance_shared_memory, duration_shared_memory]
+	shared_sim_config['write_sample_logs'] = False
+	try:
+		with ProcessPoolExecutor(
+			max_workers=num_workers,
+			initializer=init_worker,
+			initargs=(shared_sim_config, distance_matrix_description, duration_matrix_description, max(1, (os.cpu_count() or 1)//num_workers))
+		) as executor:
+			futures = [executor.submit(run_worker_simulation, *job) for job in jobs]
+			return sorted((future.result() for future in as_completed(futures)), key=lambda run: run['run_index'])
+	finally:
+		for shared_memory_block in shared_memory_blocks:
+			shared_memory_block.close()
+			shared_memory_block.unlink()
+
+def run_interleaved_jobs(sim_config, jobs, num_routing_workers, log_dir):
+	"""
+	Run simulations of jobs [(run index, seed, log dir, config overrides), ...] interleaved in this process, with
+	asynchronous routing in one pool of num_routing_workers routing workers, which log to routing_optimizer_log.txt in
+	log_dir. Returns the statistics of the runs in job order. The computational and wall times of each run include the
+	time spent running the others
+	"""
+	start_time = time.time()
+	with RoutingExecutor(num_routing_workers, os.path.join(log_dir, 'routing_optimizer_log.txt')) as routing_executor:
+		sims = [create_simulation({**sim_config, 'write_sample_logs': False, 'routing_executor': routing_executor}, seed, log_dir, overrides) for _, seed, log_dir, overrides in jobs]
+		run_interleaved(sims)
+	return [get_run_statistics(sim, run_index, seed, start_time) for sim, (run_index, seed, _, _) in zip(sims, jobs)]
+
+def run_ensemble(sim_config, num_runs, num_workers = None, base_seed = 0, log_dir = 'log/ensemble', confidence = 0.95, num_routing_workers = None):
+	"""
+	Run num_runs simulations of a preprocessed sim config in parallel, with seeds base_seed, base_seed + 1, ... Each run
+	logs to its own subdirectory of log_dir and the sample logs for animation are not written. The runs differ by the
+	seeded random numbers of the simulation, such as the noise set by config 'daily_growth_rate_noise_sigma', and by
+	the routing optimizer. Returns {'runs': [statistics of each run], 'summary': {statistic: {'n', 'mean', 'std',
+	'ci_low', 'ci_high'}}}, also saved to ensemble_record.json in log_dir.
+	With num_routing_workers, the runs are instead interleaved in this process with asynchronous routing, and their
+	routing requests share a pool of that many routing workers. This suits the genetic algorithm router, whose routing
+	takes most of the time of a run.
+	"""
+	if num_workers is None:
+		num_workers = min(num_runs, os.cpu_count() or 1)
+	start_time = time.time()
+	jobs = [(run_index, base_seed + run_index, os.path.join(log_dir, f"run_{run_index:04d}"), None) for run_index in range(num_runs)]
+	if num_routing_workers is not None:
+		num_workers = 1
+		runs = run_interleaved_jobs(sim_config, jobs, num_routing_workers, log_dir)
+	else:
+		runs = run_in_worker_pool(sim_config, jobs, num_workers)
+
+	ensemble_record = {
+		'num_runs': num_runs,
+		'num_workers': num_workers,
+		'num_routing_workers': num_routing_workers,
+		'confidence': confidence,
+		'wall_time': time.time() - start_time,
+		'runs': runs,
+		'summary': aggregate(runs, confidence)
+	}
+	os.makedirs(log_dir, exist_ok=True)
+	with open(os.path.join(log_dir, 'ensemble_record.json'), 'w') as f:
+		json.dump(ensemble_record, f, indent=4)
+	return ensemble_record
+
+def run_variants(sim_config, variants, num_workers = None, seed = 0, log_dir = 'log/variants'):
+	"""
+	Run variants of a preprocessed sim config in parallel, each given as a dict of config overrides. For what-if
+	studies, the variants can fork from a snapshot with override {'snapshot': snapshot dict or filename}, for example
+	with another 'depots' list to add a vehicle. All variants use the same seed, or the random number generator state of
+	their snapshot, so that they differ only by their overrides. Returns {'runs': [statistics of each variant]}, also
+	saved to variants_record.json in log_dir.
+	"""
+	if num_workers is None:
+		num_workers = min(len(variants), os.cpu_count() or 1)
+	start_time = time.time()
+	# Load snapshot files once, and send them to the workers as dicts
+	variants = [{**variant, 'snapshot': waste_pickup_sim.load_snapshot(variant['snapshot'])} if isinstance(variant.get('snapshot'), str) else variant for variant in variants]
+	runs = run_in_worker_pool(sim_config, [(run_index, seed, os.path.join(log_dir, f"variant_{run_index:04d}"), variant) for run_index, variant in enumerate(variants)], num_workers)
+
+	variants_record = {
+		'num_variants': len(variants),
+		'num_workers': num_workers,
+		'wall_time': time.time() - start_time,
+		'runs': runs
+	}
+	os.makedirs(log_dir, exist_ok=True)
+	with open(os.path.join(log_dir, 'variants_record.json'), 'w') as f:
+		json.dump(variants_record, f, indent=4)
+	return variants_record
@@ -0,0 +1,170 @@
+import heapq
+import time
+
+# Lightweight discrete event kernel, a drop-in alternative to SimPy for the processes of the waste pickup simulation,
+# which only wait for timeouts. Processes are generators that yield env.timeout(delay), as with SimPy, and are resumed
+# in the same order as SimPy would: by time, then priority (process starts before timeouts), then scheduling order.
+# Periodic samplers replace processes that only sample the state at a fixed interval. The samples between two events
+# see the same state, so they are taken in one batch instead of one event each.
+
+# Event priorities, as in SimPy
+URGENT = 0
+NORMAL = 1
+
+
+class Timeout():
+	__slots__ = ('delay',)
+
+	def __init__(self, delay):
+		self.delay = delay
+
+
+class Process():
+	__slots__ = ('generator', 'name')
+
+	def __init__(self, generator):
+		self.generator = generator
+		self.name = getattr(generator, '__name__', type(generator).__name__)
+
+
+# Callback at now, now + interval, ..., as if by a process that yields timeouts of interval
+class PeriodicSampler():
+	__slots__ = ('interval', 'callback', 'name', 'time', 'priority', 'eid')
+
+	def __init__(self, interval, callback, time, eid):
+		self.interval = interval
+		self.callback = callback
+		self.name = getattr(callback, '__name__', type(callback).__name__)
+		# Ordering key of the next sample. The first one is like the start of a process
+		self.time = time
+		self.priority = URGENT
+		self.eid = eid
+
+
+class Environment():
+
+	def __init__(self, initial_time = 0):
+		self.now = initial_time
+		self._queue = [] # (time, priority, event id, process)
+		self._eid = 0
+		self.samplers = []
+
+	def timeout(self, delay):
+		if delay < 0:
+			raise ValueError(f"Negative delay {delay}")
+		return Timeout(delay)
+
+	def process(self, generator):
+		"""Start a process. Returns it"""
+		process = Process(generator)
+		heapq.heappush(self._queue, (self.now, URGENT, self._eid, process))
+		self._eid += 1
+		return process
+
+	def periodic(self, interval, callback):
+		"""
+		Call callback(times) with a list of sample times, for samples at now, now + interval, ... in the order that a
+		process sampling at each time would. Samples with no events between them are batched in one call
+		"""
+		sampler = PeriodicSampler(interval, callback, self.now, self._eid)
+		self._eid += 1
+		self.samplers.append(sampler)
+		return sampler
+
+	def peek(self):
+		"""Time of the next event, or infinity if there are none"""
+		return self._queue[0][0] if len(self._queue) > 0 else float('inf')
+
+	def take_samples(self, until_key):
+		"""Take the samples that come before until_key (time, priority, event id)"""
+		for sampler in self.samplers:
+			if (sampler.time, sampler.priority, sampler.eid) < until_key:
+				self.take_sampler_samples(sampler, until_key[0])
+
+	def take_sampler_samples(self, sampler, until_time):
+		times = [sampler.time]
+		next_time = sampler.time + sampler.interval
+		# Each later sample is scheduled after the events before it, so an event at the same time comes first
+		while next_time < until_time:
+			times.append(next_time)
+			next_time += sampler.interval
+		self.now = times[-1]
+		sampler.callback(times)
+		sampler.time = next_time
+		sampler.priority = NORMAL
+		sampler.eid = self._eid + len(times) - 1
+		self._eid += len(times)
+
+	def resume(self, process):
+		try:
+			timeout = process.generator.send(None)
+		except StopIteration:
+			return
+		if type(timeout) is not Timeout:
+			raise TypeError(f"Process {process.name} yielded {timeout!r}, only timeouts are supported")
+		heapq.heappush(self._queue, (self.now + timeout.delay, NORMAL, self._eid, process))
+		self._eid += 1
+
+	def step(self):
+		"""Process the next event, after any samples before it"""
+		if len(self.samplers) > 0:
+			self.take_samples(self._queue[0][:3])
+		event_time, _, _, process = heapq.heappop(self._queue)
+		self.now = event_time
+		self.resume(process)
+
+	def run(self, until):
+		"""Run until time until. Events at until are left for later, as with SimPy"""
+		if until <= self.now:
+			raise ValueError(f"until ({until}) must be greater than the current simulation time")
+		queue = self._queue
+		while len(queue) > 0 and queue[0][0] < until:
+			self.step()
+		if len(self.samplers) > 0:
+			self.take_samples((until, URGENT, -1))
+		self.now = until
+
+
+# Kernel environment that counts events and their wall time by process name, like the SimPy InstrumentedEnvironment
+# of simpy_engine.py. A batch of samples counts as one event
+class InstrumentedEnvironment(Environment):
+
+	def __init__(self, initial_time = 0, sample_interval = 24*60):
+		"""sample_interval: simulation time between samples of the event queue length and event count"""
+		super().__init__(initial_time)
+		self.num_events = 0
+		self.peak_queue_length = 0
+		self.num_events_by_process = {}
+		self.wall_time_by_process = {}
+		self.sample_interval = sample_interval
+		self.next_sample_time = initial_time
+		self.samples = [] # (wall time, simulation time, event queue length, number of events)
+
+	def count(self, name, start_time):
+		self.num_events += 1
+		self.num_events_by_process[name] = self.num_events_by_process.get(name, 0) + 1
+		self.wall_time_by_process[name] = self.wall_time_by_process.get(name, 0) + time.perf_counter() - start_time
+
+	def take_sampler_samples(self, sampler, until_time):
+		start_time = time.perf_counter()
+		try:
+			super().take_sampler_samples(sampler, until_time)
+		finally:
+			self.count(sampler.name, start_time)
+
+	def resume(self, process):
+		start_time = time.perf_counter()
+		try:
+			super().resume(process)
+		finally:
+			self.count(process.name, start_time)
+
+	def step(self):
+		queue_length = len(self._queue)
+		if queue_length > self.peak_queue_length:
+			self.peak_queue_length = queue_length
+		next_time = self._queue[0][0]
+		if next_time >= self.next_sample_time:
+			self.samples.append((time.perf_counter(), next_time, queue_length, self.num_events))
+			self.next_sample_time = next_time + self.sample_interval
+		super().step()
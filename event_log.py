@@ -0,0 +1,105 @@
+import json
+import os
+from time import perf_counter
+
+# Event levels, in increasing order of importance
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+level_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING'}
+levels_by_name = {name: level for level, name in level_names.items()}
+
+# Structured event log. An event has a level, a time, an event type, an optional entity kind and index, and numeric
+# or other JSON-serializable fields. Events below the log level are dropped before any formatting. Events are streamed
+# to a buffered JSON Lines file during the run, and rendered as text only for printing. Warnings are also kept in
+# memory, so that they are available without the file.
+class EventLog():
+
+	def __init__(self, filename = None, level = DEBUG, quiet = False, renderers = None, time_to_string = str, buffer_size = 1 << 20):
+		"""
+		filename: JSON Lines file to stream the events to, or None to not store the events
+		level: minimum level of recorded events, a level number or name
+		quiet: if True, don't print events
+		renderers: dict of event type: function that returns a text message given the event dict
+		time_to_string: function that converts event time to text
+		"""
+		self.filename = filename
+		self.level = levels_by_name[level] if isinstance(level, str) else level
+		self.quiet = quiet
+		self.renderers = renderers or {}
+		self.time_to_string = time_to_string
+		self.buffer_size = buffer_size
+		self.file = None
+		self.num_events = 0
+		self.num_events_by_level = {level: 0 for level in level_names}
+		self.warning_events = [] # Recorded events at or above WARNING
+		self.wall_time = 0 # Seconds spent formatting, writing and printing events
+
+	def enabled(self, level):
+		"""Check if an event of the level would be recorded. Use to skip computing expensive fields"""
+		return level >= self.level
+
+	def record(self, level, time, event_type, entity_kind = None, entity_index = None, fields = None):
+		if level < self.level:
+			return
+		start_time = perf_counter()
+		event = {'level': level, 'time': time, 'type': event_type}
+		if entity_kind is not None:
+			event['entity'] = entity_kind
+			event['index'] = entity_index
+		if fields:
+			event.update(fields)
+		self.num_events += 1
+		self.num_events_by_level[level] = self.num_events_by_level.get(level, 0) + 1
+		if level >= WARNING:
+			self.warning_events.append(event)
+		if self.filename is not None:
+			if self.file is None:
+				if os.path.dirname(self.filename):
+					os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+				self.file = open(self.filename, 'w', buffering=self.buffer_size)
+			self.file.write(json.dumps(event))
+			self.file.write("\n")
+		if not self.quiet:
+			print(self.render(event))
+		self.wall_time += perf_counter() - start_time
+
+	def render(self, event):
+		"""Get an event as a line of text"""
+		renderer = self.renderers.get(event['type'])
+		message = renderer(event) if renderer is not None else ", ".join(f"{key}: {value}" for key, value in event.items() if key not in ('level', 'time', 'type', 'entity', 'index'))
+		if 'entity' in event:
+			message = f"{event['entity']} #{event['index']}: {message}"
+		if event['level'] >= WARNING:
+			return f"{self.time_to_string(event['time'])} {level_names.get(event['level'], event['level'])} - {message}"
+		return f"{self.time_to_string(event['time'])} - {message}"
+
+	def flush(self):
+		if self.file is not None:
+			self.file.flush()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def get_warnings(self):
+		"""Get the recorded warnings as lines of text, whether or not the events are stored in a file"""
+		return [self.render(event) for event in self.warning_events]
+
+	def read(self, level = None, event_type = None):
+		"""Iterate over the recorded events in the file, optionally only those at or above a level, or of a type"""
+		if self.filename is None or self.num_events == 0:
+			return
+		self.flush()
+		with open(self.filename) as f:
+			for line in f:
+				event = json.loads(line)
+				if (level is None or event['level'] >= level) and (event_type is None or event['type'] == event_type):
+					yield event
+
+	def read_text(self, level = None, event_type = None):
+		"""Iterate over the recorded events in the file as lines of text"""
+		for event in self.read(level, event_type):
+			yield self.render(event)
@@ -0,0 +1,70 @@
+import numpy as np
+
+# Offline distance and duration matrixes from great-circle distances, for running without a routing API. Road distances
+# are approximated by great-circle distances multiplied by a detour factor, and durations by a speed model of distance
+# bands, each with its own speed. The matrixes are computed in row blocks to bound memory use.
+
+earth_radius = 6371008.8 # Meters
+
+def haversine_distances(a_lonlats, b_lonlats):
+	"""Great-circle distances in meters between lonlats a and b, which are broadcast against each other"""
+	a_lonlats = np.radians(np.asarray(a_lonlats, dtype=np.float64))
+	b_lonlats = np.radians(np.asarray(b_lonlats, dtype=np.float64))
+	a_lon, a_lat = a_lonlats[..., 0], a_lonlats[..., 1]
+	b_lon, b_lat = b_lonlats[..., 0], b_lonlats[..., 1]
+	h = np.sin((b_lat - a_lat)/2)**2 + np.cos(a_lat)*np.cos(b_lat)*np.sin((b_lon - a_lon)/2)**2
+	return 2*earth_radius*np.arcsin(np.sqrt(np.minimum(h, 1)))
+
+def haversine_distance_matrix(source_lonlats, destination_lonlats):
+	"""Great-circle distances in meters between arrays of source and destination lonlats"""
+	source_lonlats = np.asarray(source_lonlats, dtype=np.float64).reshape(-1, 2)
+	destination_lonlats = np.asarray(destination_lonlats, dtype=np.float64).reshape(-1, 2)
+	return haversine_distances(source_lonlats[:, None, :], destination_lonlats[None, :, :])
+
+
+class HaversineMatrixBackend():
+
+	def __init__(self, detour_factor = 1.3, speed_bands = ((0, 60),), max_block_elements = 1 << 22):
+		"""
+		detour_factor: ratio of road distance to great-circle distance
+		speed_bands: (start road distance in meters, speed in km/h) of each distance band, in increasing order of
+			distance. The part of a trip within a band is driven at the speed of the band. For example
+			((0, 40), (5000, 80)) drives the first 5 km at 40 km/h and the rest at 80 km/h
+		max_block_elements: maximum number of matrix elements computed at once
+		"""
+		self.detour_factor = detour_factor
+		self.speed_bands = tuple((float(start), float(speed)) for start, speed in speed_bands)
+		self.max_block_elements = max_block_elements
+
+	@property
+	def name(self):
+		"""Name that identifies the backend and its parameters, for keeping its matrixes apart from others"""
+		return f"haversine_{self.detour_factor:g}_" + '_'.join(f"{start:g}-{speed:g}" for start, speed in self.speed_bands)
+
+	def get_durations(self, distances):
+		"""Durations in minutes of driving road distances in meters"""
+		durations = np.zeros_like(distances)
+		band_ends = [start for start, _ in self.speed_bands[1:]] + [np.inf]
+		for (band_start, speed), band_end in zip(self.speed_bands, band_ends):
+			durations += np.clip(distances - band_start, 0, band_end - band_start)/(speed/3.6*60)
+		return durations
+
+	def get_distance_and_duration_matrix(self, coords, source_indexes = None, destination_indexes = None):
+		"""
+		Get float32 distance (m) and duration (min) matrixes with rows for source_indexes and columns for
+		destination_indexes of coords. Source and destination indexes default to all indexes
+		"""
+		coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+		source_lonlats = coords if source_indexes is None else coords[np.asarray(source_indexes, dtype=np.int64)]
+		destination_lonlats = coords if destination_indexes is None else coords[np.asarray(destination_indexes, dtype=np.int64)]
+		distance_matrix = np.empty((len(source_lonlats), len(destination_lonlats)), dtype=np.float32)
+		duration_matrix = np.empty((len(source_lonlats), len(destination_lonlats)), dtype=np.float32)
+		block_size = max(1, self.max_block_elements // max(len(destination_lonlats), 1))
+		for block_start in range(0, len(source_lonlats), block_size):
+			block_distances = haversine_distance_matrix(source_lonlats[block_start:block_start + block_size], destination_lonlats)*self.detour_factor
+			distance_matrix[block_start:block_start + block_size] = block_distances
+			duration_matrix[block_start:block_start + block_size] = self.get_durations(block_distances)
+		return {
+			"distance_matrix": distance_matrix,
+			"duration_matrix": duration_matrix
+		}
@@ -0,0 +1,109 @@
+import numpy as np
+from sparse_travel_matrix import as_travel_matrix
+from plan_evaluator import get_pickup_durations
+
+def heuristic_router(routing_input, num_days = 14, lookahead_days = 2, slack_penalty = 30):
+	"""
+	Plan routes for num_days days by parallel nearest neighbour construction, as a fast alternative to the genetic
+	algorithm router. Each day, the candidate pickup sites are those that would overflow within lookahead_days unless
+	visited. All vehicles of the day are extended at once, each to its cheapest feasible candidate, with conflicts over the
+	same candidate resolved in favor of the lowest cost. The cost is the travel duration plus slack_penalty minutes for each
+	day the site could still wait. A candidate is feasible if the vehicle can visit it and return to its home depot within
+	max_route_duration. A vehicle that has no load capacity left for a candidate first returns to its home depot to dump its
+	load. Pickup site levels are forecast over the days from the growth rates.
+
+	routing_input is as in WastePickupSimulation.daily_routing. Returns routing output
+	{'days': [{'vehicles': [{'route': [location index, ...]}, ...]}, ...]}
+	"""
+	pickup_sites = routing_input['pickup_sites']
+	capacities = np.array([pickup_site['capacity'] for pickup_site in pickup_sites], dtype=np.float64)
+	levels = np.array([pickup_site['level'] for pickup_site in pickup_sites], dtype=np.float64)
+	daily_growths = np.array([pickup_site['growth_rate'] for pickup_site in pickup_sites], dtype=np.float64)*(24*60)
+	site_locations = np.array([pickup_site['location_index'] for pickup_site in pickup_sites], dtype=np.int64)
+	depot_locations = np.array([depot['location_index'] for depot in routing_input['depots']], dtype=np.int64)
+	vehicles = routing_input['vehicles']
+	load_capacities = np.array([vehicle['load_capacity'] for vehicle in vehicles], dtype=np.float64)
+	home_locations = depot_locations[np.array([vehicle['home_depot_index'] for vehicle in vehicles], dtype=np.int64)]
+	max_route_durations = np.array([vehicle['max_route_duration'] for vehicle in vehicles], dtype=np.float64)
+	pickup_durations = get_pickup_durations(vehicles)
+	duration_matrix = as_travel_matrix(routing_input['duration_matrix'])
+	num_vehicles = len(vehicles)
+
+	days = []
+	for day in range(num_days):
+		# Number of days each site could wait before overflowing at the end of a day
+		with np.errstate(divide='ignore', invalid='ignore'):
+			slacks = np.maximum(np.floor((capacities - levels)/daily_growths), 0)
+		slacks[daily_growths <= 0] = np.inf
+		candidates = np.nonzero((slacks < lookahead_days) & (levels > 0))[0]
+		candidate_locations = site_locations[candidates]
+		candidate_levels = levels[candidates]
+		candidate_penalties = slacks[candidates]*slack_penalty
+		available = np.ones(len(candidates), dtype=bool)
+
+		home_to_candidate = duration_matrix[home_locations[:, None], candidate_locations[None, :]].astype(np.float64)
+		candidate_to_home = duration_matrix[candidate_locations[None, :], home_locations[:, None]].astype(np.float64)
+		locations = home_locations.copy()
+		times = np.zeros(num_vehicles)
+		loads = np.zeros(num_vehicles)
+		active = np.ones(num_vehicles, dtype=bool)
+		routes = [[] for _ in range(num_vehicles)]
+
+		while len(candidates) > 0 and np.any(active) and np.any(available):
+			vehicle_indexes = np.nonzero(active)[0]
+			current_to_candidate = duration_matrix[locations[vehicle_indexes, None], candidate_locations[None, :]]
+			current_to_home = duration_matrix[locations[vehicle_indexes], home_locations[vehicle_indexes]].astype(np.float64)
+			fits = (loads[vehicle_indexes, None] + candidate_levels[None, :] <= load_capacities[vehicle_indexes, None]) | (loads[vehicle_indexes, None] == 0)
+			travel_durations = np.where(fits, current_to_candidate, current_to_home[:, None] + home_to_candidate[vehicle_indexes])
+			finish_times = times[vehicle_indexes, None] + travel_durations + pickup_durations[vehicle_indexes, None] + candidate_to_home[vehicle_indexes]
+			costs = np.where(available[None, :] & (finish_times <= max_route_durations[vehicle_indexes, None]), travel_durations + candidate_penalties[None, :], np.inf)
+
+			# Vehicles with no feasible candidate are done for the day
+			choices = np.argmin(costs, axis=1)
+			has_choice = np.isfinite(costs[np.arange(len(vehicle_indexes)), choices])
+			active[vehicle_indexes[~has_choice]] = False
+
+			# Assign one vehicle per candidate, the one with the lowest cost. The others choose again among what is left
+			pending = np.nonzero(has_choice)[0]
+			winners = []
+			while len(pending) > 0:
+				choices = np.argmin(costs[pending], axis=1)
+				choice_costs = costs[pending, choices]
+				pending = pending[np.isfinite(choice_costs)]
+				choices = choices[np.isfinite(choice_costs)]
+				choice_costs = choice_costs[np.isfinite(choice_costs)]
+				if len(pending) == 0:
+					break
+				order = np.argsort(choice_costs, kind='stable')
+				_, first_indexes = np.unique(choices[order], return_index=True)
+				round_winners = order[first_indexes]
+				winners.append((pending[round_winners], choices[round_winners]))
+				costs[:, choices[round_winners]] = np.inf
+				pending = np.delete(pending, round_winners)
+
+			for winner_rows, winner_choices in winners:
+				winner_vehicle_indexes = vehicle_indexes[winner_rows]
+				winner_fits = fits[winner_rows, winner_choices]
+				for vehicle_index, candidate_index, candidate_fits in zip(winner_vehicle_indexes.tolist(), winner_choices.tolist(), winner_fits.tolist()):
+					if not candidate_fits:
+						routes[vehicle_index].append(int(home_locations[vehicle_index])) # Dump the load
+					routes[vehicle_index].append(int(candidate_locations[candidate_index]))
+				loads[winner_vehicle_indexes] = np.where(winner_fits, loads[winner_vehicle_indexes], 0)
+				amounts = np.minimum(candidate_levels[winner_choices], load_capacities[winner_vehicle_indexes] - loads[winner_vehicle_indexes])
+				loads[winner_vehicle_indexes] += amounts
+				candidate_levels[winner_choices] -= amounts
+				times[winner_vehicle_indexes] += travel_durations[winner_rows, winner_choices] + pickup_durations[winner_vehicle_indexes]
+				locations[winner_vehicle_indexes] = candidate_locations[winner_choices]
+				available[winner_choices] = False
+
+		days.append({
+			'vehicles': [{
+				'route': [int(home_locations[vehicle_index]), *route, int(home_locations[vehicle_index])] if len(route) > 0 else []
+			} for vehicle_index, route in enumerate(routes)]
+		})
+
+		# Forecast the levels of the next day
+		levels[candidates] = candidate_levels
+		levels += daily_growths
+
+	return {'days': days}
@@ -0,0 +1,134 @@
+import contextlib
+import cProfile
+import importlib
+import json
+import os
+import threading
+import time
+
+# Lightweight instrumentation of a simulation run: wall-time spans around named parts of the run, SimPy event counts
+# and wall time by process, the peak length of the event queue, and an optional profiler. The spans and daily samples
+# of the event queue are exported as a Chrome trace event file, loadable in chrome://tracing, Perfetto and Speedscope.
+# Each span is on the track of the thread that ran it, as routing may run in the threads of a routing executor.
+
+# Simulation engines by name: modules with Environment and InstrumentedEnvironment classes, imported when first used
+engine_modules = {
+	'simpy': 'simpy_engine',
+	'kernel': 'event_kernel'
+}
+
+
+class Instrumentation():
+
+	def __init__(self, enabled = True):
+		"""With enabled False, spans are not recorded and create_environment gives a plain SimPy environment"""
+		self.enabled = enabled
+		self.origin = time.perf_counter()
+		self.spans = [] # (name, start wall time, duration, args, thread id)
+		self.thread_names = {} # Thread id: name
+		self.profiler = None
+		self.profile_filename = None
+
+	def create_environment(self, initial_time = 0, engine = 'simpy'):
+		"""Create a simulation environment of an engine, 'simpy' or 'kernel' for the event kernel of event_kernel.py"""
+		if engine not in engine_modules:
+			raise ValueError(f"Unknown engine {engine!r}, expected one of {', '.join(engine_modules)}")
+		engine_module = importlib.import_module(engine_modules[engine])
+		return engine_module.InstrumentedEnvironment(initial_time) if self.enabled else engine_module.Environment(initial_time)
+
+	@contextlib.contextmanager
+	def span(self, name, **args):
+		"""Record the wall time of a with block as a span. args are JSON-serializable values shown in the trace"""
+		if not self.enabled:
+			yield
+			return
+		start_time = time.perf_counter()
+		thread = threading.current_thread()
+		try:
+			yield
+		finally:
+			self.thread_names[thread.ident] = thread.name
+			self.spans.append((name, start_time, time.perf_counter() - start_time, args, thread.ident))
+
+	@contextlib.contextmanager
+	def profile(self, profiler, filename, hook = None):
+		"""
+		Profile a with block. profiler: None, or 'cprofile' to save cProfile statistics to filename, loadable with pstats
+		and snakeviz. hook: None, or a function that returns a context manager to enter around the block, for example to
+		start and stop a sampling profiler
+		"""
+		with contextlib.ExitStack() as stack:
+			if hook is not None:
+				stack.enter_context(hook())
+			if profiler == 'cprofile':
+				self.profiler = cProfile.Profile()
+				self.profile_filename = filename
+				self.profiler.enable()
+				stack.callback(self.save_profile)
+			elif profiler is not None:
+				raise ValueError(f"Unknown profiler {profiler!r}, expected 'cprofile'")
+			yield
+
+	def save_profile(self):
+		self.profiler.disable()
+		os.makedirs(os.path.dirname(self.profile_filename) or '.', exist_ok=True)
+		self.profiler.dump_stats(self.profile_filename)
+
+	def get_span_totals(self):
+		"""Count, total and maximum wall time in seconds of the spans of each name"""
+		totals = {}
+		for name, _, duration, _, _ in self.spans:
+			total = totals.setdefault(name, {'count': 0, 'total_time': 0, 'max_time': 0})
+			total['count'] += 1
+			total['total_time'] += duration
+			total['max_time'] = max(total['max_time'], duration)
+		return totals
+
+	def get_record(self, env, event_log = None):
+		"""Instrumentation summary for the sim record"""
+		record = {'spans': self.get_span_totals()}
+		if hasattr(env, 'num_events_by_process'): # An instrumented environment
+			record['num_events'] = env.num_events
+			record['peak_queue_length'] = env.peak_queue_length
+			record['processes'] = {name: {
+				'num_events': num_events,
+				'wall_time': env.wall_time_by_process[name]
+			} for name, num_events in sorted(env.num_events_by_process.items(), key=lambda item: -env.wall_time_by_process[item[0]])}
+		if event_log is not None:
+			record['event_log'] = {'num_events': event_log.num_events, 'wall_time': event_log.wall_time}
+		if self.profile_filename is not None:
+			record['profile_filename'] = self.profile_filename
+		return record
+
+	def write_trace(self, filename, env = None):
+		"""Write the spans, and the samples of an instrumented environment, as a Chrome trace event file"""
+		pid = os.getpid()
+		trace_events = [{
+			'name': 'thread_name',
+			'ph': 'M',
+			'pid': pid,
+			'tid': tid,
+			'args': {'name': thread_name}
+		} for tid, thread_name in list(self.thread_names.items())]
+		trace_events += [{
+			'name': name,
+			'cat': 'sim',
+			'ph': 'X',
+			'ts': (start_time - self.origin)*1e6,
+			'dur': duration*1e6,
+			'pid': pid,
+			'tid': tid,
+			'args': args
+		} for name, start_time, duration, args, tid in self.spans]
+		if hasattr(env, 'num_events_by_process'): # An instrumented environment
+			for wall_time, sim_time, queue_length, num_events in env.samples:
+				trace_events.append({
+					'name': 'event_queue',
+					'ph': 'C',
+					'ts': (wall_time - self.origin)*1e6,
+					'pid': pid,
+					'args': {'queue_length': queue_length, 'num_events': num_events, 'sim_time': sim_time}
+				})
+		os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+		with open(filename, 'w') as f:
+			json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
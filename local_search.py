@@ -0,0 +1,458 @@
+import time
+import numpy as np
+
+from plan_evaluator import PlanEvaluator, get_pickup_durations, distance_cost, overtime_cost
+from sparse_travel_matrix import SparseMatrixView
+
+# Local search improvement of routing output, between the heuristic router and the genetic algorithm: a good plan in
+# seconds. Moves within a day are evaluated by their change of cost, vectorised over the candidates with the distance
+# and duration matrixes:
+#   2-opt: reverse part of a trip between two depot or terminal stops
+#   relocate: move 1 to 3 consecutive pickup sites of a trip elsewhere in the route of the same or another vehicle,
+#     next to one of their nearest neighbours (or-opt when in the same trip)
+#   swap: exchange pickup sites visited by different vehicles, of which one is among the nearest neighbours of the other
+# The cost of a route is that of its distance and overtime, and a move is not allowed to overload a trip more than it
+# was, with loads forecast from the growth rates. Moves between days change pickup site levels, so they are instead
+# scored in batches with the plan evaluator: removing a visit, or moving it to the previous or next day. The search
+# alternates the two until no move improves or the time budget runs out, and returns the input plan if the plan
+# evaluator does not find the result better.
+
+max_segment_length = 3 # Largest number of consecutive pickup sites moved at once
+min_improvement = 1e-6 # Eur
+
+
+def get_neighbour_lists(routing_input, num_neighbours, max_block_elements = 1 << 22):
+	"""
+	Get the location indexes of the num_neighbours nearest other pickup sites of each pickup site by duration, as a
+	(pickup sites, num_neighbours) array padded with -1. With sparse matrixes, those among their stored neighbours
+	"""
+	site_locations = np.array([pickup_site['location_index'] for pickup_site in routing_input['pickup_sites']], dtype=np.int64)
+	duration_matrix = routing_input['duration_matrix']
+	num_sites = len(site_locations)
+	neighbours = np.full((num_sites, num_neighbours), -1, dtype=np.int64)
+	if isinstance(duration_matrix, SparseMatrixView):
+		matrixes = duration_matrix.matrixes
+		is_site = np.zeros(matrixes.num_locations, dtype=bool)
+		is_site[site_locations] = True
+		candidates = matrixes.neighbour_indexes[site_locations].astype(np.int64)
+		durations = np.where(is_site[candidates], matrixes.values['duration']['neighbour'][site_locations], np.inf)
+		order = np.argsort(durations, axis=1, kind='stable')[:, :num_neighbours]
+		nearest = np.take_along_axis(candidates, order, axis=1)
+		neighbours[:, :nearest.shape[1]] = np.where(np.isfinite(np.take_along_axis(durations, order, axis=1)), nearest, -1)
+		return neighbours
+	k = min(num_neighbours, num_sites - 1)
+	if k <= 0:
+		return neighbours
+	block_size = max(1, max_block_elements//num_sites)
+	for block_start in range(0, num_sites, block_size):
+		rows = np.arange(block_start, min(block_start + block_size, num_sites))
+		durations = np.asarray(duration_matrix[site_locations[rows, None], site_locations[None, :]], dtype=np.float64)
+		durations[np.arange(len(rows)), rows] = np.inf
+		nearest = np.argpartition(durations, k - 1, axis=1)[:, :k] if k < num_sites - 1 else np.argsort(durations, axis=1)[:, :k]
+		order = np.argsort(np.take_along_axis(durations, nearest, axis=1), axis=1, kind='stable')
+		neighbours[rows, :k] = site_locations[np.take_along_axis(nearest, order, axis=1)]
+	return neighbours
+
+
+class LocalSearch():
+
+	def __init__(self, routing_input, num_neighbours = 10, neighbour_lists = None):
+		"""
+		routing_input is as in WastePickupSimulation.daily_routing. num_neighbours: length of the neighbour lists of
+		the pickup sites. neighbour_lists: neighbour lists from get_neighbour_lists, to reuse them
+		"""
+		self.routing_input = routing_input
+		self.distance_matrix = routing_input['distance_matrix']
+		self.duration_matrix = routing_input['duration_matrix']
+		pickup_sites = routing_input['pickup_sites']
+		self.capacities = np.array([pickup_site['capacity'] for pickup_site in pickup_sites], dtype=np.float64)
+		self.initial_levels = np.array([pickup_site['level'] for pickup_site in pickup_sites], dtype=np.float64)
+		self.daily_growths = np.array([pickup_site['growth_rate'] for pickup_site in pickup_sites], dtype=np.float64)*(24*60)
+		site_locations = np.array([pickup_site['location_index'] for pickup_site in pickup_sites], dtype=np.int64)
+		vehicles = routing_input['vehicles']
+		self.num_vehicles = len(vehicles)
+		self.load_capacities = np.array([vehicle['load_capacity'] for vehicle in vehicles], dtype=np.float64)
+		self.max_route_durations = np.array([vehicle['max_route_duration'] for vehicle in vehicles], dtype=np.float64)
+		self.pickup_durations = get_pickup_durations(vehicles)
+		depot_locations = np.array([depot['location_index'] for depot in routing_input['depots']], dtype=np.int64)
+		self.home_locations = depot_locations[np.array([vehicle['home_depot_index'] for vehicle in vehicles], dtype=np.int64)].tolist()
+		# Pickup site index of each location, -1 for other locations. Depots and terminals override pickup sites, as in
+		# the plan evaluator
+		self.site_indexes = np.full(len(self.duration_matrix), -1, dtype=np.int64)
+		self.site_indexes[site_locations] = np.arange(len(site_locations))
+		for location in [*routing_input['depots'], *routing_input['terminals']]:
+			self.site_indexes[location['location_index']] = -1
+		self.neighbour_lists = neighbour_lists if neighbour_lists is not None else get_neighbour_lists(routing_input, num_neighbours)
+		self.evaluator = PlanEvaluator(routing_input)
+		self.stats = None
+
+	def distances(self, sources, destinations):
+		return np.asarray(self.distance_matrix[sources, destinations], dtype=np.float64)
+
+	def durations(self, sources, destinations):
+		return np.asarray(self.duration_matrix[sources, destinations], dtype=np.float64)
+
+	def get_route_stats(self, vehicle_index, route):
+		"""Distance and duration of a route, from the home depot as in the plan evaluator, with the pickup work"""
+		if len(route) == 0:
+			return 0.0, 0.0
+		stops = np.array([self.home_locations[vehicle_index], *route], dtype=np.int64)
+		moving = stops[1:] != stops[:-1]
+		num_pickups = np.count_nonzero(moving & (self.site_indexes[stops[1:]] >= 0))
+		return float(self.distances(stops[:-1], stops[1:]).sum()), float(self.durations(stops[:-1], stops[1:]).sum()) + num_pickups*float(self.pickup_durations[vehicle_index])
+
+	def get_overtimes(self, vehicle_index, durations):
+		return np.maximum(np.asarray(durations) - self.max_route_durations[vehicle_index], 0)
+
+	def get_route_cost(self, vehicle_index, day):
+		if len(self.days[day][vehicle_index]) == 0:
+			return 0.0
+		return distance_cost*self.route_distances[day][vehicle_index] + overtime_cost*float(self.get_overtimes(vehicle_index, self.route_durations[day][vehicle_index]))
+
+	def set_route(self, day, vehicle_index, route):
+		# Consecutive repeated stops left by moves are removed, and a route without pickup sites is not driven
+		route = [location_index for position, location_index in enumerate(route) if position == 0 or location_index != route[position - 1]]
+		if not any(self.site_indexes[location_index] >= 0 for location_index in route):
+			route = []
+		self.days[day][vehicle_index] = route
+		self.route_distances[day][vehicle_index], self.route_durations[day][vehicle_index] = self.get_route_stats(vehicle_index, route)
+
+	def update_amounts(self):
+		"""Forecast the amount picked up at each site on each day, from the levels with the planned visits emptying the sites"""
+		levels = self.initial_levels.copy()
+		self.amounts = []
+		for routes in self.days:
+			self.amounts.append(levels.copy())
+			visited = self.site_indexes[[location_index for route in routes for location_index in route]] if any(len(route) > 0 for route in routes) else np.zeros(0, dtype=np.int64)
+			levels[visited[visited >= 0]] = 0
+			levels += self.daily_growths
+
+	def get_trips(self, route):
+		"""Trip number of each position of a route: the number of depot and terminal stops up to and including it"""
+		return np.cumsum(self.site_indexes[np.asarray(route, dtype=np.int64)] < 0) if len(route) > 0 else np.zeros(0, dtype=np.int64)
+
+	def get_day_table(self, day):
+		"""Edges of the routes of a day, indexed by their end locations, and the loads of the trips"""
+		edge_columns = {'vehicle_index': [], 'position': [], 'source': [], 'destination': [], 'trip': []}
+		trip_loads = {}
+		site_positions = {} # Location index: (vehicle index, position) of its visits
+		for vehicle_index, route in enumerate(self.days[day]):
+			if len(route) < 2:
+				continue
+			route_array = np.asarray(route, dtype=np.int64)
+			trips = self.get_trips(route)
+			site_indexes = self.site_indexes[route_array]
+			is_site = site_indexes >= 0
+			loads = np.bincount(trips[is_site], weights=self.amounts[day][site_indexes[is_site]], minlength=trips[-1] + 1)
+			for trip in np.unique(trips[is_site]).tolist():
+				trip_loads[(vehicle_index, trip)] = float(loads[trip])
+			for position in np.flatnonzero(is_site).tolist():
+				site_positions.setdefault(route[position], []).append((vehicle_index, position))
+			edge_columns['vehicle_index'].append(np.full(len(route) - 1, vehicle_index, dtype=np.int64))
+			edge_columns['position'].append(np.arange(len(route) - 1, dtype=np.int64))
+			edge_columns['source'].append(route_array[:-1])
+			edge_columns['destination'].append(route_array[1:])
+			edge_columns['trip'].append(trips[:-1])
+		edges = {name: np.concatenate(column) if len(column) > 0 else np.zeros(0, dtype=np.int64) for name, column in edge_columns.items()}
+		# Edges by their source and destination locations, for finding the edges next to neighbours
+		edge_keys = np.concatenate([edges['source'], edges['destination']])
+		edge_order = np.argsort(edge_keys, kind='stable')
+		edges['sorted_keys'] = edge_keys[edge_order]
+		edges['sorted_indexes'] = np.concatenate([np.arange(len(edges['source']))]*2)[edge_order]
+		edges['trip_loads'] = trip_loads
+		edges['site_positions'] = site_positions
+		return edges
+
+	def get_edges_next_to(self, edges, location_indexes):
+		location_indexes = location_indexes[location_indexes >= 0]
+		starts = np.searchsorted(edges['sorted_keys'], location_indexes, 'left')
+		ends = np.searchsorted(edges['sorted_keys'], location_indexes, 'right')
+		if len(location_indexes) == 0 or not np.any(ends > starts):
+			return np.zeros(0, dtype=np.int64)
+		return np.unique(np.concatenate([edges['sorted_indexes'][start:end] for start, end in zip(starts.tolist(), ends.tolist())]))
+
+	def is_overloading(self, vehicle_index, load, added_loads):
+		"""Whether adding loads to a trip of load overloads it more than it was"""
+		capacity = self.load_capacities[vehicle_index]
+		return np.maximum(load + added_loads - capacity, 0) > max(load - capacity, 0) + 1e-9
+
+	def two_opt(self, day, vehicle_index, deadline):
+		"""Reverse parts of trips of a route while that improves it. Returns whether it did"""
+		improved = False
+		while time.perf_counter() < deadline:
+			route = self.days[day][vehicle_index]
+			best = None # (cost change, start position, end position)
+			separators = np.flatnonzero(self.site_indexes[np.asarray(route, dtype=np.int64)] < 0) if len(route) > 0 else np.zeros(0, dtype=np.int64)
+			for trip_start, trip_end in zip(separators[:-1].tolist(), separators[1:].tolist()):
+				if trip_end - trip_start < 3:
+					continue
+				stops = np.asarray(route[trip_start:trip_end + 1], dtype=np.int64)
+				n = len(stops)
+				starts, ends = np.meshgrid(np.arange(1, n - 1), np.arange(1, n - 1), indexing='ij')
+				starts, ends = starts[ends > starts], ends[ends > starts]
+				changes = []
+				for matrix in (self.distances, self.durations):
+					forward = np.concatenate([[0], np.cumsum(matrix(stops[:-1], stops[1:]))])
+					backward = np.concatenate([[0], np.cumsum(matrix(stops[1:], stops[:-1]))])
+					changes.append(
+						matrix(stops[starts - 1], stops[ends]) + matrix(stops[starts], stops[ends + 1])
+						- (forward[starts] - forward[starts - 1]) - (forward[ends + 1] - forward[ends])
+						+ (backward[ends] - backward[starts]) - (forward[ends] - forward[starts])
+					)
+				duration = self.route_durations[day][vehicle_index]
+				costs = distance_cost*changes[0] + overtime_cost*(self.get_overtimes(vehicle_index, duration + changes[1]) - self.get_overtimes(vehicle_index, duration))
+				index = int(np.argmin(costs))
+				if costs[index] < -min_improvement and (best is None or costs[index] < best[0]):
+					best = (float(costs[index]), trip_start + int(starts[index]), trip_start + int(ends[index]))
+			if best is None:
+				return improved
+			_, start, end = best
+			self.set_route(day, vehicle_index, route[:start] + route[start:end + 1][::-1] + route[end + 1:])
+			self.num_moves += 1
+			improved = True
+		return improved
+
+	def relocate(self, day, location_index, segment_length, edges):
+		"""
+		Move the visit of a pickup site and the next segment_length - 1 ones in its trip to the best position next to a
+		neighbour, if that improves the plan. Returns whether it did
+		"""
+		if location_index not in edges['site_positions']:
+			return False
+		vehicle_index, start = edges['site_positions'][location_index][0]
+		route = self.days[day][vehicle_index]
+		end = start + segment_length - 1
+		if start < 1 or end + 1 >= len(route) or np.any(self.site_indexes[np.asarray(route[start:end + 1], dtype=np.int64)] < 0):
+			return False
+		first, last = route[start], route[end]
+		previous, following = route[start - 1], route[end + 1]
+		segment_sites = self.site_indexes[np.asarray(route[start:end + 1], dtype=np.int64)]
+		segment_load = float(self.amounts[day][segment_sites].sum())
+		trip = int(self.get_trips(route)[start])
+
+		# Removal
+		removed_distance = float(self.distances(previous, following) - self.distances(previous, first) - self.distances(last, following))
+		removed_duration = float(self.durations(previous, following) - self.durations(previous, first) - self.durations(last, following)) - segment_length*float(self.pickup_durations[vehicle_index])
+		num_route_sites = np.count_nonzero(self.site_indexes[np.asarray(route, dtype=np.int64)] >= 0)
+
+		# Insertion into the edges next to the neighbours of the ends of the segment
+		candidate_edges = self.get_edges_next_to(edges, np.concatenate([self.neighbour_lists[self.site_indexes[first]], self.neighbour_lists[self.site_indexes[last]]]))
+		candidate_vehicle_indexes = edges['vehicle_index'][candidate_edges]
+		candidate_positions = edges['position'][candidate_edges]
+		same_route = candidate_vehicle_indexes == vehicle_index
+		keep = ~(same_route & (candidate_positions >= start - 1) & (candidate_positions <= end))
+		candidate_edges, candidate_vehicle_indexes, candidate_positions, same_route = candidate_edges[keep], candidate_vehicle_indexes[keep], candidate_positions[keep], same_route[keep]
+		if len(candidate_edges) == 0:
+			return False
+		sources, destinations = edges['source'][candidate_edges], edges['destination'][candidate_edges]
+		inserted_distances = self.distances(sources, first) + self.distances(last, destinations) - self.distances(sources, destinations)
+		inserted_durations = self.durations(sources, first) + self.durations(last, destinations) - self.durations(sources, destinations) + segment_length*self.pickup_durations[candidate_vehicle_indexes]
+
+		duration = self.route_durations[day][vehicle_index]
+		overtime = float(self.get_overtimes(vehicle_index, duration))
+		if num_route_sites == segment_length:
+			removal_cost = -self.get_route_cost(vehicle_index, day) # The route is no longer driven
+		else:
+			removal_cost = distance_cost*removed_distance + overtime_cost*(float(self.get_overtimes(vehicle_index, duration + removed_duration)) - overtime)
+		costs = np.empty(len(candidate_edges))
+		# Within the route
+		costs[same_route] = distance_cost*(removed_distance + inserted_distances[same_route]) + overtime_cost*(self.get_overtimes(vehicle_index, duration + removed_duration + inserted_durations[same_route]) - overtime)
+		# Into other routes
+		other = np.flatnonzero(~same_route)
+		if len(other) > 0:
+			other_durations = np.array([self.route_durations[day][index] for index in candidate_vehicle_indexes[other].tolist()])
+			other_max_route_durations = self.max_route_durations[candidate_vehicle_indexes[other]]
+			costs[other] = removal_cost + distance_cost*inserted_distances[other] + overtime_cost*(
+				np.maximum(other_durations + inserted_durations[other] - other_max_route_durations, 0) - np.maximum(other_durations - other_max_route_durations, 0))
+		# Loads of other trips
+		candidate_trips = edges['trip'][candidate_edges]
+		for index in np.flatnonzero(~same_route | (candidate_trips != trip)).tolist():
+			candidate_vehicle_index = int(candidate_vehicle_indexes[index])
+			if self.is_overloading(candidate_vehicle_index, edges['trip_loads'].get((candidate_vehicle_index, int(candidate_trips[index])), 0.0), segment_load):
+				costs[index] = np.inf
+		best = int(np.argmin(costs))
+		if not costs[best] < -min_improvement:
+			return False
+
+		segment = route[start:end + 1]
+		target_vehicle_index, target_position = int(candidate_vehicle_indexes[best]), int(candidate_positions[best])
+		remaining = route[:start] + route[end + 1:]
+		if target_vehicle_index == vehicle_index:
+			if target_position > end:
+				target_position -= segment_length
+			self.set_route(day, vehicle_index, remaining[:target_position + 1] + segment + remaining[target_position + 1:])
+		else:
+			target_route = self.days[day][target_vehicle_index]
+			self.set_route(day, target_vehicle_index, target_route[:target_position + 1] + segment + target_route[target_position + 1:])
+			self.set_route(day, vehicle_index, remaining)
+		self.num_moves += 1
+		return True
+
+	def swap(self, day, location_index, edges):
+		"""Exchange the visit of a pickup site with that of a neighbour by another vehicle, if that improves the plan. Returns whether it did"""
+		if location_index not in edges['site_positions']:
+			return False
+		vehicle_index, position = edges['site_positions'][location_index][0]
+		route = self.days[day][vehicle_index]
+		if position < 1 or position + 1 >= len(route):
+			return False
+		site_index = self.site_indexes[location_index]
+		trip = int(self.get_trips(route)[position])
+		best = None # (cost change, other vehicle index, other position)
+		for neighbour in self.neighbour_lists[site_index].tolist():
+			for other_vehicle_index, other_position in edges['site_positions'].get(neighbour, []):
+				other_route = self.days[day][other_vehicle_index]
+				if other_vehicle_index == vehicle_index or other_position < 1 or other_position + 1 >= len(other_route):
+					continue
+				amount_change = float(self.amounts[day][self.site_indexes[neighbour]] - self.amounts[day][site_index])
+				other_trip = int(self.get_trips(other_route)[other_position])
+				if self.is_overloading(vehicle_index, edges['trip_loads'].get((vehicle_index, trip), 0.0), amount_change) or self.is_overloading(other_vehicle_index, edges['trip_loads'].get((other_vehicle_index, other_trip), 0.0), -amount_change):
+					continue
+				cost = 0.0
+				for index, stops, removed, added in ((vehicle_index, route[position - 1:position + 2], location_index, neighbour), (other_vehicle_index, other_route[other_position - 1:other_position + 2], neighbour, location_index)):
+					distance_change = float(self.distances(stops[0], added) + self.distances(added, stops[2]) - self.distances(stops[0], removed) - self.distances(removed, stops[2]))
+					duration_change = float(self.durations(stops[0], added) + self.durations(added, stops[2]) - self.durations(stops[0], removed) - self.durations(removed, stops[2]))
+					duration = self.route_durations[day][index]
+					cost += distance_cost*distance_change + overtime_cost*float(self.get_overtimes(index, duration + duration_change) - self.get_overtimes(index, duration))
+				if cost < -min_improvement and (best is None or cost < best[0]):
+					best = (cost, other_vehicle_index, other_position)
+		if best is None:
+			return False
+		_, other_vehicle_index, other_position = best
+		other_route = self.days[day][other_vehicle_index]
+		neighbour = other_route[other_position]
+		self.set_route(day, vehicle_index, route[:position] + [neighbour] + route[position + 1:])
+		self.set_route(day, other_vehicle_index, other_route[:other_position] + [location_index] + other_route[other_position + 1:])
+		self.num_moves += 1
+		return True
+
+	def improve_day(self, day, deadline):
+		"""Improve the routes of a day with 2-opt, relocate and swap moves. Returns whether any improved"""
+		improved = False
+		for vehicle_index in range(self.num_vehicles):
+			improved = self.two_opt(day, vehicle_index, deadline) or improved
+		moved = True
+		while moved and time.perf_counter() < deadline:
+			moved = False
+			edges = self.get_day_table(day)
+			for location_index in list(edges['site_positions']):
+				if time.perf_counter() >= deadline:
+					break
+				for segment_length in range(1, max_segment_length + 1):
+					if self.relocate(day, location_index, segment_length, edges):
+						moved = True
+						edges = self.get_day_table(day)
+						break
+				else:
+					if self.swap(day, location_index, edges):
+						moved = True
+						edges = self.get_day_table(day)
+			improved = moved or improved
+		return improved
+
+	def get_routing_output(self, days = None):
+		return {'days': [{'vehicles': [{'route': list(route)} for route in routes]} for routes in (days if days is not None else self.days)]}
+
+	def get_inserted(self, day, location_index):
+		"""Routes of a day with a pickup site inserted where it adds the least distance, or a new route of an idle vehicle"""
+		routes = self.days[day]
+		best = None # (added distance, vehicle index, position)
+		for vehicle_index, route in enumerate(routes):
+			stops = np.asarray(route if len(route) > 0 else [self.home_locations[vehicle_index]]*2, dtype=np.int64)
+			added_distances = self.distances(stops[:-1], location_index) + self.distances(location_index, stops[1:]) - self.distances(stops[:-1], stops[1:])
+			position = int(np.argmin(added_distances))
+			if best is None or added_distances[position] < best[0]:
+				best = (float(added_distances[position]), vehicle_index, position)
+		_, vehicle_index, position = best
+		route = routes[vehicle_index] if len(routes[vehicle_index]) > 0 else [self.home_locations[vehicle_index]]*2
+		return [list(other) if index != vehicle_index else route[:position + 1] + [location_index] + route[position + 1:] for index, other in enumerate(routes)]
+
+	def improve_days(self, deadline, cost, batch_size):
+		"""
+		Try removing visits and moving them to the previous or next day, scored in batches with the plan evaluator, the
+		visits of the least full sites first. Applies the best improving move of a batch. Returns the new cost, or None
+		"""
+		visits = []
+		for day, routes in enumerate(self.days):
+			for vehicle_index, route in enumerate(routes):
+				for position, location_index in enumerate(route):
+					site_index = self.site_indexes[location_index]
+					if site_index >= 0:
+						visits.append((self.amounts[day][site_index]/self.capacities[site_index] if self.capacities[site_index] > 0 else 0.0, day, vehicle_index, position))
+		visits.sort()
+		moves = []
+		for _, day, vehicle_index, position in visits:
+			moves.append((day, vehicle_index, position, None))
+			for target_day in (day - 1, day + 1):
+				if 0 <= target_day < len(self.days):
+					moves.append((day, vehicle_index, position, target_day))
+		for batch_start in range(0, len(moves), batch_size):
+			if time.perf_counter() >= deadline:
+				return None
+			plans = []
+			for day, vehicle_index, position, target_day in moves[batch_start:batch_start + batch_size]:
+				route = self.days[day][vehicle_index]
+				days = [list(map(list, routes)) for routes in self.days]
+				days[day][vehicle_index] = route[:position] + route[position + 1:]
+				if target_day is not None:
+					location_index = route[position]
+					if any(location_index in target_route for target_route in self.days[target_day]):
+						days[target_day] = [list(target_route) for target_route in self.days[target_day]]
+					else:
+						days[target_day] = self.get_inserted(target_day, location_index)
+				plans.append(days)
+			costs = self.evaluator.evaluate([self.get_routing_output(days) for days in plans])['cost']
+			best = int(np.argmin(costs))
+			if costs[best] < cost - min_improvement:
+				for day, routes in enumerate(plans[best]):
+					for vehicle_index, route in enumerate(routes):
+						if route != self.days[day][vehicle_index]:
+							self.set_route(day, vehicle_index, route)
+				self.update_amounts()
+				self.num_moves += 1
+				return float(costs[best])
+		return None
+
+	def improve(self, routing_output, time_budget = 1.0, batch_size = 32):
+		"""
+		Improve routing output within time_budget seconds. Returns the improved routing output, or the given one if it
+		is at least as good. self.stats has the costs before and after, the number of moves and the time taken
+		"""
+		start_time = time.perf_counter()
+		deadline = start_time + time_budget
+		self.days = [[list(vehicle['route']) for vehicle in day['vehicles']] + [[] for _ in range(self.num_vehicles - len(day['vehicles']))] for day in routing_output['days']]
+		self.route_distances = [[0.0]*self.num_vehicles for _ in self.days]
+		self.route_durations = [[0.0]*self.num_vehicles for _ in self.days]
+		for day, routes in enumerate(self.days):
+			for vehicle_index, route in enumerate(routes):
+				self.route_distances[day][vehicle_index], self.route_durations[day][vehicle_index] = self.get_route_stats(vehicle_index, route)
+		self.update_amounts()
+		self.num_moves = 0
+		initial_cost = float(self.evaluator.evaluate([routing_output])['cost'][0]) if len(self.days) > 0 else 0.0
+		cost = initial_cost
+
+		improved = True
+		while improved and time.perf_counter() < deadline:
+			improved = False
+			for day in range(len(self.days)):
+				if time.perf_counter() >= deadline:
+					break
+				improved = self.improve_day(day, deadline) or improved
+			if improved:
+				cost = float(self.evaluator.evaluate([self.get_routing_output()])['cost'][0])
+			new_cost = self.improve_days(deadline, cost, batch_size)
+			if new_cost is not None:
+				cost = new_cost
+				improved = True
+
+		improved_output = self.get_routing_output()
+		cost = float(self.evaluator.evaluate([improved_output])['cost'][0]) if len(self.days) > 0 else 0.0
+		if not cost < initial_cost:
+			improved_output, cost = {'days': [{'vehicles': [{'route': list(vehicle['route'])} for vehicle in day['vehicles']]} for day in routing_output['days']]}, initial_cost
+		self.stats = {'initial_cost': initial_cost, 'cost': cost, 'num_moves': self.num_moves, 'time': time.perf_counter() - start_time}
+		return improved_output
+
+
+def improve_routing_output(routing_input, routing_output, time_budget = 1.0, num_neighbours = 10):
+	"""Improve routing output from any router with local search within time_budget seconds. See LocalSearch"""
+	return LocalSearch(routing_input, num_neighbours).improve(routing_output, time_budget)
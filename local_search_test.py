@@ -0,0 +1,62 @@
+import os
+import random
+import sys
+import numpy as np
+import waste_pickup_sim
+import plan_evaluator
+from heuristic_router import heuristic_router
+from local_search import improve_routing_output
+from routing_optimizer_worker import RoutingOptimizerWorker
+
+# Checks of local search against the plans it improves: a plan of the heuristic router and one of the C++ routing
+# optimizer for one routing run of the test scenario. The routing optimizer executable can be given as an argument,
+# default 'routing_optimizer'.
+# Run from the repository root: python local_search_test.py [routing optimizer executable]
+
+sim_config = {
+	'sim_name': 'Hämeenlinna and nearby regions',
+	'sim_runtime_days': 14,
+	'pickup_sites_filename': 'geo_data/sim_test_sites.geojson',
+	'depots_filename': 'geo_data/sim_test_terminals.geojson',
+	'terminals_filename': 'geo_data/sim_test_terminals.geojson',
+	'vehicle_template': {
+		'load_capacity': 18,
+		'max_route_duration': 8*60 + 15,
+		'pickup_duration': 15
+	},
+	'depots': [
+		{
+			'num_vehicles': 1
+		},
+		{
+			'num_vehicles': 1
+		}
+	],
+	'matrix_backend': 'haversine',
+	'routing_optimizer_path': sys.argv[1] if len(sys.argv) > 1 else 'routing_optimizer',
+	'routing_optimizer_generations': 2000,
+	'routing_optimizer_finetune_generations': 1000,
+	'log_quiet': True,
+	'log_events_to_file': False
+}
+
+def test_local_search(routing_input, routing_outputs):
+	"""Local search never returns a plan that the plan evaluator finds worse"""
+	for routing_output in routing_outputs:
+		improved = improve_routing_output(routing_input, routing_output, time_budget=1.0)
+		costs = plan_evaluator.evaluate_plans(routing_input, [routing_output, improved])['cost']
+		assert costs[1] <= costs[0], f"Local search made the cost worse: {costs[0]} -> {costs[1]}"
+		print(f"Local search: cost {costs[0]:.2f} -> {costs[1]:.2f}")
+
+random.seed(42)
+np.random.seed(42)
+os.makedirs('temp', exist_ok=True)
+waste_pickup_sim.preprocess_sim_config(sim_config, 'temp/local_search_test_config.json')
+sim = waste_pickup_sim.WastePickupSimulation(sim_config)
+routing_input = sim.get_routing_input(sim.pickup_site_accumulator.levels)
+worker = RoutingOptimizerWorker(sim_config['routing_optimizer_path'], None, sim_config['routing_optimizer_generations'], sim_config['routing_optimizer_finetune_generations'])
+try:
+	genetic_routing_output = worker.route(routing_input)
+finally:
+	worker.close()
+test_local_search(routing_input, [heuristic_router(routing_input), genetic_routing_output])
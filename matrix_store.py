@@ -0,0 +1,154 @@
+import hashlib
+import os
+import glob
+import numpy as np
+from sparse_travel_matrix import SparseTravelMatrixes, build_sparse_travel_matrixes
+
+def location_set_key(lonlats):
+	"""Get a key for a list of locations, a hash of the coordinates rounded to 1e-6 deg"""
+	rounded_lonlats = np.round(np.asarray(lonlats, dtype=np.float64).reshape(-1, 2), 6) + 0.0 # + 0.0 turns -0.0 to 0.0
+	return hashlib.sha1(rounded_lonlats.tobytes()).hexdigest()[:20]
+
+def location_keys(lonlats):
+	"""Get a hashable key for each location"""
+	rounded_lonlats = np.round(np.asarray(lonlats, dtype=np.float64).reshape(-1, 2), 6) + 0.0
+	return list(map(tuple, rounded_lonlats.tolist()))
+
+
+# A store of distance and duration matrixes as float32 .npy files, one set of files per list of locations, keyed by a
+# hash of the location coordinates. The matrixes are memory-mapped when loaded. A new list of locations reuses the
+# matrix elements between any locations it shares with the most similar stored list, and only the rows and columns of
+# the other locations are fetched.
+class MatrixStore():
+
+	def __init__(self, directory = 'temp/matrix_store'):
+		self.directory = directory
+
+	def get_filenames(self, key):
+		return {
+			'lonlats': os.path.join(self.directory, f"{key}_lonlats.npy"),
+			'distance_matrix': os.path.join(self.directory, f"{key}_distance.npy"),
+			'duration_matrix': os.path.join(self.directory, f"{key}_duration.npy")
+		}
+
+	def contains(self, lonlats):
+		# The lonlats file is written last, so it marks a complete set of files
+		return os.path.exists(self.get_filenames(location_set_key(lonlats))['lonlats'])
+
+	def load(self, key):
+		"""Load memory-mapped matrixes of a key. Returns a dict with 'lonlats', 'distance_matrix', 'duration_matrix' and 'key'"""
+		filenames = self.get_filenames(key)
+		return {
+			'lonlats': np.load(filenames['lonlats']),
+			'distance_matrix': np.load(filenames['distance_matrix'], mmap_mode='r'),
+			'duration_matrix': np.load(filenames['duration_matrix'], mmap_mode='r'),
+			'key': key
+		}
+
+	def put(self, lonlats, distance_matrix, duration_matrix):
+		"""Store complete matrixes for a list of locations. Returns the memory-mapped stored matrixes"""
+		key = location_set_key(lonlats)
+		distance_file, duration_file = self.create_matrix_files(key, len(lonlats))
+		distance_file[:] = distance_matrix
+		duration_file[:] = duration_matrix
+		return self.finish_matrix_files(key, lonlats, distance_file, duration_file)
+
+	def create_matrix_files(self, key, num_locations):
+		os.makedirs(self.directory, exist_ok=True)
+		filenames = self.get_filenames(key)
+		distance_file = np.lib.format.open_memmap(filenames['distance_matrix'], mode='w+', dtype=np.float32, shape=(num_locations, num_locations))
+		duration_file = np.lib.format.open_memmap(filenames['duration_matrix'], mode='w+', dtype=np.float32, shape=(num_locations, num_locations))
+		return distance_file, duration_file
+
+	def finish_matrix_files(self, key, lonlats, distance_file, duration_file):
+		# Writing the lonlats file last marks the set of files complete
+		distance_file.flush()
+		duration_file.flush()
+		np.save(self.get_filenames(key)['lonlats'], np.asarray(lonlats, dtype=np.float64).reshape(-1, 2))
+		return self.load(key)
+
+	def find_most_similar(self, lonlats):
+		"""Find the stored list of locations that shares the most locations with lonlats. Returns (key, shared location count)"""
+		wanted_keys = set(location_keys(lonlats))
+		best_key = None
+		best_num_shared = 0
+		for lonlats_filename in glob.glob(os.path.join(self.directory, '*_lonlats.npy')):
+			num_shared = len(wanted_keys.intersection(location_keys(np.load(lonlats_filename))))
+			if num_shared > best_num_shared:
+				best_key = os.path.basename(lonlats_filename)[:-len('_lonlats.npy')]
+				best_num_shared = num_shared
+		return best_key, best_num_shared
+
+	def get(self, lonlats, fetch, max_block_elements = 1 << 24):
+		"""
+		Get memory-mapped distance and duration matrixes for a list of locations, fetching only what is not stored.
+		fetch(coords, source_indexes, destination_indexes) must return a dict with 'distance_matrix' and 'duration_matrix'
+		arrays for the given rows and columns. Fetching is done in blocks of rows of at most max_block_elements elements.
+		Returns a dict with 'lonlats', 'distance_matrix', 'duration_matrix' and 'key'
+		"""
+		key = location_set_key(lonlats)
+		if self.contains(lonlats):
+			return self.load(key)
+
+		coords = np.asarray(lonlats, dtype=np.float64).reshape(-1, 2).tolist()
+		num_locations = len(coords)
+		distance_file, duration_file = self.create_matrix_files(key, num_locations)
+		block_size = max(1, max_block_elements // max(num_locations, 1))
+
+		# Copy the elements between the locations shared with the most similar stored list of locations
+		similar_key, num_shared = self.find_most_similar(lonlats)
+		is_known = np.zeros(num_locations, dtype=bool)
+		if similar_key is not None:
+			similar = self.load(similar_key)
+			similar_indexes_by_location_key = {}
+			for index, location_key in enumerate(location_keys(similar['lonlats'])):
+				similar_indexes_by_location_key.setdefault(location_key, index)
+			similar_indexes = np.array([similar_indexes_by_location_key.get(location_key, -1) for location_key in location_keys(lonlats)], dtype=np.int64)
+			is_known = similar_indexes >= 0
+			known_indexes = np.nonzero(is_known)[0]
+			for block_start in range(0, len(known_indexes), block_size):
+				rows = known_indexes[block_start:block_start + block_size]
+				similar_rows = similar_indexes[rows]
+				distance_file[rows[:, None], known_indexes[None, :]] = similar['distance_matrix'][similar_rows][:, similar_indexes[known_indexes]]
+				duration_file[rows[:, None], known_indexes[None, :]] = similar['duration_matrix'][similar_rows][:, similar_indexes[known_indexes]]
+			del similar
+
+		# Fetch rows and columns of the other locations: new rows against all columns, and known rows against new columns
+		new_indexes = np.nonzero(~is_known)[0]
+		known_indexes = np.nonzero(is_known)[0]
+		all_indexes = np.arange(num_locations)
+		for rows, columns in ((new_indexes, all_indexes), (known_indexes, new_indexes)):
+			if len(rows) == 0 or len(columns) == 0:
+				continue
+			for block_start in range(0, len(rows), block_size):
+				block_rows = rows[block_start:block_start + block_size]
+				fetched = fetch(coords, block_rows, columns)
+				distance_file[block_rows[:, None], columns[None, :]] = fetched['distance_matrix']
+				duration_file[block_rows[:, None], columns[None, :]] = fetched['duration_matrix']
+				# Write the block to disk so that its memory can be reclaimed
+				distance_file.flush()
+				duration_file.flush()
+
+		return self.finish_matrix_files(key, lonlats, distance_file, duration_file)
+
+	def get_sparse_filename(self, key, k):
+		return os.path.join(self.directory, f"{key}_sparse_k{k}.npz")
+
+	def load_sparse(self, key, k):
+		"""Load stored sparse travel matrixes of a key and k"""
+		return SparseTravelMatrixes.load(self.get_sparse_filename(key, k))
+
+	def get_sparse(self, lonlats, fetch, k, dense_indexes = ()):
+		"""
+		Get sparse travel matrixes for a list of locations, with the k nearest neighbours of each location and the full rows
+		and columns of dense_indexes. See sparse_travel_matrix. The matrixes are stored in an .npz file of the key and k
+		"""
+		filename = self.get_sparse_filename(location_set_key(lonlats), k)
+		if os.path.exists(filename):
+			matrixes = SparseTravelMatrixes.load(filename)
+			if np.array_equal(matrixes.dense_indexes, np.asarray(dense_indexes, dtype=np.int64)):
+				return matrixes
+		matrixes = build_sparse_travel_matrixes(lonlats, fetch, k, dense_indexes)
+		os.makedirs(self.directory, exist_ok=True)
+		matrixes.save(filename)
+		return matrixes
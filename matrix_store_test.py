@@ -0,0 +1,32 @@
+import tempfile
+import numpy as np
+from haversine_matrix import HaversineMatrixBackend
+from matrix_store import MatrixStore
+
+# Checks of the matrix store against the matrixes of the haversine backend: a new list of locations, one that shares
+# most of its locations with a stored list and reuses its elements, and a stored list loaded again.
+# Run from the repository root: python matrix_store_test.py
+
+def test_matrix_store(rng, num_locations = 200, num_new_locations = 50):
+	"""Matrixes of the store, also those that reuse a similar stored list of locations, are those of the backend"""
+	backend = HaversineMatrixBackend()
+	lonlats = np.column_stack([rng.uniform(23.5, 25.5, num_locations), rng.uniform(60.5, 61.5, num_locations)])
+	new_lonlats = np.concatenate([lonlats[num_new_locations:], np.column_stack([rng.uniform(23.5, 25.5, num_new_locations), rng.uniform(60.5, 61.5, num_new_locations)])])
+	num_fetched = 0
+	def fetch(coords, source_indexes, destination_indexes):
+		nonlocal num_fetched
+		num_fetched += len(source_indexes)*len(destination_indexes)
+		return backend.get_distance_and_duration_matrix(coords, source_indexes, destination_indexes)
+	with tempfile.TemporaryDirectory() as directory:
+		store = MatrixStore(directory)
+		for location_lonlats, max_num_fetched in ((lonlats, num_locations**2), (new_lonlats, num_locations**2 - (num_locations - num_new_locations)**2), (lonlats, 0)):
+			num_fetched = 0
+			matrixes = store.get(location_lonlats, fetch, max_block_elements=1000)
+			expected = backend.get_distance_and_duration_matrix(location_lonlats)
+			for name in ('distance_matrix', 'duration_matrix'):
+				assert np.array_equal(np.asarray(matrixes[name]), expected[name]), f"Matrix store {name} differs from the backend"
+			assert num_fetched <= max_num_fetched, f"Matrix store fetched {num_fetched} elements, expected at most {max_num_fetched}"
+			del matrixes
+	print("Matrix store matches the backend")
+
+test_matrix_store(np.random.default_rng(42))
@@ -0,0 +1,182 @@
+import csv
+import itertools
+import json
+import math
+import os
+import time
+import numpy as np
+
+import ensemble
+
+# Parameter sweep over fleet configurations of a preprocessed sim config, such as the number of vehicles per depot,
+# their load capacity and max route duration, with successive halving. All configurations are first simulated for a
+# few days, and only the best 1/reduction_factor of them by the objective continue to a horizon reduction_factor times
+# longer, until the survivors run the full 'sim_runtime_days'. Each rung runs in a pool of worker processes that share
+# the matrixes of the preprocessed config, as in ensemble.py, and each configuration runs with the same seeds, so that
+# they differ only by their parameters. The results are a table of the cost components of each configuration at the
+# longest horizon it reached. Configurations tied with the cutoff of a rung, within a tolerance or the confidence
+# intervals of the objective over the seeds, all continue, so that a rung too short to tell them apart does not drop
+# configurations by their order.
+
+# Statistics of a run that are averaged over the seeds of a configuration
+result_statistic_names = ('cost', 'pickup_site_overflow_days', 'odometer', 'vehicle_run_time', 'overtime', 'num_warnings')
+
+
+def get_design(parameters, design = 'grid', num_points = None, seed = 0):
+	"""
+	Get the configurations of a design, as dicts of parameter values. parameters: {name: [values]}. design: 'grid' for
+	all combinations, or 'random' for num_points distinct random combinations
+	"""
+	names = list(parameters)
+	if design == 'grid':
+		return [dict(zip(names, values)) for values in itertools.product(*(parameters[name] for name in names))]
+	if design != 'random':
+		raise ValueError(f"Unknown design {design!r}, expected 'grid' or 'random'")
+	num_combinations = math.prod(len(parameters[name]) for name in names)
+	num_points = min(num_points if num_points is not None else num_combinations, num_combinations)
+	rng = np.random.default_rng(seed)
+	value_indexes = set()
+	points = []
+	while len(points) < num_points:
+		indexes = tuple(int(rng.integers(len(parameters[name]))) for name in names)
+		if indexes not in value_indexes:
+			value_indexes.add(indexes)
+			points.append({name: parameters[name][index] for name, index in zip(names, indexes)})
+	return points
+
+def get_overrides(sim_config, point):
+	"""
+	Config overrides of a configuration. Parameter 'num_vehicles' is the number of vehicles of each depot, or a list of
+	them by depot. Parameters that are keys of 'vehicle_template', such as 'load_capacity' and 'max_route_duration',
+	override those. Other parameters override config keys
+	"""
+	overrides = {}
+	vehicle_template = dict(sim_config['vehicle_template'])
+	for name, value in point.items():
+		if name == 'num_vehicles':
+			num_vehicles = value if isinstance(value, (list, tuple)) else [value]*len(sim_config['depots'])
+			if len(num_vehicles) != len(sim_config['depots']):
+				raise ValueError(f"Parameter 'num_vehicles' has {len(num_vehicles)} values, for {len(sim_config['depots'])} depots")
+			overrides['depots'] = [{**depot, 'num_vehicles': int(n)} for depot, n in zip(sim_config['depots'], num_vehicles)]
+		elif name in vehicle_template:
+			vehicle_template[name] = value
+			overrides['vehicle_template'] = vehicle_template
+		else:
+			overrides[name] = value
+	return overrides
+
+def get_horizons(sim_runtime_days, min_days, reduction_factor):
+	"""Simulated days of each rung, growing by reduction_factor up to sim_runtime_days"""
+	horizons = []
+	days = max(min(min_days, sim_runtime_days), 1)
+	while days < sim_runtime_days:
+		horizons.append(days)
+		days = min(days*reduction_factor, sim_runtime_days)
+	return horizons + [sim_runtime_days]
+
+def get_survivors(rows, survivors, reduction_factor, tolerance = 1e-6):
+	"""
+	Configurations of a rung that continue to the next: the best 1/reduction_factor by the objective, and those tied
+	with the worst of them, that is within tolerance of its objective or with overlapping confidence intervals.
+	rows: {configuration index: result row}. Returns the continuing configuration indexes, best first
+	"""
+	ranked = sorted(survivors, key=lambda point_index: rows[point_index]['objective'])
+	cutoff = rows[ranked[max(1, math.ceil(len(survivors)/reduction_factor)) - 1]]
+	cutoff_high = max(cutoff['objective'] + tolerance, cutoff['objective_ci_high'] if not math.isnan(cutoff['objective_ci_high']) else -math.inf)
+	return [point_index for point_index in ranked if rows[point_index]['objective'] <= cutoff_high or rows[point_index]['objective_ci_low'] <= cutoff_high]
+
+def run_sweep(sim_config, parameters, design = 'grid', num_points = None, seeds = (0,), min_days = 2, reduction_factor = 3, objective = None, num_workers = None, log_dir = 'log/sweep', tolerance = 1e-6, confidence = 0.95):
+	"""
+	Sweep the parameters of a preprocessed sim config with successive halving.
+	parameters: {name: [values]}, see get_overrides, for example {'num_vehicles': [1, 2, 3], 'load_capacity': [12, 18]}
+	design, num_points: see get_design
+	seeds: seeds of the runs of each configuration, whose statistics are averaged
+	min_days: simulated days of the first rung
+	reduction_factor: 1/reduction_factor of the configurations continue from each rung to the next, which simulates
+		reduction_factor times as many days
+	objective: function of a result row to minimize, default its cost. For example, a fixed cost per vehicle day can
+		be added to compare fleet sizes: lambda row: row['cost'] + 300*row['total_num_vehicles']*row['days']
+	tolerance, confidence: configurations whose objective is within tolerance of the cutoff of a rung, or whose
+		confidence interval of the objective over the seeds overlaps that of the cutoff, continue with it. A rung
+		where all objectives are within tolerance drops none, with a warning that min_days is too short
+	Returns {'rungs': [{'days', 'results'}], 'results': [a result row of each configuration]}. The rows are sorted
+	best first: those that reached the full horizon by objective, then the others by the rung where they were
+	dropped. A row has the parameters, 'total_num_vehicles', 'days' simulated, 'rung', 'objective' and the means of
+	the statistics over the seeds, and 'objective_ci_low' and 'objective_ci_high' of the objective of each seed. A
+	rung has 'tied' if its objectives could not tell the configurations apart. Also saved to sweep_record.json and sweep_results.csv in log_dir.
+	"""
+	if objective is None:
+		objective = lambda row: row['cost']
+	start_time = time.time()
+	if len(seeds) == 0:
+		raise ValueError("No seeds to run the configurations with")
+	points = get_design(parameters, design, num_points, seeds[0])
+	if len(points) == 0:
+		raise ValueError(f"The {design} design of parameters {parameters} has no configurations")
+	overrides = [get_overrides(sim_config, point) for point in points]
+	horizons = get_horizons(sim_config['sim_runtime_days'], min_days, reduction_factor)
+
+	rows = {} # Result row of each configuration at the longest horizon it reached
+	rungs = []
+	survivors = list(range(len(points)))
+	for rung, days in enumerate(horizons):
+		if len(survivors) == 1 and days < horizons[-1]:
+			continue # Nothing to compare, skip to the full horizon
+		jobs = [(
+			job_index,
+			seed,
+			os.path.join(log_dir, f"rung_{rung:02d}", f"configuration_{point_index:04d}_seed_{seed}"),
+			{**overrides[point_index], 'sim_runtime_days': days}
+		) for job_index, (point_index, seed) in enumerate(itertools.product(survivors, seeds))]
+		runs = ensemble.run_in_worker_pool(sim_config, jobs, num_workers if num_workers is not None else min(len(jobs), os.cpu_count() or 1))
+		for index, point_index in enumerate(survivors):
+			point_runs = runs[index*len(seeds):(index + 1)*len(seeds)]
+			depots = overrides[point_index].get('depots', sim_config['depots'])
+			row = {
+				'configuration_index': point_index,
+				**points[point_index],
+				'total_num_vehicles': sum(depot['num_vehicles'] for depot in depots),
+				'days': days,
+				'rung': rung,
+				**{name: float(np.mean([run[name] for run in point_runs])) for name in result_statistic_names}
+			}
+			row['objective'] = float(objective(row))
+			seed_objectives = ensemble.summarize([objective({**row, **{name: run[name] for name in result_statistic_names}}) for run in point_runs], confidence)
+			row['objective_ci_low'] = seed_objectives['ci_low']
+			row['objective_ci_high'] = seed_objectives['ci_high']
+			rows[point_index] = row
+		objectives = [rows[point_index]['objective'] for point_index in survivors]
+		tied = len(survivors) > 1 and max(objectives) - min(objectives) <= tolerance
+		rungs.append({'days': days, 'tied': tied, 'results': [rows[point_index] for point_index in survivors]})
+		if tied and days < horizons[-1]:
+			print(f"WARNING: all {len(survivors)} configurations have objective {objectives[0]:.4g} after {days} days, none dropped. Consider a longer min_days")
+		if days < horizons[-1]:
+			survivors = get_survivors(rows, survivors, reduction_factor, tolerance)
+
+	results = sorted(rows.values(), key=lambda row: (-row['rung'], row['objective']))
+	sweep_record = {
+		'parameters': parameters,
+		'design': design,
+		'seeds': list(seeds),
+		'min_days': min_days,
+		'reduction_factor': reduction_factor,
+		'tolerance': tolerance,
+		'confidence': confidence,
+		'wall_time': time.time() - start_time,
+		'rungs': rungs,
+		'results': results
+	}
+	os.makedirs(log_dir, exist_ok=True)
+	with open(os.path.join(log_dir, 'sweep_record.json'), 'w') as f:
+		json.dump(sweep_record, f, indent=4)
+	write_results_csv(results, os.path.join(log_dir, 'sweep_results.csv'))
+	return sweep_record
+
+def write_results_csv(results, filename):
+	"""Write result rows to a CSV file, with list values such as vehicles by depot as JSON"""
+	fieldnames = list(dict.fromkeys(name for row in results for name in row))
+	with open(filename, 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=fieldnames)
+		writer.writeheader()
+		for row in results:
+			writer.writerow({name: json.dumps(value) if isinstance(value, (list, tuple, dict)) else value for name, value in row.items()})
@@ -0,0 +1,81 @@
+import math
+import os
+import tempfile
+import waste_pickup_sim
+import parameter_sweep
+
+# Checks of successive halving in fleet sizing sweeps: the configurations that continue from a rung, also when they
+# are tied with the cutoff, and a sweep of the test scenario whose first rung cannot tell the configurations apart.
+# Run from the repository root: python parameter_sweep_test.py
+
+sim_config = {
+	'sim_name': 'Hämeenlinna and nearby regions',
+	'sim_runtime_days': 9,
+	'pickup_sites_filename': 'geo_data/sim_test_sites.geojson',
+	'depots_filename': 'geo_data/sim_test_terminals.geojson',
+	'terminals_filename': 'geo_data/sim_test_terminals.geojson',
+	'vehicle_template': {
+		'load_capacity': 18,
+		'max_route_duration': 8*60 + 15,
+		'pickup_duration': 15
+	},
+	'depots': [
+		{
+			'num_vehicles': 1
+		},
+		{
+			'num_vehicles': 1
+		}
+	],
+	'matrix_backend': 'haversine',
+	'router': 'heuristic',
+	'log_quiet': True,
+	'log_events_to_file': False
+}
+
+def get_rows(objectives, ci_half_widths = None):
+	"""Result rows of configurations with objectives, and confidence intervals if given"""
+	ci_half_widths = ci_half_widths if ci_half_widths is not None else [math.nan]*len(objectives)
+	return {index: {'objective': objective, 'objective_ci_low': objective - half_width, 'objective_ci_high': objective + half_width} for index, (objective, half_width) in enumerate(zip(objectives, ci_half_widths))}
+
+def test_get_survivors():
+	"""The best 1/reduction_factor continue, with all configurations tied with the worst of them"""
+	def survivors(objectives, ci_half_widths = None):
+		return parameter_sweep.get_survivors(get_rows(objectives, ci_half_widths), list(range(len(objectives))), 3)
+	assert survivors([5, 3, 1, 4, 2, 6]) == [2, 4]
+	assert survivors([0.0]*6) == list(range(6)), "Configurations tied with the cutoff were dropped"
+	assert survivors([3, 1, 1, 2, 1, 5]) == [1, 2, 4]
+	assert survivors([1, 2 + 1e-9, 2, 3, 4, 5]) == [0, 2, 1], "A configuration within tolerance of the cutoff was dropped"
+	assert survivors([1, 2, 3, 4, 5, 6], [0.1, 0.1, 0.95, 0.1, 0.1, 0.1]) == [0, 1, 2], "A configuration whose confidence interval overlaps that of the cutoff was dropped"
+	assert survivors([1, 2, 3, 4, 5, 6], [0.1, 0.6, 0.6, 0.1, 0.1, 0.1]) == [0, 1, 2]
+	assert survivors([1, 2, 3, 4, 5, 6], [0.1]*6) == [0, 1]
+	print("Successive halving keeps the configurations tied with the cutoff")
+
+def test_empty_design(sim_config):
+	"""A sweep without configurations or seeds is rejected"""
+	for parameters, seeds in (({'num_vehicles': []}, (0,)), ({'num_vehicles': [1, 2]}, ())):
+		try:
+			parameter_sweep.run_sweep(sim_config, parameters, seeds=seeds)
+		except ValueError as error:
+			print(f"Rejected: {error}")
+		else:
+			assert False, f"A sweep of parameters {parameters} with seeds {seeds} was not rejected"
+
+def test_tied_rung(sim_config):
+	"""No configuration is dropped after a first day without overflows, and the rung is marked tied"""
+	with tempfile.TemporaryDirectory() as log_dir:
+		sweep_record = parameter_sweep.run_sweep(sim_config, {'num_vehicles': [1, 2], 'load_capacity': [12, 18, 24]}, min_days=1, log_dir=log_dir)
+	rungs = sweep_record['rungs']
+	assert [rung['days'] for rung in rungs] == [1, 3, 9]
+	assert rungs[0]['tied'] and len(rungs[1]['results']) == 6, f"The first rung of objectives {[row['objective'] for row in rungs[0]['results']]} was halved to {len(rungs[1]['results'])}"
+	for rung, next_rung in zip(rungs, rungs[1:]):
+		cutoff = sorted(row['objective'] for row in rung['results'])[max(1, math.ceil(len(rung['results'])/3)) - 1]
+		assert sorted(row['configuration_index'] for row in next_rung['results']) == sorted(row['configuration_index'] for row in rung['results'] if row['objective'] <= cutoff + 1e-6)
+	print(f"Sweep configurations by rung: {[len(rung['results']) for rung in rungs]}, tied {[rung['tied'] for rung in rungs]}")
+
+if __name__ == '__main__':
+	os.makedirs('temp', exist_ok=True)
+	waste_pickup_sim.preprocess_sim_config(sim_config, 'temp/parameter_sweep_test_config.json')
+	test_get_survivors()
+	test_empty_design(sim_config)
+	test_tied_rung(sim_config)
@@ -0,0 +1,216 @@
+import json
+import numpy as np
+from sparse_travel_matrix import as_travel_matrix
+
+# Evaluation of multi-day routing plans with the simulation model of LogisticsSimulation::costFunction in
+# routing_optimizer.cpp, vectorised over a batch of plans with NumPy. The C++ float32 state and the order of
+# simultaneous events are mirrored, so the cost components are the same as those of the C++ model.
+#
+# Travel times don't depend on pickup site levels, so the evaluation is done in two passes. The first pass goes
+# through the days and route steps, for all plans and vehicles at once, accumulating odometers and overtime and
+# recording the times of pickups and dumps. The second pass replays the pickups, dumps and daily level growths of each
+# plan in the order of the simulation, for all plans at once by the rank of the event in its plan.
+
+pickup_duration = np.float32(15) # Minutes, as in routing_optimizer.cpp
+
+# Cost rates, as in costFunctionFromComponents of routing_optimizer.cpp
+distance_cost = 50.0/100000.0*2 # Eur / m. Fuel price: 2 eur / L, fuel consumption: 50 L / (100 km)
+overflow_day_cost = 50.0 # Eur / overload day / pickup site
+overtime_cost = 50.0/60 # Eur / min of overtime work
+
+# Location types, as in routing_optimizer.cpp
+LOCATION_TYPE_DEPOT = 0
+LOCATION_TYPE_PICKUP_SITE = 1
+LOCATION_TYPE_TERMINAL = 2
+
+# Event types of the second pass
+EVENT_PICKUP = 0
+EVENT_DUMP = 1
+EVENT_GROWTH = 2
+
+def cost_function_from_components(total_odometer, total_num_pickup_site_overflow_days, total_overtime):
+	"""Monetary cost as in costFunctionFromComponents of routing_optimizer.cpp"""
+	return total_odometer*distance_cost + total_num_pickup_site_overflow_days*overflow_day_cost + total_overtime*overtime_cost
+
+def get_pickup_durations(vehicles):
+	"""Pickup duration of each vehicle of routing input in minutes, as configured in the simulation, default that of routing_optimizer.cpp"""
+	return np.array([vehicle.get('pickup_duration', pickup_duration) for vehicle in vehicles], dtype=np.float64)
+
+def plans_to_array(plans, num_days = None):
+	"""
+	Convert routing outputs {'days': [{'vehicles': [{'route': [...]}, ...]}, ...]} to an int32 array of location indexes
+	of shape (plans, days, vehicles, route steps), padded with -1. Plans with fewer than num_days days get empty routes
+	"""
+	if num_days is None:
+		num_days = max(len(plan['days']) for plan in plans)
+	num_vehicles = max((len(day['vehicles']) for plan in plans for day in plan['days']), default=0)
+	max_route_length = max((len(vehicle['route']) for plan in plans for day in plan['days'] for vehicle in day['vehicles']), default=0)
+	plan_array = np.full((len(plans), num_days, num_vehicles, max_route_length), -1, dtype=np.int32)
+	for plan_index, plan in enumerate(plans):
+		for day_index, day in enumerate(plan['days'][:num_days]):
+			for vehicle_index, vehicle in enumerate(day['vehicles']):
+				plan_array[plan_index, day_index, vehicle_index, :len(vehicle['route'])] = vehicle['route']
+	return plan_array
+
+
+class PlanEvaluator():
+
+	def __init__(self, routing_input):
+		"""routing_input is as in WastePickupSimulation.daily_routing or temp/routing_input.json"""
+		pickup_sites = routing_input['pickup_sites']
+		self.capacities = np.array([pickup_site['capacity'] for pickup_site in pickup_sites], dtype=np.float32)
+		self.initial_levels = np.array([pickup_site['level'] for pickup_site in pickup_sites], dtype=np.float32)
+		growth_rates = np.array([pickup_site['growth_rate'] for pickup_site in pickup_sites], dtype=np.float32)
+		self.daily_growths = growth_rates*np.float32(24)*np.float32(60)
+		self.distance_matrix = as_travel_matrix(routing_input['distance_matrix'], dtype=np.float32)
+		self.duration_matrix = as_travel_matrix(routing_input['duration_matrix'], dtype=np.float32)
+		vehicles = routing_input['vehicles']
+		self.load_capacities = np.array([vehicle['load_capacity'] for vehicle in vehicles], dtype=np.float32)
+		self.max_route_durations = np.array([vehicle['max_route_duration'] for vehicle in vehicles], dtype=np.int32).astype(np.float64)
+		depot_locations = np.array([depot['location_index'] for depot in routing_input['depots']], dtype=np.int64)
+		self.home_locations = depot_locations[np.array([vehicle['home_depot_index'] for vehicle in vehicles], dtype=np.int64)]
+
+		# Location types and pickup site indexes by location index, later types overriding earlier as in routing_optimizer.cpp
+		num_locations = len(self.duration_matrix)
+		self.location_types = np.full(num_locations, -1, dtype=np.int8)
+		self.location_pickup_site_indexes = np.full(num_locations, -1, dtype=np.int64)
+		for location_type, locations in (
+			(LOCATION_TYPE_PICKUP_SITE, routing_input['pickup_sites']),
+			(LOCATION_TYPE_DEPOT, routing_input['depots']),
+			(LOCATION_TYPE_TERMINAL, routing_input['terminals'])
+		):
+			location_indexes = np.array([location['location_index'] for location in locations], dtype=np.int64)
+			self.location_types[location_indexes] = location_type
+			if location_type == LOCATION_TYPE_PICKUP_SITE:
+				self.location_pickup_site_indexes[location_indexes] = np.arange(len(location_indexes))
+
+	def evaluate(self, plans):
+		"""
+		Evaluate plans, given as a list of routing outputs or as an array from plans_to_array. Returns a dict of arrays
+		with one value per plan: 'cost', 'odometer' (m), 'overtime' (min), 'num_overload_days', and per plan and vehicle:
+		'vehicle_odometers', 'vehicle_overtimes'
+		"""
+		plan_array = plans if isinstance(plans, np.ndarray) else plans_to_array(plans)
+		num_plans, num_days, num_vehicles, max_route_length = plan_array.shape
+		vehicle_indexes = np.broadcast_to(np.arange(num_vehicles), (num_plans, num_vehicles))
+		plan_indexes = np.broadcast_to(np.arange(num_plans)[:, None], (num_plans, num_vehicles))
+
+		# First pass: travel
+		locations = np.broadcast_to(self.home_locations, (num_plans, num_vehicles)).copy()
+		odometers = np.zeros((num_plans, num_vehicles), dtype=np.float32)
+		overtimes = np.zeros((num_plans, num_vehicles), dtype=np.float32)
+		route_end_times = np.full((num_plans, num_vehicles), -np.inf)
+		events = [] # Arrays of (event type, plan index, vehicle index, pickup site index, time, time scheduled)
+		for day in range(num_days):
+			day_start_time = float(day*24*60)
+			routes = plan_array[:, day]
+			# A route is not started if the previous one is still being driven
+			started = (routes[:, :, 0] >= 0) & (route_end_times < day_start_time) if max_route_length > 0 else np.zeros((num_plans, num_vehicles), dtype=bool)
+			times = np.full((num_plans, num_vehicles), day_start_time)
+			for route_step in range(max_route_length):
+				destinations = routes[:, :, route_step]
+				moving = started & (destinations >= 0) & (destinations != locations)
+				if not np.any(moving):
+					continue
+				sources = np.where(moving, locations, 0)
+				destinations = np.where(moving, destinations, 0)
+				departure_times = times
+				times = np.where(moving, times + self.duration_matrix[sources, destinations], times)
+				odometers = np.where(moving, odometers + self.distance_matrix[sources, destinations], odometers)
+				locations = np.where(moving, destinations, locations)
+				arrival_types = np.where(moving, self.location_types[destinations], -1)
+				for event_type, location_type in ((EVENT_PICKUP, LOCATION_TYPE_PICKUP_SITE), (EVENT_DUMP, LOCATION_TYPE_DEPOT)):
+					arrived = arrival_types == location_type
+					if np.any(arrived):
+						events.append((
+							np.full(np.count_nonzero(arrived), event_type),
+							plan_indexes[arrived],
+							vehicle_indexes[arrived],
+							self.location_pickup_site_indexes[destinations[arrived]],
+							times[arrived],
+							departure_times[arrived]
+						))
+				# Pickup work
+				times = np.where(arrival_types == LOCATION_TYPE_PICKUP_SITE, times + pickup_duration, times)
+			shift_durations = times - day_start_time
+			overtime_increments = np.where(started & (shift_durations > self.max_route_durations), shift_durations - self.max_route_durations, 0)
+			overtimes = (overtimes.astype(np.float64) + overtime_increments).astype(np.float32)
+			route_end_times = np.where(started, times, route_end_times)
+
+		# Daily growths, scheduled at the start of each day after the vehicle route starts of the day
+		for day in range(num_days):
+			events.append((
+				np.full(num_plans, EVENT_GROWTH),
+				np.arange(num_plans),
+				np.full(num_plans, num_vehicles),
+				np.full(num_plans, -1),
+				np.full(num_plans, float((day + 1)*24*60)),
+				np.full(num_plans, float(day*24*60))
+			))
+
+		# Second pass: levels, in the order of event time and then the time when the event was scheduled
+		event_types, event_plan_indexes, event_vehicle_indexes, event_pickup_site_indexes, event_times, event_scheduled_times = (np.concatenate(column) for column in zip(*events))
+		order = np.lexsort((event_vehicle_indexes, event_scheduled_times, event_times, event_plan_indexes))
+		event_types, event_plan_indexes, event_vehicle_indexes, event_pickup_site_indexes = event_types[order], event_plan_indexes[order], event_vehicle_indexes[order], event_pickup_site_indexes[order]
+		plan_event_starts = np.searchsorted(event_plan_indexes, np.arange(num_plans))
+		event_ranks = np.arange(len(order)) - plan_event_starts[event_plan_indexes]
+		rank_order = np.argsort(event_ranks, kind='stable')
+		rank_starts = np.searchsorted(event_ranks[rank_order], np.arange(event_ranks.max() + 2 if len(order) > 0 else 1))
+
+		levels = np.broadcast_to(self.initial_levels, (num_plans, len(self.initial_levels))).copy()
+		loads = np.zeros((num_plans, num_vehicles), dtype=np.float32)
+		num_overload_days = np.zeros(num_plans, dtype=np.int64)
+		for rank in range(len(rank_starts) - 1):
+			rank_events = rank_order[rank_starts[rank]:rank_starts[rank + 1]]
+			rank_event_types = event_types[rank_events]
+
+			pickups = rank_events[rank_event_types == EVENT_PICKUP]
+			if len(pickups) > 0:
+				p, v, s = event_plan_indexes[pickups], event_vehicle_indexes[pickups], event_pickup_site_indexes[pickups]
+				level, load, load_capacity = levels[p, s], loads[p, v], self.load_capacities[v]
+				can_pick = (level != 0) & (load != load_capacity)
+				takes_part = can_pick & (load + level > load_capacity)
+				takes_all = can_pick & ~takes_part
+				levels[p, s] = np.where(takes_part, level - (load_capacity - load), np.where(takes_all, np.float32(0), level))
+				loads[p, v] = np.where(takes_part, load_capacity, np.where(takes_all, load + level, load))
+
+			dumps = rank_events[rank_event_types == EVENT_DUMP]
+			if len(dumps) > 0:
+				loads[event_plan_indexes[dumps], event_vehicle_indexes[dumps]] = 0
+
+			growths = rank_events[rank_event_types == EVENT_GROWTH]
+			if len(growths) > 0:
+				p = event_plan_indexes[growths]
+				levels[p] += self.daily_growths
+				num_overload_days[p] += np.count_nonzero(levels[p] > self.capacities, axis=1)
+
+		# Totals are summed in double precision in vehicle order
+		odometer = np.cumsum(odometers.astype(np.float64), axis=1)[:, -1] if num_vehicles > 0 else np.zeros(num_plans)
+		overtime = np.cumsum(overtimes.astype(np.float64), axis=1)[:, -1] if num_vehicles > 0 else np.zeros(num_plans)
+		return {
+			'cost': cost_function_from_components(odometer, num_overload_days, overtime),
+			'odometer': odometer,
+			'overtime': overtime,
+			'num_overload_days': num_overload_days,
+			'vehicle_odometers': odometers,
+			'vehicle_overtimes': overtimes
+		}
+
+
+def evaluate_plans(routing_input, plans):
+	"""Evaluate a list of routing outputs. See PlanEvaluator.evaluate"""
+	return PlanEvaluator(routing_input).evaluate(plans)
+
+def evaluate_routing_output_file(routing_input_filename = 'temp/routing_input.json', routing_output_filename = 'temp/routing_output.json'):
+	"""Evaluate the routing output written by the routing optimizer. Returns the cost and its components"""
+	with open(routing_input_filename) as routing_input_file:
+		routing_input = json.load(routing_input_file)
+	with open(routing_output_filename) as routing_output_file:
+		routing_output = json.load(routing_output_file)
+	evaluation = evaluate_plans(routing_input, [routing_output])
+	return {
+		'cost': float(evaluation['cost'][0]),
+		'odometer': float(evaluation['odometer'][0]),
+		'overtime': float(evaluation['overtime'][0]),
+		'num_overload_days': int(evaluation['num_overload_days'][0])
+	}
@@ -1,55 +1,267 @@
-from waste_pickup_sim_secrets import API_key
+# The openrouteservice API key is read from waste_pickup_sim_secrets.py when first needed, unless given to MatrixFetcher.
 # waste_pickup_sim_secrets.py contents should be in format (replace # with your API key):
 # API_key = '########################################################'
 
-import requests
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-def get_distance_and_duration_matrix(coords):
-	block_side_length = 50
-
-	distance_matrix = np.ndarray((len(coords), len(coords)), dtype=np.float64)
-	duration_matrix = np.ndarray((len(coords), len(coords)), dtype=np.float64)
-
-	block_corners = np.arange(0, len(coords), block_side_length).tolist()
-	if block_corners[-1] < len(coords):
-		block_corners.append(len(coords))
-
-	for i in range(len(block_corners) - 1):
-		for j in range(len(block_corners) - 1):
-			source_indexes = np.arange(block_corners[i], block_corners[i + 1]).tolist()
-			destination_indexes = np.arange(block_corners[j], block_corners[j + 1]).tolist()
-			print("Making a routing API request")
-			api_results = api_request_distance_and_duration_matrix(coords, source_indexes, destination_indexes)
-			distance_matrix[block_corners[i]:block_corners[i + 1], block_corners[j]:block_corners[j + 1]] = api_results['distance_matrix']
-			duration_matrix[block_corners[i]:block_corners[i + 1], block_corners[j]:block_corners[j + 1]] = api_results['duration_matrix']
-
-	return {
-		"distance_matrix": distance_matrix,
-		"duration_matrix": duration_matrix,
-	}
-
-def api_request_distance_and_duration_matrix(coords, source_indexes, destination_indexes):
-	"""Function to make an API request for a distance matrix and a duration matrix"""
-
-	headers = {
-		'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
-		'Authorization': API_key,
-		'Content-Type': 'application/json; charset=utf-8'
-	}
-	
-	body = {
-		"locations": coords,
-		"sources": source_indexes,
-		"destinations": destination_indexes,
-		"metrics": ["distance", "duration"]
-	}
-	
-	response = requests.post('https://api.openrouteservice.org/v2/matrix/driving-car', json=body, headers=headers)
-	response.raise_for_status()
-	response_json = response.json()
-
-	return {
-		'distance_matrix': np.array(response_json["distances"], dtype=np.float64),
-		'duration_matrix': np.array(response_json["durations"], dtype=np.float64)/60 # Convert from seconds to minutes
-	}
+openrouteservice_matrix_url = 'https://api.openrouteservice.org/v2/matrix/driving-car'
+
+
+class BlockTooLargeError(Exception):
+	pass
+
+
+# Limits the rate of requests over all threads, allowing short bursts
+class RateLimiter():
+
+	def __init__(self, max_requests_per_minute, burst = 1):
+		self.interval = 60/max_requests_per_minute if max_requests_per_minute else 0
+		self.burst = burst
+		self.lock = threading.Lock()
+		self.next_time = time.monotonic()
+
+	def wait(self):
+		if self.interval == 0:
+			return
+		with self.lock:
+			now = time.monotonic()
+			# Allow at most burst requests to be made back to back
+			self.next_time = max(self.next_time, now - (self.burst - 1)*self.interval)
+			wait_time = self.next_time - now
+			self.next_time += self.interval
+		if wait_time > 0:
+			time.sleep(wait_time)
+
+
+# Fetches distance and duration matrixes from an openrouteservice or OSRM compatible matrix API. The matrix is split in
+# blocks that are requested concurrently through a pooled session, under a rate limit, with retries and exponential
+# backoff. The largest number of elements per request is learned from the API: a block that the API rejects as too
+# large is split in blocks of the largest known accepted size, or of a size between it and the smallest rejected size,
+# and blocks larger than that are split before they are sent.
+class MatrixFetcher():
+
+	def __init__(self, url = openrouteservice_matrix_url, api = 'openrouteservice', api_key = None, max_workers = 4, max_requests_per_minute = 40, max_elements = 2500, max_retries = 5, backoff = 1.0, timeout = 60):
+		"""
+		url: matrix endpoint. For openrouteservice, e.g. 'https://api.openrouteservice.org/v2/matrix/driving-car'.
+			For OSRM, the table service base e.g. 'http://localhost:5000/table/v1/driving'
+		api: 'openrouteservice' or 'osrm'
+		max_elements: maximum number of matrix elements (sources times destinations) per request
+		"""
+		self.url = url
+		self.api = api
+		self.api_key = api_key
+		self.max_workers = max_workers
+		self.max_elements = max_elements
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.rate_limiter = RateLimiter(max_requests_per_minute, max_workers)
+		# Imported here, so that importing this module doesn't load requests
+		import requests
+		from requests.adapters import HTTPAdapter
+		self.request_errors = (requests.ConnectionError, requests.Timeout)
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.num_requests = 0
+		self.num_rejected_requests = 0 # Rejected as too large
+		# Largest number of elements of an accepted request, and smallest of a request rejected as too large
+		self.max_accepted_elements = 0
+		self.min_rejected_elements = None
+		# Guards the above and max_elements, which the fetching threads update
+		self.lock = threading.Lock()
+
+	def get_block_shape(self, num_sources, num_destinations):
+		"""Choose the block shape, as square as possible but using up all of a short side"""
+		side_length = max(1, int(math.sqrt(self.max_elements)))
+		num_block_sources = min(num_sources, side_length)
+		num_block_destinations = min(num_destinations, max(1, self.max_elements // num_block_sources))
+		num_block_sources = min(num_sources, max(1, self.max_elements // num_block_destinations))
+		return num_block_sources, num_block_destinations
+
+	def get_block_split(self, num_sources, num_destinations, max_elements):
+		"""Split a block into the fewest equal parts of at most max_elements. Returns (number of row parts, number of column parts)"""
+		best = None
+		for num_row_parts in range(1, num_sources + 1):
+			num_part_rows = -(-num_sources//num_row_parts)
+			if num_part_rows > max_elements:
+				continue
+			num_column_parts = -(-num_destinations//(max_elements//num_part_rows))
+			if best is None or num_row_parts*num_column_parts < best[0]*best[1]:
+				best = (num_row_parts, num_column_parts)
+			if num_column_parts == 1:
+				break
+		return best
+
+	def update_max_elements(self, num_elements, accepted):
+		"""Learn from a request of num_elements that was accepted, or rejected as too large. Call with self.lock held"""
+		if accepted:
+			self.max_accepted_elements = max(self.max_accepted_elements, num_elements)
+		else:
+			self.num_rejected_requests += 1
+			self.min_rejected_elements = num_elements if self.min_rejected_elements is None else min(self.min_rejected_elements, num_elements)
+		if self.min_rejected_elements is None:
+			return
+		if self.max_accepted_elements == 0:
+			# A quarter smaller than the rejected size, until a size is accepted
+			self.max_elements = max(1, min(self.max_elements, self.min_rejected_elements*3//4))
+		elif self.min_rejected_elements - self.max_accepted_elements > self.max_accepted_elements//10:
+			# Halfway between the largest accepted and the smallest rejected size
+			self.max_elements = (self.max_accepted_elements + self.min_rejected_elements)//2
+		else:
+			self.max_elements = self.max_accepted_elements
+
+	def get_distance_and_duration_matrix(self, coords, source_indexes = None, destination_indexes = None):
+		"""
+		Get distance and duration matrixes with rows for source_indexes and columns for destination_indexes of coords.
+		Source and destination indexes default to all indexes. Distances are in meters and durations in minutes.
+		"""
+		if source_indexes is None:
+			source_indexes = np.arange(len(coords))
+		if destination_indexes is None:
+			destination_indexes = np.arange(len(coords))
+		source_indexes = np.asarray(source_indexes, dtype=np.int64)
+		destination_indexes = np.asarray(destination_indexes, dtype=np.int64)
+		coords = np.asarray(coords, dtype=np.float64)
+
+		distance_matrix = np.ndarray((len(source_indexes), len(destination_indexes)), dtype=np.float64)
+		duration_matrix = np.ndarray((len(source_indexes), len(destination_indexes)), dtype=np.float64)
+
+		def fetch_block(row_start, row_end, column_start, column_end):
+			num_elements = (row_end - row_start)*(column_end - column_start)
+			with self.lock:
+				max_elements = self.max_elements
+			if num_elements > max_elements:
+				# Split before sending, into blocks of the size learned so far
+				num_row_parts, num_column_parts = self.get_block_split(row_end - row_start, column_end - column_start, max_elements)
+				row_bounds = [row_start + (row_end - row_start)*part//num_row_parts for part in range(num_row_parts + 1)]
+				column_bounds = [column_start + (column_end - column_start)*part//num_column_parts for part in range(num_column_parts + 1)]
+				for i in range(num_row_parts):
+					for j in range(num_column_parts):
+						fetch_block(row_bounds[i], row_bounds[i + 1], column_bounds[j], column_bounds[j + 1])
+				return
+			try:
+				api_results = self.request_block(coords, source_indexes[row_start:row_end], destination_indexes[column_start:column_end])
+			except BlockTooLargeError:
+				if num_elements <= 1:
+					raise
+				with self.lock:
+					self.update_max_elements(num_elements, False)
+				fetch_block(row_start, row_end, column_start, column_end)
+				return
+			with self.lock:
+				self.update_max_elements(num_elements, True)
+			distance_matrix[row_start:row_end, column_start:column_end] = api_results['distance_matrix']
+			duration_matrix[row_start:row_end, column_start:column_end] = api_results['duration_matrix']
+
+		with self.lock:
+			num_block_sources, num_block_destinations = self.get_block_shape(len(source_indexes), len(destination_indexes))
+		blocks = [
+			(i, min(i + num_block_sources, len(source_indexes)), j, min(j + num_block_destinations, len(destination_indexes)))
+			for i in range(0, len(source_indexes), num_block_sources)
+			for j in range(0, len(destination_indexes), num_block_destinations)
+		]
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			for future in [executor.submit(fetch_block, *block) for block in blocks]:
+				future.result()
+
+		return {
+			"distance_matrix": distance_matrix,
+			"duration_matrix": duration_matrix,
+		}
+
+	def request_block(self, coords, source_indexes, destination_indexes):
+		"""Request a block, sending only the coordinates of the sources and destinations of the block"""
+		block_location_indexes, block_inverse = np.unique(np.concatenate([source_indexes, destination_indexes]), return_inverse=True)
+		block_coords = coords[block_location_indexes].tolist()
+		block_sources = block_inverse[:len(source_indexes)].tolist()
+		block_destinations = block_inverse[len(source_indexes):].tolist()
+
+		for attempt in range(self.max_retries + 1):
+			self.rate_limiter.wait()
+			with self.lock:
+				self.num_requests += 1
+			retry_after = None
+			try:
+				response = self.send_request(block_coords, block_sources, block_destinations)
+			except self.request_errors:
+				if attempt == self.max_retries:
+					raise
+			else:
+				if is_too_large_response(response):
+					raise BlockTooLargeError()
+				if response.status_code != 429 and response.status_code < 500:
+					response.raise_for_status()
+					response_json = response.json()
+					return {
+						'distance_matrix': np.array(response_json["distances"], dtype=np.float64),
+						'duration_matrix': np.array(response_json["durations"], dtype=np.float64)/60 # Convert from seconds to minutes
+					}
+				if attempt == self.max_retries:
+					response.raise_for_status()
+				retry_after = response.headers.get('Retry-After')
+			# Back off exponentially, or as long as the API asks to
+			try:
+				time.sleep(float(retry_after))
+			except (TypeError, ValueError):
+				time.sleep(self.backoff*2**attempt)
+
+	def send_request(self, block_coords, block_sources, block_destinations):
+		if self.api == 'osrm':
+			return self.session.get(
+				f"{self.url}/{';'.join(f'{lon},{lat}' for lon, lat in block_coords)}",
+				params={
+					'sources': ';'.join(map(str, block_sources)),
+					'destinations': ';'.join(map(str, block_destinations)),
+					'annotations': 'distance,duration'
+				},
+				timeout=self.timeout
+			)
+		if self.api_key is None:
+			from waste_pickup_sim_secrets import API_key
+			self.api_key = API_key
+		headers = {
+			'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
+			'Authorization': self.api_key,
+			'Content-Type': 'application/json; charset=utf-8'
+		}
+		body = {
+			"locations": block_coords,
+			"sources": block_sources,
+			"destinations": block_destinations,
+			"metrics": ["distance", "duration"]
+		}
+		return self.session.post(self.url, json=body, headers=headers, timeout=self.timeout)
+
+
+def is_too_large_response(response):
+	"""Check if a response rejects a request for having too many locations"""
+	if response.status_code == 413:
+		return True
+	if response.status_code != 400:
+		return False
+	try:
+		response_json = response.json()
+	except ValueError:
+		return False
+	# openrouteservice error code 6004: request parameters exceed the server configuration limits. OSRM code TooBig
+	error = response_json.get('error')
+	return (isinstance(error, dict) and error.get('code') == 6004) or response_json.get('code') == 'TooBig'
+
+
+default_fetcher = None
+
+def get_distance_and_duration_matrix(coords, source_indexes=None, destination_indexes=None):
+	"""
+	Get distance and duration matrixes with rows for source_indexes and columns for destination_indexes of coords,
+	from openrouteservice. Source and destination indexes default to all indexes.
+	"""
+	global default_fetcher
+	if default_fetcher is None:
+		default_fetcher = MatrixFetcher()
+	return default_fetcher.get_distance_and_duration_matrix(coords, source_indexes, destination_indexes)
@@ -0,0 +1,132 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+import numpy as np
+from haversine_matrix import HaversineMatrixBackend
+
+# A local stand-in for the openrouteservice and OSRM matrix APIs, for running and testing the simulation without
+# network access or an API key. The matrixes are from a HaversineMatrixBackend. Endpoints:
+# POST /v2/matrix/<profile> (openrouteservice) and GET /table/v1/<profile>/<lon>,<lat>;... (OSRM)
+
+
+class StandInMatrixServer(ThreadingHTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, address = ('127.0.0.1', 0), backend = None, max_elements = None, latency = 0):
+		"""
+		backend: matrix backend, by default HaversineMatrixBackend()
+		max_elements: maximum number of matrix elements (sources times destinations) per request, or None for no limit
+		latency: time in seconds to wait before answering each request
+		"""
+		super().__init__(address, StandInMatrixRequestHandler)
+		self.backend = backend if backend is not None else HaversineMatrixBackend()
+		self.max_elements = max_elements
+		self.latency = latency
+		self.num_requests = 0
+		self.thread = None
+
+	def get_url(self, api = 'openrouteservice', profile = 'driving-car'):
+		host, port = self.server_address[:2]
+		if api == 'osrm':
+			return f"http://{host}:{port}/table/v1/{profile}"
+		return f"http://{host}:{port}/v2/matrix/{profile}"
+
+	def get_matrixes(self, lonlats, sources, destinations):
+		"""Get distance (meters) and duration (seconds) matrixes"""
+		matrixes = self.backend.get_distance_and_duration_matrix(lonlats, sources, destinations)
+		return matrixes['distance_matrix'].astype(np.float64), matrixes['duration_matrix'].astype(np.float64)*60
+
+	def start(self):
+		"""Serve in a background thread"""
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+
+class StandInMatrixRequestHandler(BaseHTTPRequestHandler):
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, status, content):
+		data = json.dumps(content).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json; charset=utf-8')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def is_too_large(self, sources, destinations):
+		return self.server.max_elements is not None and len(sources)*len(destinations) > self.server.max_elements
+
+	def do_POST(self):
+		self.server.num_requests += 1
+		time.sleep(self.server.latency)
+		if not urlsplit(self.path).path.startswith('/v2/matrix/'):
+			self.send_json(404, {'error': {'code': 6099, 'message': 'Not found'}})
+			return
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			lonlats = body['locations']
+			sources = body.get('sources', list(range(len(lonlats))))
+			destinations = body.get('destinations', list(range(len(lonlats))))
+			distance_matrix, duration_matrix = self.server.get_matrixes(lonlats, sources, destinations)
+		except (ValueError, KeyError, IndexError, TypeError) as error:
+			self.send_json(400, {'error': {'code': 6000, 'message': str(error)}})
+			return
+		if self.is_too_large(sources, destinations):
+			self.send_json(400, {'error': {'code': 6004, 'message': f"Request parameters exceed the server configuration limits. Only a total of {self.server.max_elements} routes are allowed."}})
+			return
+		metrics = body.get('metrics', ['duration'])
+		response = {}
+		if 'distance' in metrics:
+			response['distances'] = np.round(distance_matrix, 2).tolist()
+		if 'duration' in metrics:
+			response['durations'] = np.round(duration_matrix, 2).tolist()
+		self.send_json(200, response)
+
+	def do_GET(self):
+		self.server.num_requests += 1
+		time.sleep(self.server.latency)
+		url = urlsplit(self.path)
+		path_parts = url.path.split('/')
+		if len(path_parts) != 5 or path_parts[1] != 'table':
+			self.send_json(400, {'code': 'InvalidUrl', 'message': 'URL string malformed'})
+			return
+		query = parse_qs(url.query)
+		try:
+			lonlats = [list(map(float, lonlat.split(','))) for lonlat in unquote(path_parts[4]).split(';')]
+			sources = list(map(int, query['sources'][0].split(';'))) if 'sources' in query else list(range(len(lonlats)))
+			destinations = list(map(int, query['destinations'][0].split(';'))) if 'destinations' in query else list(range(len(lonlats)))
+			distance_matrix, duration_matrix = self.server.get_matrixes(lonlats, sources, destinations)
+		except (ValueError, IndexError) as error:
+			self.send_json(400, {'code': 'InvalidQuery', 'message': str(error)})
+			return
+		if self.is_too_large(sources, destinations):
+			self.send_json(400, {'code': 'TooBig', 'message': 'Too many table coordinates'})
+			return
+		annotations = query.get('annotations', ['duration'])[0].split(',')
+		response = {'code': 'Ok'}
+		if 'distance' in annotations:
+			response['distances'] = np.round(distance_matrix, 1).tolist()
+		if 'duration' in annotations:
+			response['durations'] = np.round(duration_matrix, 1).tolist()
+		self.send_json(200, response)
+
+
+if __name__ == '__main__':
+	# Usage: python routing_api_stand_in.py [port]
+	server = StandInMatrixServer(('127.0.0.1', int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
+	print(f"Serving openrouteservice matrix API at {server.get_url()} and OSRM table API at {server.get_url('osrm')}")
+	server.serve_forever()
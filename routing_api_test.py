@@ -0,0 +1,40 @@
+import numpy as np
+from haversine_matrix import HaversineMatrixBackend
+from routing_api import MatrixFetcher
+from routing_api_stand_in import StandInMatrixServer
+
+# Checks of the matrix fetcher against the local stand-in for the openrouteservice and OSRM matrix APIs: the fetched
+# matrixes are those of the stand-in's backend, and with a limit of elements per request, the fetcher learns the limit
+# with few rejected requests.
+# Run from the repository root: python routing_api_test.py
+
+def test_matrix_fetcher(rng, api, num_locations = 200, max_elements = 1000):
+	"""The matrix fetcher gets the matrixes of the stand-in, with few requests over a limit of elements per request"""
+	backend = HaversineMatrixBackend()
+	coords = np.column_stack([rng.uniform(23.5, 25.5, num_locations), rng.uniform(60.5, 61.5, num_locations)])
+	server = StandInMatrixServer(backend=backend, max_elements=max_elements).start()
+	try:
+		fetcher = MatrixFetcher(server.get_url(api), api, api_key='stand-in', max_requests_per_minute=None)
+		matrixes = fetcher.get_distance_and_duration_matrix(coords)
+		# A matrix of some rows, with the limit learned
+		num_requests, num_rejected_requests = fetcher.num_requests, fetcher.num_rejected_requests
+		rows = rng.choice(num_locations, 30, replace=False)
+		row_matrixes = fetcher.get_distance_and_duration_matrix(coords, rows)
+	finally:
+		server.stop()
+	expected = backend.get_distance_and_duration_matrix(coords)
+	# The APIs round distances to 0.1 m or less, and durations to 0.1 s or less
+	for name, atol in (('distance_matrix', 0.06), ('duration_matrix', 0.06/60)):
+		assert np.allclose(matrixes[name], expected[name], rtol=1e-6, atol=atol), f"Fetched {name} differs from the stand-in's"
+		assert np.allclose(row_matrixes[name], expected[name][rows], rtol=1e-6, atol=atol), f"Fetched {name} of rows differs from the stand-in's"
+	min_num_requests = -(-num_locations**2//max_elements)
+	assert fetcher.max_accepted_elements <= max_elements < fetcher.min_rejected_elements and fetcher.max_elements >= 0.8*max_elements, f"Learned {fetcher.max_elements} elements per request, the limit is {max_elements}"
+	assert num_requests <= 1.5*min_num_requests, f"{num_requests} requests, at least {min_num_requests} needed"
+	# Only requests already sent when the first of them was rejected are rejected at once
+	assert num_rejected_requests <= 2*fetcher.max_workers, f"{num_rejected_requests} requests rejected as too large"
+	assert fetcher.num_rejected_requests - num_rejected_requests <= fetcher.max_workers, f"{fetcher.num_rejected_requests - num_rejected_requests} requests rejected after the limit was learned"
+	print(f"Matrix fetcher matches the {api} stand-in: {num_requests} requests, at least {min_num_requests} needed, {num_rejected_requests} rejected, learned {fetcher.max_elements} elements per request")
+
+rng = np.random.default_rng(42)
+test_matrix_fetcher(rng, 'openrouteservice')
+test_matrix_fetcher(rng, 'osrm')
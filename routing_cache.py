@@ -0,0 +1,269 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+from plan_evaluator import evaluate_plans, get_pickup_durations
+from sparse_travel_matrix import as_travel_matrix
+
+# Cache of routing decisions in front of a router, for ensembles and what-if studies that route nearly the same state
+# many times. A routing input is fingerprinted by a structure key of what must match exactly: the router and its
+# settings (the namespace), the pickup site locations and capacities, the depots, the terminals and the fleet. The
+# pickup site fill ratios and growth rates are quantised on top of that: identical quantised states are a hit and get
+# the cached plan. A state within a few quanta of a cached one is a near-hit: the cached plan is repaired by inserting
+# visits to sites that would overflow without one, and re-scored with the plan evaluator. It is used if its cost is
+# within a tolerance of the cost of the cached plan in its own state, and otherwise it warm-starts the router. Entries
+# are evicted least recently used first, and can also be kept on disk, shared by processes, as JSON files in a
+# directory per structure key.
+
+
+class RoutingCache():
+
+	def __init__(self, max_entries = 256, directory = None, level_quantum = 0.05, growth_rate_quantum = 0.05, near_hit_quanta = 2, near_hit_cost_tolerance = 0.1):
+		"""
+		max_entries: number of plans kept in memory
+		directory: directory of the on-disk tier, default None for none
+		level_quantum: quantum of pickup site fill ratios
+		growth_rate_quantum: relative quantum of pickup site growth rates
+		near_hit_quanta: largest difference in quanta of any pickup site for a near-hit, 0 for none
+		near_hit_cost_tolerance: largest relative increase of cost of a repaired plan of a near-hit, over that of the cached
+			plan in its own state
+		"""
+		self.max_entries = max_entries
+		self.directory = directory
+		self.level_quantum = level_quantum
+		self.growth_rate_quantum = growth_rate_quantum
+		self.near_hit_quanta = near_hit_quanta
+		self.near_hit_cost_tolerance = near_hit_cost_tolerance
+		self.entries = collections.OrderedDict() # (structure key, state key): entry, least recently used first
+		self.disk_filenames = set() # Files of the on-disk tier that have been read
+		self.disk_directory_mtimes = {} # Structure key: modification time of its directory when last listed
+		self.lock = threading.Lock()
+		self.stats = {'hits': 0, 'disk_hits': 0, 'near_hits': 0, 'warm_starts': 0, 'misses': 0, 'evictions': 0}
+
+	def get_keys(self, namespace, routing_input):
+		"""Get the structure key and the quantised state of a routing input. Returns (structure key, state key, quantised state)"""
+		pickup_sites = routing_input['pickup_sites']
+		capacities = np.array([pickup_site['capacity'] for pickup_site in pickup_sites], dtype=np.float64)
+		levels = np.array([pickup_site['level'] for pickup_site in pickup_sites], dtype=np.float64)
+		growth_rates = np.array([pickup_site['growth_rate'] for pickup_site in pickup_sites], dtype=np.float64)
+		structure = json.dumps({
+			'namespace': namespace,
+			'pickup_sites': [[pickup_site['location_index'], pickup_site['capacity']] for pickup_site in pickup_sites],
+			'depots': [depot['location_index'] for depot in routing_input['depots']],
+			'terminals': [terminal['location_index'] for terminal in routing_input['terminals']],
+			'vehicles': routing_input['vehicles']
+		}, sort_keys=True)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			quantised_levels = np.round(np.where(capacities > 0, levels/capacities, 0)/self.level_quantum)
+			quantised_growth_rates = np.round(np.log(np.maximum(growth_rates, 1e-12))/np.log1p(self.growth_rate_quantum))
+		state = np.concatenate([quantised_levels, quantised_growth_rates]).astype(np.int64)
+		return hashlib.sha1(structure.encode()).hexdigest()[:20], hashlib.sha1(state.tobytes()).hexdigest()[:20], state
+
+	def get_filename(self, structure_key, state_key):
+		return os.path.join(self.directory, structure_key, f"{state_key}.json")
+
+	def put_entry(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+			self.stats['evictions'] += 1
+
+	def read_disk_entry(self, structure_key, state_key):
+		"""Read an entry of the on-disk tier into memory. Returns the entry, or None if there is none"""
+		filename = self.get_filename(structure_key, state_key)
+		try:
+			with open(filename) as f:
+				entry = json.load(f)
+		except (OSError, ValueError):
+			return None # None, or being written
+		self.disk_filenames.add(filename)
+		entry['state'] = np.asarray(entry['state'], dtype=np.int64)
+		if (structure_key, state_key) not in self.entries:
+			self.put_entry((structure_key, state_key), entry)
+		return self.entries[(structure_key, state_key)]
+
+	def read_disk_entries(self, structure_key):
+		"""
+		Read the entries of a structure key that other processes have written to the on-disk tier since the last read.
+		The directory is only listed again when it has changed
+		"""
+		directory = os.path.join(self.directory, structure_key)
+		try:
+			mtime = os.stat(directory).st_mtime_ns
+		except OSError:
+			return
+		if self.disk_directory_mtimes.get(structure_key) == mtime:
+			return
+		self.disk_directory_mtimes[structure_key] = mtime
+		for filename in sorted(os.listdir(directory)):
+			if filename.endswith('.json') and os.path.join(directory, filename) not in self.disk_filenames:
+				self.read_disk_entry(structure_key, filename[:-len('.json')])
+
+	def lookup(self, structure_key, state_key, state):
+		"""Find a cached entry. Returns ('hit' or 'near_hit', entry) or (None, None)"""
+		with self.lock:
+			entry = self.entries.get((structure_key, state_key))
+			if entry is None and self.directory is not None:
+				entry = self.read_disk_entry(structure_key, state_key)
+				if entry is not None:
+					self.stats['disk_hits'] += 1
+			if entry is not None:
+				self.entries.move_to_end((structure_key, state_key))
+				return 'hit', entry
+			if self.near_hit_quanta <= 0:
+				return None, None
+			if self.directory is not None:
+				self.read_disk_entries(structure_key)
+			# The nearest cached state of the same structure, by the largest difference of any pickup site
+			nearest_key = None
+			nearest_distance = self.near_hit_quanta + 1
+			for key, candidate in self.entries.items():
+				if key[0] == structure_key:
+					distance = np.abs(candidate['state'] - state).max(initial=0)
+					if distance < nearest_distance:
+						nearest_key, nearest_distance = key, distance
+			if nearest_key is None:
+				return None, None
+			self.entries.move_to_end(nearest_key)
+			return 'near_hit', self.entries[nearest_key]
+
+	def put(self, structure_key, state_key, state, routing_output, cost):
+		entry = {'state': state, 'routing_output': copy_routing_output(routing_output), 'cost': cost}
+		with self.lock:
+			self.put_entry((structure_key, state_key), entry)
+			if self.directory is not None:
+				filename = self.get_filename(structure_key, state_key)
+				os.makedirs(os.path.dirname(filename), exist_ok=True)
+				# Written to a temporary file first, so that other processes never read a partial file
+				temporary_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+				with open(temporary_filename, 'w') as f:
+					json.dump({**entry, 'state': state.tolist()}, f)
+				os.replace(temporary_filename, filename)
+				self.disk_filenames.add(filename)
+
+	def route(self, namespace, routing_input, router, warm_start = False):
+		"""
+		Route with router through the cache. namespace identifies the router and its settings. warm_start: whether the
+		router reads routing_input['starting_plan'], which the repaired plan of a near-hit that is not good enough then
+		replaces. Returns (routing output, 'hit', 'near_hit', 'warm_start' or 'miss')
+		"""
+		structure_key, state_key, state = self.get_keys(namespace, routing_input)
+		kind, entry = self.lookup(structure_key, state_key, state)
+		if kind == 'hit':
+			self.count('hits')
+			return copy_routing_output(entry['routing_output']), 'hit'
+		if kind == 'near_hit':
+			repaired = repair_plan(routing_input, entry['routing_output'])
+			repaired_cost = get_cost(routing_input, repaired)
+			if repaired_cost <= entry['cost']*(1 + self.near_hit_cost_tolerance):
+				self.count('near_hits')
+				# Cached under its own state, so that routing the same state again is a hit
+				self.put(structure_key, state_key, state, repaired, repaired_cost)
+				return repaired, 'near_hit'
+		if kind == 'near_hit' and warm_start:
+			routing_input = {**routing_input, 'starting_plan': repaired}
+			kind = 'warm_start'
+			self.count('warm_starts')
+		else:
+			kind = 'miss'
+			self.count('misses')
+		routing_output = router(routing_input)
+		self.put(structure_key, state_key, state, routing_output, get_cost(routing_input, routing_output))
+		return routing_output, kind
+
+	def count(self, name):
+		with self.lock:
+			self.stats[name] += 1
+
+	def get_stats(self):
+		"""Hit and miss counts, the hit rate including near-hits, and the number of entries in memory"""
+		with self.lock:
+			num_lookups = self.stats['hits'] + self.stats['near_hits'] + self.stats['warm_starts'] + self.stats['misses']
+			return {
+				**self.stats,
+				'hit_rate': (self.stats['hits'] + self.stats['near_hits'])/num_lookups if num_lookups > 0 else 0,
+				'num_entries': len(self.entries)
+			}
+
+
+# Routing caches shared by the simulations of a process, by their settings
+shared_routing_caches = {}
+shared_routing_caches_lock = threading.Lock()
+
+def get_shared_routing_cache(**settings):
+	"""Get the routing cache of this process with the given RoutingCache settings, creating it on first use"""
+	key = json.dumps(settings, sort_keys=True)
+	with shared_routing_caches_lock:
+		if key not in shared_routing_caches:
+			shared_routing_caches[key] = RoutingCache(**settings)
+		return shared_routing_caches[key]
+
+
+def copy_routing_output(routing_output):
+	return {'days': [{'vehicles': [{'route': list(vehicle['route'])} for vehicle in day['vehicles']]} for day in routing_output['days']]}
+
+def get_cost(routing_input, routing_output):
+	if len(routing_output['days']) == 0:
+		return 0.0
+	return float(evaluate_plans(routing_input, [routing_output])['cost'][0])
+
+def repair_plan(routing_input, routing_output):
+	"""
+	Repair a plan for the pickup site levels of routing_input: each day, a site forecast to overflow by the end of the
+	day, and not visited that day, is inserted where it adds the least duration to a route of the day that stays within
+	its vehicle's max_route_duration. An idle vehicle gets a route from its home depot. Returns the repaired plan
+	"""
+	pickup_sites = routing_input['pickup_sites']
+	capacities = np.array([pickup_site['capacity'] for pickup_site in pickup_sites], dtype=np.float64)
+	levels = np.array([pickup_site['level'] for pickup_site in pickup_sites], dtype=np.float64)
+	daily_growths = np.array([pickup_site['growth_rate'] for pickup_site in pickup_sites], dtype=np.float64)*(24*60)
+	site_locations = np.array([pickup_site['location_index'] for pickup_site in pickup_sites], dtype=np.int64)
+	site_indexes_by_location = {location_index: site_index for site_index, location_index in enumerate(site_locations.tolist())}
+	vehicles = routing_input['vehicles']
+	home_locations = [routing_input['depots'][vehicle['home_depot_index']]['location_index'] for vehicle in vehicles]
+	duration_matrix = as_travel_matrix(routing_input['duration_matrix'])
+	pickup_durations = get_pickup_durations(vehicles)
+
+	def get_route_duration(route, vehicle_index):
+		route = np.asarray(route, dtype=np.int64)
+		num_pickups = sum(1 for location_index in route.tolist() if location_index in site_indexes_by_location)
+		return float(np.sum(duration_matrix[route[:-1], route[1:]])) + num_pickups*pickup_durations[vehicle_index] if len(route) > 1 else 0.0
+
+	repaired = copy_routing_output(routing_output)
+	for day in repaired['days']:
+		routes = [vehicle['route'] for vehicle in day['vehicles']]
+		visited = np.zeros(len(pickup_sites), dtype=bool)
+		for route in routes:
+			for location_index in route:
+				if location_index in site_indexes_by_location:
+					visited[site_indexes_by_location[location_index]] = True
+		route_durations = [get_route_duration(route, vehicle_index) if vehicle_index < len(vehicles) else 0.0 for vehicle_index, route in enumerate(routes)]
+		# Most urgent first
+		overflowing = np.flatnonzero(~visited & (levels + daily_growths > capacities))
+		for site_index in overflowing[np.argsort(-(levels + daily_growths - capacities)[overflowing], kind='stable')].tolist():
+			site_location = int(site_locations[site_index])
+			best = None # (added duration, vehicle index, position)
+			for vehicle_index, route in enumerate(routes):
+				if vehicle_index >= len(vehicles):
+					break
+				stops = np.asarray(route if len(route) > 0 else [home_locations[vehicle_index], home_locations[vehicle_index]], dtype=np.int64)
+				added_durations = (duration_matrix[stops[:-1], site_location] + duration_matrix[site_location, stops[1:]] - duration_matrix[stops[:-1], stops[1:]]).astype(np.float64) + pickup_durations[vehicle_index]
+				position = int(np.argmin(added_durations))
+				added_duration = float(added_durations[position])
+				if route_durations[vehicle_index] + added_duration <= vehicles[vehicle_index]['max_route_duration'] and (best is None or added_duration < best[0]):
+					best = (added_duration, vehicle_index, position)
+			if best is None:
+				continue
+			added_duration, vehicle_index, position = best
+			if len(routes[vehicle_index]) == 0:
+				routes[vehicle_index].extend([home_locations[vehicle_index], home_locations[vehicle_index]])
+			routes[vehicle_index].insert(position + 1, site_location)
+			route_durations[vehicle_index] += added_duration
+			visited[site_index] = True
+		# Forecast the levels of the next day
+		levels = np.where(visited, 0, levels) + daily_growths
+	return repaired
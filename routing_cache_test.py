@@ -0,0 +1,147 @@
+import copy
+import os
+import random
+import tempfile
+import numpy as np
+import waste_pickup_sim
+from heuristic_router import heuristic_router
+from plan_evaluator import evaluate_plans
+from routing_cache import RoutingCache, repair_plan
+
+# Checks of the routing cache on the test scenario, with the heuristic router and offline haversine matrixes: hits,
+# near-hits and their repaired plans, warm starts, eviction, the on-disk tier shared by caches, and reuse across two
+# identical simulation runs.
+# Run from the repository root: python routing_cache_test.py
+
+sim_config = {
+	'sim_name': 'Hämeenlinna and nearby regions',
+	'sim_runtime_days': 14,
+	'pickup_sites_filename': 'geo_data/sim_test_sites.geojson',
+	'depots_filename': 'geo_data/sim_test_terminals.geojson',
+	'terminals_filename': 'geo_data/sim_test_terminals.geojson',
+	'vehicle_template': {
+		'load_capacity': 18,
+		'max_route_duration': 8*60 + 15,
+		'pickup_duration': 15
+	},
+	'depots': [
+		{
+			'num_vehicles': 1
+		},
+		{
+			'num_vehicles': 1
+		}
+	],
+	'matrix_backend': 'haversine',
+	'router': 'heuristic',
+	'log_quiet': True,
+	'log_events_to_file': False,
+	'write_sample_logs': False
+}
+
+# A router that counts its calls and records the starting plans it is given
+class RecordingRouter():
+
+	def __init__(self):
+		self.num_calls = 0
+		self.starting_plans = []
+
+	def __call__(self, routing_input):
+		self.num_calls += 1
+		self.starting_plans.append(routing_input.get('starting_plan'))
+		return heuristic_router(routing_input)
+
+def with_fill_ratios(routing_input, fill_ratio_changes):
+	"""Routing input with the fill ratios of the pickup sites changed"""
+	routing_input = copy.copy(routing_input)
+	routing_input['pickup_sites'] = [{**pickup_site, 'level': min(max(pickup_site['level'] + change*pickup_site['capacity'], 0), pickup_site['capacity'])} for pickup_site, change in zip(routing_input['pickup_sites'], fill_ratio_changes)]
+	return routing_input
+
+def test_hits_and_near_hits(routing_input):
+	"""The same state is a hit, a state a quantum away a near-hit, and the repaired plan is cached under its own state"""
+	cache = RoutingCache()
+	router = RecordingRouter()
+	assert cache.route('test', routing_input, router)[1] == 'miss'
+	routing_output, kind = cache.route('test', routing_input, router)
+	assert kind == 'hit' and router.num_calls == 1 and routing_output == heuristic_router(routing_input), f"Routing the same state again was a {kind}"
+	near_input = with_fill_ratios(routing_input, np.full(len(routing_input['pickup_sites']), cache.level_quantum))
+	near_output, kind = cache.route('test', near_input, router)
+	assert kind == 'near_hit' and router.num_calls == 1, f"Routing a state a quantum away was a {kind}"
+	assert cache.route('test', near_input, router) == (near_output, 'hit'), "The repaired plan of a near-hit was not cached under its state"
+	assert cache.route('other', routing_input, router)[1] == 'miss', "Another namespace shared the plans"
+	print(f"Routing cache hits and near-hits: {cache.get_stats()}")
+
+def test_repair_plan(routing_input):
+	"""A repaired plan visits sites that would overflow, so it has no more overflow days than the plan it repairs"""
+	routing_output = heuristic_router(routing_input)
+	fuller_input = with_fill_ratios(routing_input, np.full(len(routing_input['pickup_sites']), 0.3))
+	repaired = repair_plan(fuller_input, routing_output)
+	evaluation = evaluate_plans(fuller_input, [routing_output, repaired])
+	assert evaluation['num_overload_days'][1] < evaluation['num_overload_days'][0], f"Repair left {evaluation['num_overload_days'][1]} of {evaluation['num_overload_days'][0]} overload days"
+	for day, repaired_day in zip(routing_output['days'], repaired['days']):
+		for vehicle, repaired_vehicle in zip(day['vehicles'], repaired_day['vehicles']):
+			assert [location_index for location_index in repaired_vehicle['route'] if location_index in vehicle['route']] == vehicle['route'] or len(vehicle['route']) == 0, "Repair reordered the visits of a route"
+	print(f"Repaired plan: {evaluation['num_overload_days'][0]} -> {evaluation['num_overload_days'][1]} overload days, cost {evaluation['cost'][0]:.2f} -> {evaluation['cost'][1]:.2f}")
+
+def test_warm_start(routing_input):
+	"""A near-hit that is not good enough warm-starts routers that read a starting plan, and is a miss for others"""
+	near_input = with_fill_ratios(routing_input, np.full(len(routing_input['pickup_sites']), 0.05))
+	for warm_start in (True, False):
+		cache = RoutingCache(near_hit_cost_tolerance=-1) # No repaired plan is good enough
+		router = RecordingRouter()
+		cache.route('test', routing_input, router)
+		_, kind = cache.route('test', near_input, router, warm_start)
+		assert kind == ('warm_start' if warm_start else 'miss'), f"A near-hit with warm_start {warm_start} was a {kind}"
+		assert (router.starting_plans[-1] is not None) == warm_start, "The starting plan of the router was not the repaired plan"
+	print("Routing cache warm starts only routers that read a starting plan")
+
+def test_eviction(routing_input):
+	"""The least recently used plans are evicted first"""
+	cache = RoutingCache(max_entries=2, near_hit_quanta=0)
+	router = RecordingRouter()
+	inputs = [with_fill_ratios(routing_input, np.full(len(routing_input['pickup_sites']), 0.2*index)) for index in range(3)]
+	kinds = [cache.route('test', routing_input, router)[1] for routing_input in (inputs[0], inputs[1], inputs[0], inputs[2], inputs[0], inputs[1])]
+	assert kinds == ['miss', 'miss', 'hit', 'miss', 'hit', 'miss'] and cache.get_stats()['evictions'] == 2, f"Routing cache kinds {kinds}, {cache.get_stats()['evictions']} evictions"
+	print(f"Routing cache evicts the least recently used plans: {kinds}")
+
+def test_disk_tier(routing_input):
+	"""Caches that share a directory share their plans, also near-hits"""
+	with tempfile.TemporaryDirectory() as directory:
+		cache = RoutingCache(directory=directory)
+		other_cache = RoutingCache(directory=directory)
+		router = RecordingRouter()
+		cache.route('test', routing_input, router)
+		assert other_cache.route('test', routing_input, router)[1] == 'hit' and other_cache.get_stats()['disk_hits'] == 1, "A plan of the on-disk tier was not a hit"
+		near_input = with_fill_ratios(routing_input, np.full(len(routing_input['pickup_sites']), cache.level_quantum))
+		assert RoutingCache(directory=directory).route('test', near_input, router)[1] == 'near_hit', "A plan of the on-disk tier was not a near-hit"
+		assert router.num_calls == 1
+		# The near-hit of the third cache is on disk for the others
+		assert cache.route('test', near_input, router)[1] == 'hit'
+	print("Routing caches share plans through the on-disk tier")
+
+def test_simulation_runs(sim_config):
+	"""A second run of the same scenario without noise only gets hits, also of the near-hits of the first run"""
+	cache = RoutingCache()
+	counts = []
+	for _ in range(2):
+		sim = waste_pickup_sim.WastePickupSimulation({**sim_config, 'routing_cache': cache, 'replan_interval_days': 1})
+		sim.sim_run()
+		sim.sim_record()
+		counts.append(sim.sim_records['routing_cache'])
+	num_routings = sum(counts[0][kind] for kind in ('hit', 'near_hit', 'warm_start', 'miss'))
+	assert counts[0]['near_hit'] > 0, f"The first run had no near-hits: {counts[0]}"
+	assert counts[1]['hit'] == num_routings, f"The second run of {num_routings} routings had {counts[1]}"
+	print(f"Second run of the same scenario only gets hits: first run {counts[0]}, second run {counts[1]}")
+
+random.seed(42)
+np.random.seed(42)
+os.makedirs('temp', exist_ok=True)
+waste_pickup_sim.preprocess_sim_config(sim_config, 'temp/routing_cache_test_config.json')
+sim = waste_pickup_sim.WastePickupSimulation(sim_config)
+routing_input = sim.get_routing_input(sim.pickup_site_accumulator.levels)
+test_hits_and_near_hits(routing_input)
+test_repair_plan(routing_input)
+test_warm_start(routing_input)
+test_eviction(routing_input)
+test_disk_tier(routing_input)
+test_simulation_runs(sim_config)
@@ -0,0 +1,120 @@
+import numpy as np
+
+from spatial_index import SpatialIndex
+
+# Depot-cluster decomposition of routing. Pickup sites are partitioned into clusters by their nearest depot that has
+# vehicles, found with a spatial index. With an overlap, a site also joins the cluster of any other depot that is at
+# most 1 + overlap times as far, so that sites near cluster borders can be served from either side. Each cluster is
+# routed as an independent subproblem with its own vehicles and the terminals, and the subproblems run in parallel in a
+# routing executor. With local matrixes, a subproblem has small dense matrixes of its own locations, for the genetic
+# algorithm router, otherwise the matrixes of all locations. The routes are merged into one routing output per day. A
+# site visited in more than one cluster on the same day keeps the visit of the cluster of its nearest depot, or else
+# the first one.
+
+
+class RoutingDecomposition():
+
+	def __init__(self, location_lonlats, pickup_site_location_indexes, depot_location_indexes, terminal_location_indexes, vehicle_home_depot_indexes, distance_matrix, duration_matrix, overlap = 0.1, local_matrixes = True, max_clusters_per_site = 4):
+		"""
+		location_lonlats: lonlats of all locations
+		pickup_site_location_indexes, depot_location_indexes, terminal_location_indexes: location indexes of the pickup
+			sites, depots and terminals, in the order of routing input
+		vehicle_home_depot_indexes: home depot index of each vehicle
+		distance_matrix, duration_matrix: matrixes of all locations
+		overlap: a site joins the cluster of a depot at most 1 + overlap times as far as its nearest depot
+		local_matrixes: whether subproblems have matrixes of their own locations, with location indexes of those
+		max_clusters_per_site: largest number of clusters a site joins
+		"""
+		location_lonlats = np.asarray(location_lonlats, dtype=np.float64).reshape(-1, 2)
+		pickup_site_location_indexes = np.asarray(pickup_site_location_indexes, dtype=np.int64)
+		depot_location_indexes = np.asarray(depot_location_indexes, dtype=np.int64)
+		terminal_location_indexes = np.asarray(terminal_location_indexes, dtype=np.int64)
+		vehicle_home_depot_indexes = np.asarray(vehicle_home_depot_indexes, dtype=np.int64)
+		# Depots with vehicles, and their nearest among them for each site
+		cluster_depot_indexes = np.unique(vehicle_home_depot_indexes)
+		depot_index = SpatialIndex(location_lonlats[depot_location_indexes[cluster_depot_indexes]])
+		nearest, distances = depot_index.nearest(location_lonlats[pickup_site_location_indexes], max_clusters_per_site)
+		is_member = distances <= distances[:, :1]*(1 + overlap)
+
+		# Cluster of each pickup site location, by its nearest depot
+		self.owner_clusters = np.full(len(location_lonlats), -1, dtype=np.int64)
+		self.owner_clusters[pickup_site_location_indexes] = nearest[:, 0]
+		self.is_pickup_site = np.zeros(len(location_lonlats), dtype=bool)
+		self.is_pickup_site[pickup_site_location_indexes] = True
+
+		self.clusters = []
+		for cluster_index, cluster_depot_index in enumerate(cluster_depot_indexes.tolist()):
+			pickup_site_indexes = np.flatnonzero(np.any((nearest == cluster_index) & is_member, axis=1))
+			location_indexes = np.unique(np.concatenate([pickup_site_location_indexes[pickup_site_indexes], depot_location_indexes[cluster_depot_index:cluster_depot_index + 1], terminal_location_indexes]))
+			is_location = np.zeros(len(location_lonlats), dtype=bool)
+			is_location[location_indexes] = True
+			self.clusters.append({
+				'depot_index': cluster_depot_index,
+				'pickup_site_indexes': pickup_site_indexes.tolist(),
+				'vehicle_indexes': np.flatnonzero(vehicle_home_depot_indexes == cluster_depot_index).tolist(),
+				'is_location': is_location,
+				# Location index of each location index of the subproblem, in increasing order
+				'location_indexes': location_indexes if local_matrixes else np.arange(len(location_lonlats)),
+				'distance_matrix': np.asarray(distance_matrix[location_indexes[:, None], location_indexes[None, :]]) if local_matrixes else None,
+				'duration_matrix': np.asarray(duration_matrix[location_indexes[:, None], location_indexes[None, :]]) if local_matrixes else None
+			})
+
+	def get_subproblem_input(self, routing_input, cluster):
+		"""Routing input of the subproblem of a cluster"""
+		location_indexes = cluster['location_indexes']
+		is_location = cluster['is_location']
+		def to_local(location_index):
+			return int(np.searchsorted(location_indexes, location_index))
+		subproblem_input = {
+			'pickup_sites': [{**routing_input['pickup_sites'][index], 'location_index': to_local(routing_input['pickup_sites'][index]['location_index'])} for index in cluster['pickup_site_indexes']],
+			'depots': [{'location_index': to_local(routing_input['depots'][cluster['depot_index']]['location_index'])}],
+			'terminals': [{'location_index': to_local(terminal['location_index'])} for terminal in routing_input['terminals']],
+			'vehicles': [{**routing_input['vehicles'][index], 'home_depot_index': 0} for index in cluster['vehicle_indexes']],
+			'distance_matrix': cluster['distance_matrix'] if cluster['distance_matrix'] is not None else routing_input['distance_matrix'],
+			'duration_matrix': cluster['duration_matrix'] if cluster['duration_matrix'] is not None else routing_input['duration_matrix']
+		}
+		if 'starting_plan' in routing_input:
+			# The cluster's vehicles' planned routes, without visits outside the cluster
+			subproblem_input['starting_plan'] = {'days': [{'vehicles': [{
+				'route': np.searchsorted(location_indexes, [location_index for location_index in day['vehicles'][index]['route'] if is_location[location_index]]).tolist()
+			} for index in cluster['vehicle_indexes']]} for day in routing_input['starting_plan']['days']]}
+		return subproblem_input
+
+	def merge(self, num_vehicles, routing_outputs):
+		"""
+		Merge the routing outputs of the subproblems into one, of as many days as the shortest of them. Clusters without
+		pickup sites have routing output None, and their vehicles stay at the depot
+		"""
+		num_days = min((len(routing_output['days']) for routing_output in routing_outputs if routing_output is not None), default=0)
+		days = []
+		for day in range(num_days):
+			cluster_routes = [[cluster['location_indexes'][vehicle['route']].tolist() for vehicle in routing_output['days'][day]['vehicles']] if routing_output is not None else [] for cluster, routing_output in zip(self.clusters, routing_outputs)]
+			# Visits of the sites of each cluster's own depot come first, then the other visits in cluster order
+			visited = set()
+			for cluster_index, routes in enumerate(cluster_routes):
+				for route in routes:
+					visited.update(location_index for location_index in route if self.owner_clusters[location_index] == cluster_index)
+			vehicles = [{'route': []} for _ in range(num_vehicles)]
+			for cluster_index, (cluster, routes) in enumerate(zip(self.clusters, cluster_routes)):
+				for vehicle_index, route in zip(cluster['vehicle_indexes'], routes):
+					kept_route = []
+					for location_index in route:
+						owner_cluster = self.owner_clusters[location_index]
+						if owner_cluster != cluster_index and owner_cluster >= 0:
+							if location_index in visited:
+								continue
+							visited.add(location_index)
+						kept_route.append(location_index)
+					vehicles[vehicle_index]['route'] = self.clean_route(kept_route)
+			days.append({'vehicles': vehicles})
+		return {'days': days}
+
+	def clean_route(self, route):
+		"""Remove repeated stops left by removed visits. A route without pickup sites is left empty"""
+		route = [location_index for position, location_index in enumerate(route) if position == 0 or location_index != route[position - 1]]
+		return route if any(self.is_pickup_site[location_index] for location_index in route) else []
+
+	def route(self, routing_input, router, routing_executor):
+		"""Route the subproblems of the clusters with router in parallel in a routing executor, and merge their routes"""
+		futures = [routing_executor.submit(router, self.get_subproblem_input(routing_input, cluster)) if len(cluster['pickup_site_indexes']) > 0 else None for cluster in self.clusters]
+		return self.merge(len(routing_input['vehicles']), [future.result() if future is not None else None for future in futures])
@@ -0,0 +1,93 @@
+import concurrent.futures
+import os
+import threading
+
+from routing_optimizer_worker import RoutingOptimizerWorker
+
+# Asynchronous routing. A routing executor runs routing requests in a bounded pool of threads, each with its own
+# persistent routing optimizer worker processes, so that simulations keep running while their next routes are being
+# optimized. One executor can serve any number of simulations, and run_interleaved runs simulations in one process so
+# that while one of them waits for its routes, the others advance.
+
+# The routing executor of each pool thread
+current = threading.local()
+
+
+class RoutingExecutor():
+
+	def __init__(self, max_workers = None, log_filename = None):
+		"""
+		max_workers: maximum number of concurrent routing requests, default the number of CPU cores, which the routing
+			optimizer processes share
+		log_filename: file that all routing optimizer workers of the executor log to, so that simulations with different
+			log files share the workers. Default None for a worker per log file of the simulations
+		"""
+		self.max_workers = max_workers or os.cpu_count() or 1
+		self.log_filename = log_filename
+		self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='routing', initializer=self.init_thread)
+		self.thread_local = threading.local()
+		self.workers = []
+		self.lock = threading.Lock()
+
+	def init_thread(self):
+		current.routing_executor = self
+
+	def submit(self, fn, /, *args, **kwargs):
+		"""Run fn(*args, **kwargs) in a thread of the pool. Returns a concurrent.futures.Future"""
+		return self.executor.submit(fn, *args, **kwargs)
+
+	def get_routing_optimizer_worker(self, executable, log_filename, num_generations, num_finetune_generations):
+		"""
+		Get the routing optimizer worker of the calling pool thread with these settings, starting it on first use.
+		log_filename is ignored if the executor has a log file of its own
+		"""
+		workers = getattr(self.thread_local, 'workers', None)
+		if workers is None:
+			workers = self.thread_local.workers = {}
+		if self.log_filename is not None:
+			log_filename = self.log_filename
+		key = (executable, log_filename, num_generations, num_finetune_generations)
+		if key not in workers:
+			workers[key] = RoutingOptimizerWorker(executable, log_filename, num_generations, num_finetune_generations, max(1, (os.cpu_count() or 1)//self.max_workers))
+			with self.lock:
+				self.workers.append(workers[key])
+		return workers[key]
+
+	def shutdown(self):
+		"""Wait for the submitted requests, and stop the threads and the routing optimizer processes"""
+		self.executor.shutdown()
+		with self.lock:
+			for worker in self.workers:
+				worker.close()
+			self.workers = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.shutdown()
+
+
+def get_current_routing_executor():
+	"""The routing executor whose pool thread is calling, or None"""
+	return getattr(current, 'routing_executor', None)
+
+def run_interleaved(sims):
+	"""
+	Run simulations in this process, each until it has to wait for routes that are still being optimized, then others.
+	For the routing to overlap, the simulations should have config 'async_routing' and share config 'routing_executor'
+	"""
+	runs = {sim: sim.run_steps() for sim in sims}
+	waiting = {} # Simulation: the routing future it waits for
+	ready = list(sims)
+	while len(ready) > 0 or len(waiting) > 0:
+		for sim in ready:
+			future = next(runs[sim], None)
+			if future is not None:
+				waiting[sim] = future
+		if len(waiting) == 0:
+			break
+		done, _ = concurrent.futures.wait(waiting.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+		ready = [sim for sim, future in waiting.items() if future in done]
+		for sim in ready:
+			del waiting[sim]
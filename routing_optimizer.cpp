@@ -17,6 +17,13 @@
 #include <omp.h>
 #include <coroutine>
 #include <sstream>
+#include <stdexcept>
+#ifdef _WIN32
+#include <io.h>
+#include <fcntl.h>
+#else
+#include <unistd.h>
+#endif
 #include "fschuetz04/simcpp20.hpp"
 #include "nlohmann/json.hpp"
 using json = nlohmann::json;
@@ -96,6 +103,8 @@ struct RoutingInput
   std::vector<RoutingInputVehicle> vehicles;
   std::vector<std::vector<float>> distance_matrix;
   std::vector<std::vector<float>> duration_matrix;
+  // Optional plan to start the optimization from: routes by day and vehicle. Empty for a random start
+  std::vector<std::vector<std::vector<int>>> starting_plan;
 
   // Will be calculated from the above:
   int output_num_days;
@@ -116,6 +125,15 @@ void from_json(const json &j, RoutingInput &x)
   j.at("vehicles").get_to(x.vehicles);
   j.at("distance_matrix").get_to(x.distance_matrix);
   j.at("duration_matrix").get_to(x.duration_matrix);
+  x.starting_plan.clear();
+  if (j.contains("starting_plan")) {
+    for (auto &day: j.at("starting_plan").at("days")) {
+      x.starting_plan.emplace_back();
+      for (auto &vehicle: day.at("vehicles")) {
+        x.starting_plan.back().push_back(vehicle.at("route").get<std::vector<int>>());
+      }
+    }
+  }
 }
 
 // Store location indexes and location types for easy access
@@ -165,6 +183,9 @@ struct RoutingOutputDay {
 
 struct RoutingOutput {
   std::vector<RoutingOutputDay> days;
+  // Optimization statistics, not in the JSON output
+  int num_generations = 0;
+  double cost = 0;
   RoutingOutput(RoutingInput &routingInput): days(routingInput.sim_duration_days, routingInput) {}
 };
 
@@ -454,37 +475,75 @@ double LogisticsSimulation::costFunction(const std::vector<int16_t> &genome, dou
 LogisticsSimulation::LogisticsSimulation(RoutingInput &routingInput):
 routingInput(routingInput), routingOutput(routingInput), vehicles(routingInput.vehicles.size()), pickupSites(routingInput.pickup_sites.size()) {}
 
-int main() {
-  // Read routing optimization input
-  std::ifstream f("temp/routing_input.json");
-  auto routingInputJson = json::parse(f);
-  auto routingInput = routingInputJson.get<RoutingInput>();
-  // Preprocess routing optimization input
-  preprocess_routing_input(routingInput);
+// Encode a plan of routes by day and vehicle as a genome, for starting the optimization from it. The plan is repaired
+// to fit the genome: visits to a pickup site beyond its number of visits in the genome, which depends on its current
+// level, and visits to other locations such as depots mid-route are dropped. Days and vehicles missing from the plan
+// get empty routes.
+std::vector<int16_t> planToGenome(RoutingInput &routingInput, const std::vector<std::vector<std::vector<int>>> &plan) {
+  // Genes of each pickup site are consecutive. Find the next unused gene and the end of the genes of each site
+  std::vector<int> nextGene(routingInput.pickup_sites.size(), 0);
+  std::vector<int> endGene(routingInput.pickup_sites.size(), 0);
+  for (int gene = routingInput.num_pickup_site_visits_in_genome - 1; gene >= 0; gene--) {
+    nextGene[routingInput.gene_to_pickup_site_index[gene]] = gene;
+    if (endGene[routingInput.gene_to_pickup_site_index[gene]] == 0) endGene[routingInput.gene_to_pickup_site_index[gene]] = gene + 1;
+  }
+  std::vector<int16_t> genome;
+  genome.reserve(routingInput.num_genes);
+  int nextBreakGene = routingInput.num_pickup_site_visits_in_genome;
+  for (int day = 0; day < routingInput.output_num_days; day++) {
+    for (int vehicleIndex = 0; vehicleIndex < routingInput.vehicles.size(); vehicleIndex++) {
+      if (day < plan.size() && vehicleIndex < plan[day].size()) {
+        for (int locationIndex: plan[day][vehicleIndex]) {
+          if (locationIndex < 0 || locationIndex >= routingInput.location_index_info.size() || routingInput.location_index_info[locationIndex].locationType != LOCATION_TYPE_PICKUP_SITE) continue;
+          int pickupSiteIndex = routingInput.location_index_info[locationIndex].specific_index;
+          if (routingInput.pickup_sites[pickupSiteIndex].location_index != locationIndex || nextGene[pickupSiteIndex] >= endGene[pickupSiteIndex]) continue;
+          genome.push_back(nextGene[pickupSiteIndex]++);
+        }
+      }
+      genome.push_back(nextBreakGene++); // End of route
+    }
+  }
+  // Unused pickup site visits go after the last route
+  for (int pickupSiteIndex = 0; pickupSiteIndex < routingInput.pickup_sites.size(); pickupSiteIndex++) {
+    for (int gene = nextGene[pickupSiteIndex]; gene < endGene[pickupSiteIndex]; gene++) genome.push_back(gene);
+  }
+  return genome;
+}
+
+// Optimize routes, starting from routingInput.starting_plan if not empty. Each of the two phases of the optimization
+// ends early if maxStallGenerations > 0 and the best cost has not improved for that many generations. Returns the
+// routing output of the best genome found.
+RoutingOutput optimizeRoutes(RoutingInput &routingInput, int numGenerations, int numFinetuneGenerations, int maxStallGenerations = 0) {
   std::vector<HasCostFunction<int16_t>*> logisticsSims;
   for (int i = 0; i < omp_get_max_threads(); i++) {
     logisticsSims.push_back(new LogisticsSimulation(routingInput));
   }
 
-  // Uncomment the following two lines to start optimization from a starting point
-  //std::vector<int16_t> startingPoint = {130,86,59,68,99,101,82,75,79,76,72,84,80,94,28,25,111,30,120,12,6,18,0,2,126,114,104,36,138,117,48,63,67,34,89,93,53,23,90,96,46,41,40,108,43,103,134,132,136,122,137,139,142,143,128,133,129,118,125,131,123,135,116,140,119,121,141,127,124,92,5,100,71,74,85,39,22,81,61,51,113,95,73,106,70,88,11,91,112,109,31,54,16,19,97,98,29,21,57,8,47,58,10,27,7,45,52,32,9,24,55,3,13,87,1,17,115,83,65,37,26,56,60,4,102,105,77,44,49,110,50,20,33,107,69,62,14,35,15,64,38,42,78,66};
-  //Optimizer<int16_t> optimizer(routingInput.num_genes, logisticsSims, -1, startingPoint);
-
-  // Uncomment the following line to start from a random population
-  Optimizer<int16_t> optimizer(routingInput.num_genes, logisticsSims);
+  // Start from the starting plan, in an otherwise random population, or from a random population
+  std::optional<std::vector<int16_t>> startingPoint;
+  if (!routingInput.starting_plan.empty()) startingPoint = planToGenome(routingInput, routingInput.starting_plan);
+  Optimizer<int16_t> optimizer(routingInput.num_genes, logisticsSims, -1, startingPoint);
 
-  int numGenerations = 40000; // 40000
-  int numFinetuneGenerations = 20000; // 20000
   int numGenerationsPerStep = 100;
 
   int generationIndex = 0;
-  for (; generationIndex < numGenerations; generationIndex += numGenerationsPerStep) {
-    if (debug >= 1) printf("%d,%f\n", generationIndex, optimizer.best.cost);
-    optimizer.optimize(numGenerationsPerStep, false);
-  }
-  for (; generationIndex < numGenerations + numFinetuneGenerations; generationIndex += numGenerationsPerStep) {
-    if (debug >= 1) printf("%d,%f\n", generationIndex, optimizer.best.cost);
-    optimizer.optimize(numGenerationsPerStep, true);
+  for (int phase = 0; phase < 2; phase++) {
+    bool greedy = phase == 1;
+    int phaseEnd = generationIndex + (greedy ? numFinetuneGenerations : numGenerations);
+    int lastImprovementGenerationIndex = generationIndex;
+    double lastImprovementCost = optimizer.best.cost;
+    for (; generationIndex < phaseEnd; generationIndex += numGenerationsPerStep) {
+      if (debug >= 1) printf("%d,%f\n", generationIndex, optimizer.best.cost);
+      optimizer.optimize(numGenerationsPerStep, greedy);
+      if (optimizer.best.cost < lastImprovementCost*(1 - 1e-6)) {
+        lastImprovementGenerationIndex = generationIndex + numGenerationsPerStep;
+        lastImprovementCost = optimizer.best.cost;
+      } else if (maxStallGenerations > 0 && generationIndex + numGenerationsPerStep - lastImprovementGenerationIndex >= maxStallGenerations) {
+        generationIndex += numGenerationsPerStep;
+        if (debug >= 1) printf("Stalled after %d generations\n", generationIndex);
+        break;
+      }
+    }
   }
   if (debug >= 1) printf("%d,%f\n", generationIndex, optimizer.best.cost);
 
@@ -504,12 +563,182 @@ int main() {
     printf("%d,", genome[i]);
   }
   printf("\n\n");
+  fflush(stdout);
   LogisticsSimulation logisticsSim(routingInput);
   logisticsSim.costFunction(genome); // Get routeStartLoci
-  json j = logisticsSim.routingOutput;
+  logisticsSim.routingOutput.num_generations = generationIndex;
+  logisticsSim.routingOutput.cost = optimizer.best.cost;
+  return logisticsSim.routingOutput;
+}
+
+// Server mode binary protocol. All values are little-endian int32 or float32. Each request starts with a message type.
+// The static distance and duration matrixes are sent once, and each routing request only sends the pickup sites,
+// depots, terminals and vehicles.
+enum ServerMessageType {SERVER_MESSAGE_QUIT = 0, SERVER_MESSAGE_SET_MATRIXES = 1, SERVER_MESSAGE_ROUTE = 2};
+
+template<class T> T readValue(FILE *in) {
+  T value;
+  if (fread(&value, sizeof(T), 1, in) != 1) throw std::runtime_error("Unexpected end of input");
+  return value;
+}
+
+template<class T> std::vector<T> readArray(FILE *in, int n) {
+  std::vector<T> values(n);
+  if (n > 0 && fread(values.data(), sizeof(T), n, in) != (size_t)n) throw std::runtime_error("Unexpected end of input");
+  return values;
+}
+
+template<class T> void writeValue(FILE *out, T value) {
+  fwrite(&value, sizeof(T), 1, out);
+}
+
+// SET_MATRIXES: int32 n, float32 distance_matrix[n*n], float32 duration_matrix[n*n]. Reply: int32 0
+void serverSetMatrixes(FILE *in, FILE *out, RoutingInput &routingInput) {
+  int n = readValue<int32_t>(in);
+  routingInput.distance_matrix.assign(n, std::vector<float>(n));
+  routingInput.duration_matrix.assign(n, std::vector<float>(n));
+  for (int i = 0; i < n; i++) {
+    if (fread(routingInput.distance_matrix[i].data(), sizeof(float), n, in) != (size_t)n) throw std::runtime_error("Unexpected end of input");
+  }
+  for (int i = 0; i < n; i++) {
+    if (fread(routingInput.duration_matrix[i].data(), sizeof(float), n, in) != (size_t)n) throw std::runtime_error("Unexpected end of input");
+  }
+  writeValue<int32_t>(out, 0);
+  fflush(out);
+}
+
+// ROUTE:
+//   int32 num_pickup_sites, float32 capacity[], float32 level[], float32 growth_rate[], int32 location_index[]
+//   int32 num_depots, int32 location_index[]
+//   int32 num_terminals, int32 location_index[]
+//   int32 num_vehicles, float32 load_capacity[], int32 home_depot_index[], int32 max_route_duration[]
+//   int32 num_generations, int32 num_finetune_generations, int32 max_stall_generations (0 = run all generations)
+//   int32 num_starting_plan_days (0 = random start), int32 num_starting_plan_vehicles, then for each day and vehicle:
+//   int32 route_length, int32 route[route_length]
+// Reply: int32 num_generations_run, float32 cost, int32 num_days, int32 num_vehicles, then for each day and vehicle:
+//   int32 route_length, int32 route[route_length]
+void serverRoute(FILE *in, FILE *out, RoutingInput &routingInput) {
+  int numPickupSites = readValue<int32_t>(in);
+  std::vector<float> capacities = readArray<float>(in, numPickupSites);
+  std::vector<float> levels = readArray<float>(in, numPickupSites);
+  std::vector<float> growthRates = readArray<float>(in, numPickupSites);
+  std::vector<int32_t> pickupSiteLocationIndexes = readArray<int32_t>(in, numPickupSites);
+  routingInput.pickup_sites.resize(numPickupSites);
+  for (int i = 0; i < numPickupSites; i++) {
+    routingInput.pickup_sites[i].capacity = capacities[i];
+    routingInput.pickup_sites[i].level = levels[i];
+    routingInput.pickup_sites[i].growth_rate = growthRates[i];
+    routingInput.pickup_sites[i].location_index = pickupSiteLocationIndexes[i];
+  }
+  int numDepots = readValue<int32_t>(in);
+  std::vector<int32_t> depotLocationIndexes = readArray<int32_t>(in, numDepots);
+  routingInput.depots.resize(numDepots);
+  for (int i = 0; i < numDepots; i++) routingInput.depots[i].location_index = depotLocationIndexes[i];
+  int numTerminals = readValue<int32_t>(in);
+  std::vector<int32_t> terminalLocationIndexes = readArray<int32_t>(in, numTerminals);
+  routingInput.terminals.resize(numTerminals);
+  for (int i = 0; i < numTerminals; i++) routingInput.terminals[i].location_index = terminalLocationIndexes[i];
+  int numVehicles = readValue<int32_t>(in);
+  std::vector<float> loadCapacities = readArray<float>(in, numVehicles);
+  std::vector<int32_t> homeDepotIndexes = readArray<int32_t>(in, numVehicles);
+  std::vector<int32_t> maxRouteDurations = readArray<int32_t>(in, numVehicles);
+  routingInput.vehicles.resize(numVehicles);
+  for (int i = 0; i < numVehicles; i++) {
+    routingInput.vehicles[i].load_capacity = loadCapacities[i];
+    routingInput.vehicles[i].home_depot_index = homeDepotIndexes[i];
+    routingInput.vehicles[i].max_route_duration = maxRouteDurations[i];
+  }
+  int numGenerations = readValue<int32_t>(in);
+  int numFinetuneGenerations = readValue<int32_t>(in);
+  int maxStallGenerations = readValue<int32_t>(in);
+  int numStartingPlanDays = readValue<int32_t>(in);
+  int numStartingPlanVehicles = readValue<int32_t>(in);
+  routingInput.starting_plan.assign(numStartingPlanDays, std::vector<std::vector<int>>(numStartingPlanVehicles));
+  for (auto &day: routingInput.starting_plan) {
+    for (auto &route: day) {
+      int routeLength = readValue<int32_t>(in);
+      std::vector<int32_t> locationIndexes = readArray<int32_t>(in, routeLength);
+      route.assign(locationIndexes.begin(), locationIndexes.end());
+    }
+  }
+
+  // Clear anything calculated for a previous request
+  routingInput.gene_to_pickup_site_index.clear();
+  routingInput.location_index_info.clear();
+  preprocess_routing_input(routingInput);
+  RoutingOutput routingOutput = optimizeRoutes(routingInput, numGenerations, numFinetuneGenerations, maxStallGenerations);
+
+  writeValue<int32_t>(out, routingOutput.num_generations);
+  writeValue<float>(out, (float)routingOutput.cost);
+  writeValue<int32_t>(out, routingOutput.days.size());
+  writeValue<int32_t>(out, numVehicles);
+  for (auto &day: routingOutput.days) {
+    for (auto &vehicle: day.vehicles) {
+      writeValue<int32_t>(out, vehicle.route.size());
+      for (int locationIndex: vehicle.route) writeValue<int32_t>(out, locationIndex);
+    }
+  }
+  fflush(out);
+}
+
+// Serve routing requests from stdin until quit or end of input. Replies are written to the original stdout, and
+// anything printed is redirected to stderr.
+int runServer() {
+#ifdef _WIN32
+  _setmode(_fileno(stdin), _O_BINARY);
+  FILE *out = _fdopen(_dup(_fileno(stdout)), "wb");
+  _setmode(_fileno(out), _O_BINARY);
+  _dup2(_fileno(stderr), _fileno(stdout));
+#else
+  FILE *out = fdopen(dup(fileno(stdout)), "wb");
+  dup2(fileno(stderr), fileno(stdout));
+#endif
+  FILE *in = stdin;
+  RoutingInput routingInput;
+  try {
+    while (true) {
+      int32_t messageType;
+      if (fread(&messageType, sizeof(int32_t), 1, in) != 1 || messageType == SERVER_MESSAGE_QUIT) break;
+      switch (messageType) {
+        case SERVER_MESSAGE_SET_MATRIXES:
+          serverSetMatrixes(in, out, routingInput);
+          break;
+        case SERVER_MESSAGE_ROUTE:
+          serverRoute(in, out, routingInput);
+          break;
+        default:
+          fprintf(stderr, "Unknown message type %d\n", messageType);
+          return 1;
+      }
+    }
+  } catch (std::exception &e) {
+    fprintf(stderr, "Error: %s\n", e.what());
+    return 1;
+  }
+  return 0;
+}
+
+int main(int argc, char *argv[]) {
+  // Run as a persistent worker process
+  if (argc > 1 && std::string(argv[1]) == "--server") {
+    return runServer();
+  }
+
+  // Read routing optimization input
+  std::ifstream f("temp/routing_input.json");
+  auto routingInputJson = json::parse(f);
+  auto routingInput = routingInputJson.get<RoutingInput>();
+  // Preprocess routing optimization input
+  preprocess_routing_input(routingInput);
+
+  int numGenerations = 40000; // 40000
+  int numFinetuneGenerations = 20000; // 20000
+  RoutingOutput routingOutput = optimizeRoutes(routingInput, numGenerations, numFinetuneGenerations);
+
+  json j = routingOutput;
   std::ofstream o("temp/routing_output.json");
   o << std::setw(4) << j << std::endl;
 
   return 0;
 
-}
\ No newline at end of file
+}
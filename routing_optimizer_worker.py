@@ -0,0 +1,136 @@
+import os
+import shutil
+import subprocess
+import numpy as np
+
+# Message types of the routing optimizer server mode binary protocol, see routing_optimizer.cpp
+SERVER_MESSAGE_QUIT = 0
+SERVER_MESSAGE_SET_MATRIXES = 1
+SERVER_MESSAGE_ROUTE = 2
+
+def find_routing_optimizer(executable = 'routing_optimizer'):
+	"""Find the routing optimizer executable, in the current directory or in PATH"""
+	for candidate in (executable, executable + '.exe'):
+		if os.path.isfile(candidate):
+			return os.path.abspath(candidate)
+	found = shutil.which(executable)
+	return found if found is not None else executable
+
+def is_same_matrix(a, b):
+	"""Whether two matrixes are the same object, or NumPy views of the same data"""
+	if a is b:
+		return True
+	return isinstance(a, np.ndarray) and isinstance(b, np.ndarray) and a.shape == b.shape and a.dtype == b.dtype and a.__array_interface__['data'][0] == b.__array_interface__['data'][0]
+
+
+# A long-lived routing optimizer process that communicates through a binary pipe protocol. The static distance and
+# duration matrixes are sent once, and each routing request only sends the pickup site levels and the fleet. They are
+# sent again if a request has other matrixes, so that a worker can serve simulations of different location sets.
+class RoutingOptimizerWorker():
+
+	def __init__(self, executable = 'routing_optimizer', log_filename = None, num_generations = 40000, num_finetune_generations = 20000, num_threads = None):
+		"""
+		executable: routing optimizer executable
+		log_filename: file to append the optimizer's printed output to, or None to discard it
+		num_threads: number of OpenMP threads of the optimizer, or None for its default
+		"""
+		self.num_generations = num_generations
+		self.num_finetune_generations = num_finetune_generations
+		if log_filename is not None:
+			if os.path.dirname(log_filename):
+				os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+			self.log_file = open(log_filename, 'ab')
+		else:
+			self.log_file = None
+		self.last_num_generations = None # Generations run and the best cost of the last routing request
+		self.last_cost = None
+		env = {**os.environ, 'OMP_NUM_THREADS': str(num_threads)} if num_threads is not None else None
+		self.process = subprocess.Popen([find_routing_optimizer(executable), '--server'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.log_file if self.log_file is not None else subprocess.DEVNULL, env=env)
+		self.distance_matrix = None # Matrixes in the optimizer process
+		self.duration_matrix = None
+
+	def write_int32(self, *values):
+		self.process.stdin.write(np.array(values, dtype='<i4').tobytes())
+
+	def write_array(self, values, dtype):
+		self.process.stdin.write(memoryview(np.ascontiguousarray(values, dtype=dtype)).cast('B'))
+
+	def read_array(self, count, dtype):
+		num_bytes = np.dtype(dtype).itemsize*count
+		data = self.process.stdout.read(num_bytes)
+		if len(data) != num_bytes:
+			raise RuntimeError(f"Routing optimizer process exited with code {self.process.poll()}, see its log for details")
+		return np.frombuffer(data, dtype=dtype)
+
+	def read_int32(self, count = 1):
+		return self.read_array(count, '<i4')
+
+	def set_matrixes(self, distance_matrix, duration_matrix):
+		"""Send the distance and duration matrixes. They stay in the optimizer process for all later routing requests"""
+		distance_matrix = np.asarray(distance_matrix, dtype='<f4')
+		duration_matrix = np.asarray(duration_matrix, dtype='<f4')
+		self.write_int32(SERVER_MESSAGE_SET_MATRIXES, len(distance_matrix))
+		self.write_array(distance_matrix, '<f4')
+		self.write_array(duration_matrix, '<f4')
+		self.process.stdin.flush()
+		self.read_int32()
+
+	def route(self, routing_input, max_stall_generations = 0):
+		"""
+		Optimize routes. routing_input is as in WastePickupSimulation.daily_routing. Its matrixes are sent only if they
+		are not the ones already sent. An optional routing_input['starting_plan'], routing output of earlier routing, seeds the optimization.
+		max_stall_generations: if > 0, end each optimization phase early when the best cost has not improved for that many
+		generations. Returns routing output {'days': [{'vehicles': [{'route': [location index, ...]}, ...]}, ...]}
+		"""
+		vehicles = routing_input['vehicles']
+		starting_plan_days = routing_input.get('starting_plan', {'days': []})['days']
+		for day_index, day in enumerate(starting_plan_days):
+			# Checked before anything is sent, as the optimizer reads a route for each vehicle of each day
+			if len(day['vehicles']) != len(vehicles):
+				raise ValueError(f"Day {day_index} of the starting plan has {len(day['vehicles'])} vehicles, the routing input has {len(vehicles)}")
+		if not (is_same_matrix(routing_input['distance_matrix'], self.distance_matrix) and is_same_matrix(routing_input['duration_matrix'], self.duration_matrix)):
+			self.set_matrixes(routing_input['distance_matrix'], routing_input['duration_matrix'])
+			self.distance_matrix = routing_input['distance_matrix']
+			self.duration_matrix = routing_input['duration_matrix']
+		pickup_sites = routing_input['pickup_sites']
+		self.write_int32(SERVER_MESSAGE_ROUTE, len(pickup_sites))
+		self.write_array([pickup_site['capacity'] for pickup_site in pickup_sites], '<f4')
+		self.write_array([pickup_site['level'] for pickup_site in pickup_sites], '<f4')
+		self.write_array([pickup_site['growth_rate'] for pickup_site in pickup_sites], '<f4')
+		self.write_array([pickup_site['location_index'] for pickup_site in pickup_sites], '<i4')
+		self.write_int32(len(routing_input['depots']), *[depot['location_index'] for depot in routing_input['depots']])
+		self.write_int32(len(routing_input['terminals']), *[terminal['location_index'] for terminal in routing_input['terminals']])
+		self.write_int32(len(vehicles))
+		self.write_array([vehicle['load_capacity'] for vehicle in vehicles], '<f4')
+		self.write_array([vehicle['home_depot_index'] for vehicle in vehicles], '<i4')
+		self.write_array([vehicle['max_route_duration'] for vehicle in vehicles], '<i4')
+		self.write_int32(self.num_generations, self.num_finetune_generations, max_stall_generations)
+		self.write_int32(len(starting_plan_days), len(vehicles))
+		for day in starting_plan_days:
+			for vehicle in day['vehicles']:
+				self.write_int32(len(vehicle['route']), *vehicle['route'])
+		self.process.stdin.flush()
+
+		self.last_num_generations = int(self.read_int32()[0])
+		self.last_cost = float(self.read_array(1, '<f4')[0])
+		num_days, num_vehicles = self.read_int32(2).tolist()
+		days = []
+		for _ in range(num_days):
+			day_vehicles = []
+			for _ in range(num_vehicles):
+				route_length = int(self.read_int32()[0])
+				day_vehicles.append({'route': self.read_int32(route_length).tolist()})
+			days.append({'vehicles': day_vehicles})
+		return {'days': days}
+
+	def close(self):
+		if self.process.poll() is None:
+			try:
+				self.write_int32(SERVER_MESSAGE_QUIT)
+				self.process.stdin.close()
+			except OSError:
+				pass
+			self.process.wait()
+		if self.log_file is not None:
+			self.log_file.close()
+			self.log_file = None
@@ -0,0 +1,67 @@
+import json
+import os
+import random
+import sys
+import numpy as np
+import waste_pickup_sim
+import plan_evaluator
+from routing_optimizer_worker import RoutingOptimizerWorker
+
+# Check of the plan evaluator against the cost of the C++ routing optimizer for one routing run of the test scenario.
+# The routing optimizer executable can be given as an argument, default 'routing_optimizer'.
+# Run from the repository root: python routing_test.py [routing optimizer executable]
+
+sim_config = {
+	'sim_name': 'Hämeenlinna and nearby regions',
+	'sim_runtime_days': 14,
+	'pickup_sites_filename': 'geo_data/sim_test_sites.geojson',
+	'depots_filename': 'geo_data/sim_test_terminals.geojson',
+	'terminals_filename': 'geo_data/sim_test_terminals.geojson',
+	'vehicle_template': {
+		'load_capacity': 18,
+		'max_route_duration': 8*60 + 15,
+		'pickup_duration': 15
+	},
+	'depots': [
+		{
+			'num_vehicles': 1
+		},
+		{
+			'num_vehicles': 1
+		}
+	],
+	'matrix_backend': 'haversine',
+	'routing_optimizer_path': sys.argv[1] if len(sys.argv) > 1 else 'routing_optimizer',
+	'routing_optimizer_generations': 2000,
+	'routing_optimizer_finetune_generations': 1000,
+	'log_quiet': True,
+	'log_events_to_file': False
+}
+
+def get_routing_input(sim_config):
+	"""Routing input of the start of a simulation of the test scenario"""
+	sim = waste_pickup_sim.WastePickupSimulation(sim_config)
+	return sim.get_routing_input(sim.pickup_site_accumulator.levels)
+
+def test_plan_evaluator(sim_config, routing_input, routing_input_filename = 'temp/routing_input.json', routing_output_filename = 'temp/routing_output.json'):
+	"""The plan evaluator gives the cost of the routing optimizer's best plan"""
+	worker = RoutingOptimizerWorker(sim_config['routing_optimizer_path'], None, sim_config['routing_optimizer_generations'], sim_config['routing_optimizer_finetune_generations'])
+	try:
+		routing_output = worker.route(routing_input)
+	finally:
+		worker.close()
+	with open(routing_input_filename, 'w') as f:
+		json.dump({**routing_input, 'distance_matrix': np.asarray(routing_input['distance_matrix']).tolist(), 'duration_matrix': np.asarray(routing_input['duration_matrix']).tolist()}, f)
+	with open(routing_output_filename, 'w') as f:
+		json.dump(routing_output, f)
+	evaluation = plan_evaluator.evaluate_routing_output_file(routing_input_filename, routing_output_filename)
+	# The optimizer adds up the cost in float32
+	assert abs(evaluation['cost'] - worker.last_cost) <= 1e-4*max(abs(worker.last_cost), 1), f"Plan evaluator cost {evaluation['cost']}, routing optimizer cost {worker.last_cost}"
+	print(f"Plan evaluator matches the routing optimizer: cost {evaluation['cost']:.2f}")
+
+random.seed(42)
+np.random.seed(42)
+os.makedirs('temp', exist_ok=True)
+waste_pickup_sim.preprocess_sim_config(sim_config, 'temp/routing_test_config.json')
+routing_input = get_routing_input(sim_config)
+test_plan_evaluator(sim_config, routing_input)
@@ -0,0 +1,65 @@
+import json
+import numpy as np
+
+from matrix_store import MatrixStore
+
+# Compiled scenario bundle: a preprocessed sim config in one .npz file, with the locations and the pickup site
+# parameters as arrays and the rest of the config as JSON. The distance and duration matrixes are not included, only
+# referred to by their matrix store directory and key, and are memory-mapped from the store when the bundle is loaded.
+# Loading a bundle parses no GeoJSON and fetches nothing, so it suits ensemble workers and short what-if runs.
+
+bundle_version = 1
+
+# Pickup site parameters stored as arrays. Other pickup site fields, such as GeoJSON properties, are stored as JSON
+pickup_site_array_keys = ('capacity', 'level', 'daily_growth_rate', 'location_index')
+
+# Config keys that are stored separately, or not at all
+excluded_keys = ('distance_matrix', 'duration_matrix', 'pickup_sites', 'location_lonlats')
+
+
+def save_scenario_bundle(sim_config, filename):
+	"""Save a sim config preprocessed by waste_pickup_sim.preprocess_sim_config to a scenario bundle file"""
+	if 'matrix_store_key' not in sim_config:
+		raise ValueError("The sim config has no matrix store key, preprocess it first")
+	pickup_sites = sim_config['pickup_sites']
+	arrays = {f"pickup_site_{key}": np.array([pickup_site[key] for pickup_site in pickup_sites]) for key in pickup_site_array_keys}
+	pickup_site_fields = [{key: value for key, value in pickup_site.items() if key not in pickup_site_array_keys and key != 'lonlats'} for pickup_site in pickup_sites]
+	with open(filename, 'wb') as f:
+		np.savez(
+			f,
+			version=bundle_version,
+			config_json=json.dumps({key: value for key, value in sim_config.items() if key not in excluded_keys}),
+			pickup_site_fields_json=json.dumps(pickup_site_fields),
+			location_lonlats=np.asarray(sim_config['location_lonlats'], dtype=np.float64).reshape(-1, 2),
+			**arrays
+		)
+
+def load_scenario_bundle(filename):
+	"""Load a scenario bundle file. Returns a preprocessed sim config, with the matrixes from the matrix store"""
+	with np.load(filename) as bundle:
+		if int(bundle['version']) != bundle_version:
+			raise ValueError(f"Scenario bundle {filename} has version {int(bundle['version'])}, expected {bundle_version}")
+		sim_config = json.loads(str(bundle['config_json']))
+		pickup_site_fields = json.loads(str(bundle['pickup_site_fields_json']))
+		location_lonlats = list(map(tuple, bundle['location_lonlats'].tolist()))
+		pickup_site_arrays = {key: bundle[f"pickup_site_{key}"].tolist() for key in pickup_site_array_keys}
+
+	sim_config['location_lonlats'] = location_lonlats
+	sim_config['pickup_sites'] = [{
+		**fields,
+		'lonlats': location_lonlats[location_index],
+		**{key: pickup_site_arrays[key][index] for key in pickup_site_array_keys}
+	} for index, (fields, location_index) in enumerate(zip(pickup_site_fields, pickup_site_arrays['location_index']))]
+	for x in [*sim_config['terminals'], *sim_config['depots']]:
+		x['lonlats'] = location_lonlats[x['location_index']]
+
+	matrix_store = MatrixStore(sim_config['matrix_store_directory'])
+	if sim_config.get('sparse_matrix_k') is not None:
+		sparse_travel_matrixes = matrix_store.load_sparse(sim_config['matrix_store_key'], sim_config['sparse_matrix_k'])
+		sim_config['distance_matrix'] = sparse_travel_matrixes.distance_matrix
+		sim_config['duration_matrix'] = sparse_travel_matrixes.duration_matrix
+	else:
+		distance_and_duration_matrixes = matrix_store.load(sim_config['matrix_store_key'])
+		sim_config['distance_matrix'] = distance_and_duration_matrixes['distance_matrix']
+		sim_config['duration_matrix'] = distance_and_duration_matrixes['duration_matrix']
+	return sim_config
@@ -0,0 +1,274 @@
+import argparse
+import json
+import math
+import os
+import numpy as np
+
+from haversine_matrix import earth_radius
+
+# Synthetic large scenarios inside an area polygon, such as geo_data/sim_test_area.geojson. Pickup sites, depots and
+# terminals are sampled uniformly inside the area, vectorised by rejection sampling in blocks. Optionally the density
+# follows population: the area features are weighted by a population property, and a fraction of the sites is
+# clustered around population centers. Pickup site capacities, daily growth rates and levels are drawn from the same
+# distributions as in waste_pickup_sim.preprocess_sim_config, with a seeded random number generator, and written as
+# GeoJSON properties that preprocessing keeps. The files have the schemas of the test area GeoJSON files. Matrixes are
+# built by preprocessing with the haversine backend, streamed in blocks into the matrix store, and sparse for large
+# numbers of locations.
+
+# Largest number of locations with full matrixes by default, about 1.6 GB per float32 matrix
+max_dense_locations = 20000
+default_sparse_matrix_k = 50
+
+
+def parse_number(value):
+	"""Parse a number property, also in the format of the area GeoJSON, for example '8 847' or '389,31'"""
+	if isinstance(value, str):
+		value = value.replace('\xa0', '').replace(' ', '').replace(',', '.')
+	return float(value)
+
+def load_area(filename):
+	"""Load the features of an area GeoJSON file of Polygon and MultiPolygon geometries. Returns [{'rings', 'properties'}, ...]"""
+	with open(filename) as f:
+		area_geojson = json.load(f)
+	area_features = []
+	for feature in area_geojson['features']:
+		geometry = feature['geometry']
+		polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+		area_features.append({
+			'rings': [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon],
+			'properties': feature['properties']
+		})
+	return area_features
+
+def points_in_rings(lonlats, rings, max_block_elements = 1 << 22):
+	"""Whether each point is inside the rings, by the even-odd rule, so that holes are outside"""
+	inside = np.zeros(len(lonlats), dtype=bool)
+	for ring in rings:
+		start = ring
+		end = np.roll(ring, -1, axis=0)
+		block_size = max(1, max_block_elements // len(ring))
+		for block_start in range(0, len(lonlats), block_size):
+			x = lonlats[block_start:block_start + block_size, 0:1]
+			y = lonlats[block_start:block_start + block_size, 1:2]
+			# Crossings of a ray from each point in the +x direction with the edges
+			straddles = (start[:, 1] > y) != (end[:, 1] > y)
+			with np.errstate(divide='ignore', invalid='ignore'):
+				crossing_x = start[:, 0] + (y - start[:, 1])*(end[:, 0] - start[:, 0])/(end[:, 1] - start[:, 1])
+			inside[block_start:block_start + block_size] ^= (np.count_nonzero(straddles & (x < crossing_x), axis=1) % 2).astype(bool)
+	return inside
+
+def points_in_area(lonlats, area_features):
+	inside = np.zeros(len(lonlats), dtype=bool)
+	for area_feature in area_features:
+		inside |= points_in_rings(lonlats, area_feature['rings'])
+	return inside
+
+def get_bounds(area_features):
+	all_points = np.concatenate([ring for area_feature in area_features for ring in area_feature['rings']])
+	return all_points.min(axis=0), all_points.max(axis=0)
+
+def get_area(area_feature):
+	"""Area of a feature in km^2, by the shoelace formula in a local equirectangular projection"""
+	area = 0
+	for ring in area_feature['rings']:
+		x = np.radians(ring[:, 0])*np.cos(np.radians(ring[:, 1].mean()))*earth_radius/1000
+		y = np.radians(ring[:, 1])*earth_radius/1000
+		area += (x*np.roll(y, -1) - np.roll(x, -1)*y).sum()/2
+	# Holes wind opposite to their outer rings
+	return abs(area)
+
+def sample_uniform(rng, area_features, num_points, max_block_size = 1 << 18, max_attempts = 1000):
+	"""
+	Sample points uniformly inside the area features, by rejection sampling in their bounding box. Raises ValueError if
+	max_attempts blocks of candidates are not enough
+	"""
+	(min_lon, min_lat), (max_lon, max_lat) = get_bounds(area_features)
+	min_y, max_y = math.sin(math.radians(min_lat)), math.sin(math.radians(max_lat))
+	points = []
+	num_sampled = 0
+	acceptance = 0.5
+	for _ in range(max_attempts):
+		if num_sampled >= num_points:
+			break
+		block_size = min(max_block_size, int((num_points - num_sampled)/acceptance*1.1) + 16)
+		# Uniform in the sine of latitude is uniform in area
+		candidates = np.column_stack([
+			rng.uniform(min_lon, max_lon, block_size),
+			np.degrees(np.arcsin(rng.uniform(min_y, max_y, block_size)))
+		])
+		accepted = candidates[points_in_area(candidates, area_features)]
+		acceptance = max(len(accepted)/block_size, 0.01)
+		points.append(accepted[:num_points - num_sampled])
+		num_sampled += len(points[-1])
+	else:
+		if num_sampled < num_points:
+			raise ValueError(f"Only {num_sampled} of {num_points} points sampled inside the area in {max_attempts} attempts, is the area empty?")
+	return np.concatenate(points) if len(points) > 0 else np.empty((0, 2))
+
+def sample_clustered(rng, area_features, num_points, center_lonlats, center_weights, scale_km, max_block_size = 1 << 18, max_attempts = 1000):
+	"""
+	Sample points inside the area features around centers chosen by weight, with normal offsets of scale_km. Raises
+	ValueError if max_attempts blocks of candidates are not enough
+	"""
+	center_lonlats = np.asarray(center_lonlats, dtype=np.float64).reshape(-1, 2)
+	center_probabilities = np.asarray(center_weights, dtype=np.float64)/np.sum(center_weights)
+	points = []
+	num_sampled = 0
+	for _ in range(max_attempts):
+		if num_sampled >= num_points:
+			break
+		block_size = min(max_block_size, 2*(num_points - num_sampled) + 16)
+		centers = center_lonlats[rng.choice(len(center_lonlats), size=block_size, p=center_probabilities)]
+		offsets = rng.normal(0, np.degrees(scale_km*1000/earth_radius), size=(block_size, 2))
+		offsets[:, 0] /= np.cos(np.radians(centers[:, 1]))
+		candidates = centers + offsets
+		accepted = candidates[points_in_area(candidates, area_features)]
+		points.append(accepted[:num_points - num_sampled])
+		num_sampled += len(points[-1])
+	else:
+		if num_sampled < num_points:
+			raise ValueError(f"Only {num_sampled} of {num_points} points sampled inside the area around the centers in {max_attempts} attempts, are the centers far outside the area?")
+	return np.concatenate(points) if len(points) > 0 else np.empty((0, 2))
+
+def sample_locations(rng, area_features, num_points, weight_property = None, center_lonlats = None, center_weights = None, clustered_fraction = 0.8, scale_km = 3):
+	"""
+	Sample locations inside the area. With weight_property, the number of locations of each area feature is by that
+	property, for example population, instead of by area. With centers, clustered_fraction of the locations are
+	clustered around them. Returns (location lonlats, area feature index of each location)
+	"""
+	num_clustered = int(round(num_points*clustered_fraction)) if center_lonlats is not None and len(center_lonlats) > 0 else 0
+	weights = np.array([parse_number(area_feature['properties'][weight_property]) if weight_property is not None else get_area(area_feature) for area_feature in area_features])
+	counts = rng.multinomial(num_points - num_clustered, weights/weights.sum())
+	lonlats = [sample_uniform(rng, [area_feature], count) for area_feature, count in zip(area_features, counts)]
+	if num_clustered > 0:
+		lonlats.append(sample_clustered(rng, area_features, num_clustered, center_lonlats, center_weights if center_weights is not None else np.ones(len(center_lonlats)), scale_km))
+	lonlats = np.concatenate(lonlats)
+	lonlats = lonlats[rng.permutation(len(lonlats))]
+	# Area feature of each location, the first that contains it
+	feature_indexes = np.full(len(lonlats), -1)
+	for feature_index, area_feature in reversed(list(enumerate(area_features))):
+		feature_indexes[points_in_rings(lonlats, area_feature['rings'])] = feature_index
+	return lonlats, feature_indexes
+
+def sample_pickup_site_parameters(rng, num_pickup_sites):
+	"""Capacity, daily growth rate and level of pickup sites, from the distributions of preprocess_sim_config"""
+	capacity = rng.integers(1, 4, num_pickup_sites)
+	daily_growth_rate = capacity*rng.lognormal(np.log(1 / ((14 + 21) / 2)), 0.1, num_pickup_sites) # Log-normal dist of 2 to 3 weeks to be full.
+	level = capacity*rng.uniform(0, 0.8, num_pickup_sites)
+	return capacity, daily_growth_rate, level
+
+def write_feature_collection(filename, name, lonlats, properties, crs = 'urn:ogc:def:crs:OGC:1.3:CRS84'):
+	"""Write points and their properties to a GeoJSON file, in the schema of the test area files. crs: CRS name, or None for none"""
+	feature_collection = {
+		'type': 'FeatureCollection',
+		'name': name
+	}
+	if crs is not None:
+		feature_collection['crs'] = {'type': 'name', 'properties': {'name': crs}}
+	with open(filename, 'w') as f:
+		json.dump({
+			**feature_collection,
+			'features': [{
+				'type': 'Feature',
+				'properties': feature_properties,
+				'geometry': {'type': 'Point', 'coordinates': lonlat}
+			} for lonlat, feature_properties in zip(np.round(lonlats, 7).tolist(), properties)]
+		}, f, ensure_ascii=False)
+
+def load_points(filename, weight_property = None):
+	"""Load the lonlats of the points of a GeoJSON file, and their weights by a property, default 1. Returns (lonlats, weights)"""
+	with open(filename) as f:
+		features = json.load(f)['features']
+	lonlats = np.array([feature['geometry']['coordinates'][:2] for feature in features], dtype=np.float64).reshape(-1, 2)
+	weights = np.array([parse_number(feature['properties'][weight_property]) if weight_property is not None else 1 for feature in features], dtype=np.float64)
+	return lonlats, weights
+
+def generate_scenario(directory, num_pickup_sites, num_vehicles, num_depots = 2, num_terminals = 2, sim_runtime_days = 14, area_filename = 'geo_data/sim_test_area.geojson', seed = 0, weight_property = None, population_centers_filename = None, population_center_weight_property = None, clustered_fraction = 0.8, cluster_scale_km = 3, sparse_matrix_k = None):
+	"""
+	Write GeoJSON files of a synthetic scenario to directory. The pickup sites, depots and terminals are sampled inside
+	the area, clustered around the points of population_centers_filename if given. sparse_matrix_k defaults to
+	default_sparse_matrix_k above max_dense_locations locations. Returns a sim config for preprocess_sim_config
+	"""
+	rng = np.random.default_rng(seed)
+	area_features = load_area(area_filename)
+	center_lonlats = center_weights = None
+	if population_centers_filename is not None:
+		center_lonlats, center_weights = load_points(population_centers_filename, population_center_weight_property)
+	def sample(num_points):
+		return sample_locations(rng, area_features, num_points, weight_property, center_lonlats, center_weights, clustered_fraction, cluster_scale_km)
+
+	pickup_site_lonlats, feature_indexes = sample(num_pickup_sites)
+	capacity, daily_growth_rate, level = sample_pickup_site_parameters(rng, num_pickup_sites)
+	municipalities = [area_feature['properties'].get('Kunta') for area_feature in area_features]
+	pickup_site_properties = [{
+		'ID': f"G-{index:06d}",
+		'Kunta': municipalities[feature_index] if feature_index >= 0 else None,
+		'capacity': site_capacity,
+		'daily_growth_rate': site_daily_growth_rate,
+		'level': site_level
+	} for index, (feature_index, site_capacity, site_daily_growth_rate, site_level) in enumerate(zip(feature_indexes.tolist(), capacity.tolist(), daily_growth_rate.tolist(), level.tolist()))]
+	depot_lonlats, _ = sample(num_depots)
+	terminal_lonlats, _ = sample(num_terminals)
+
+	os.makedirs(directory, exist_ok=True)
+	pickup_sites_filename = os.path.join(directory, 'sites.geojson')
+	depots_filename = os.path.join(directory, 'depots.geojson')
+	terminals_filename = os.path.join(directory, 'terminals.geojson')
+	write_feature_collection(pickup_sites_filename, 'sites', pickup_site_lonlats, pickup_site_properties)
+	write_feature_collection(depots_filename, 'depots', depot_lonlats, [{'name': f"Depot {index}"} for index in range(num_depots)])
+	write_feature_collection(terminals_filename, 'terminals', terminal_lonlats, [{'name': f"Terminal {index}"} for index in range(num_terminals)])
+
+	if sparse_matrix_k is None and num_pickup_sites + num_depots + num_terminals > max_dense_locations:
+		sparse_matrix_k = default_sparse_matrix_k
+	return {
+		'sim_name': f"Synthetic {num_pickup_sites} sites {num_vehicles} vehicles seed {seed}",
+		'sim_runtime_days': sim_runtime_days,
+		'pickup_sites_filename': pickup_sites_filename,
+		'depots_filename': depots_filename,
+		'terminals_filename': terminals_filename,
+		'vehicle_template': {
+			'load_capacity': 18,
+			'max_route_duration': 8*60 + 15,
+			'pickup_duration': 15
+		},
+		'depots': [{'num_vehicles': num_vehicles//num_depots + (1 if index < num_vehicles % num_depots else 0)} for index in range(num_depots)],
+		'matrix_backend': 'haversine',
+		'matrix_store_dir': os.path.join(directory, 'matrix_store'),
+		'sparse_matrix_k': sparse_matrix_k,
+		'router': 'heuristic' if sparse_matrix_k is not None else 'genetic',
+		'seed': seed,
+		'log_dir': os.path.join(directory, 'log')
+	}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate a synthetic waste pickup scenario inside an area polygon, preprocess it and save it as a scenario bundle')
+	parser.add_argument('directory', help='output directory')
+	parser.add_argument('--num-pickup-sites', type=int, default=1000)
+	parser.add_argument('--num-vehicles', type=int, help='default one per 30 pickup sites')
+	parser.add_argument('--num-depots', type=int, default=2)
+	parser.add_argument('--num-terminals', type=int, default=2)
+	parser.add_argument('--sim-runtime-days', type=int, default=14)
+	parser.add_argument('--area', default='geo_data/sim_test_area.geojson', help='area GeoJSON file')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--weight-property', help='area feature property to distribute the sites by, for example Asukasluku (population). Default by area')
+	parser.add_argument('--population-centers', help='GeoJSON file of points to cluster the sites around, for example geo_data/sim_test_terminals.geojson')
+	parser.add_argument('--population-center-weight-property', help='point property to weight the population centers by. Default equal weights')
+	parser.add_argument('--clustered-fraction', type=float, default=0.8, help='fraction of the sites clustered around the population centers')
+	parser.add_argument('--cluster-scale-km', type=float, default=3, help='standard deviation of the distance of clustered sites from their center')
+	parser.add_argument('--sparse-matrix-k', type=int, help=f"number of nearest neighbours of sparse matrixes, default {default_sparse_matrix_k} above {max_dense_locations} locations and full matrixes otherwise")
+	args = parser.parse_args()
+
+	import random
+	import waste_pickup_sim
+	import scenario_bundle
+	sim_config = generate_scenario(
+		args.directory, args.num_pickup_sites, args.num_vehicles or max(1, round(args.num_pickup_sites/30)), args.num_depots, args.num_terminals,
+		args.sim_runtime_days, args.area, args.seed, args.weight_property, args.population_centers, args.population_center_weight_property,
+		args.clustered_fraction, args.cluster_scale_km, args.sparse_matrix_k
+	)
+	random.seed(args.seed)
+	np.random.seed(args.seed)
+	waste_pickup_sim.preprocess_sim_config(sim_config, os.path.join(args.directory, 'sim_preprocessed_config.json'))
+	scenario_bundle.save_scenario_bundle(sim_config, os.path.join(args.directory, 'scenario.npz'))
+	print(f"Scenario of {len(sim_config['location_lonlats'])} locations saved to {os.path.join(args.directory, 'scenario.npz')}")
@@ -0,0 +1,56 @@
+import json
+import os
+import tempfile
+import numpy as np
+import scenario_generator
+
+# Checks of the synthetic scenario generator: points in polygons against a plain ray casting reference, including a
+# polygon with a hole, scenarios the same for the same seed and different for another, and all locations inside the
+# area. Run from the repository root: python scenario_generator_test.py
+
+def point_in_rings_reference(lon, lat, rings):
+	"""Whether a point is inside rings by the even-odd rule, one edge at a time"""
+	inside = False
+	for ring in rings:
+		for (x1, y1), (x2, y2) in zip(ring.tolist(), np.roll(ring, -1, axis=0).tolist()):
+			if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1)*(x2 - x1)/(y2 - y1):
+				inside = not inside
+	return inside
+
+def test_points_in_rings(rng, num_points = 2000):
+	"""points_in_rings agrees with the reference on a square with a hole and on the area of the test scenario"""
+	square_with_hole = [np.array([[0, 0], [4, 0], [4, 4], [0, 4]], dtype=np.float64), np.array([[1, 1], [1, 3], [3, 3], [3, 1]], dtype=np.float64)]
+	assert scenario_generator.points_in_rings(np.array([[0.5, 0.5], [2, 2], [3.5, 2], [5, 2]]), square_with_hole).tolist() == [True, False, True, False]
+	area_features = scenario_generator.load_area('geo_data/sim_test_area.geojson')
+	for rings in [square_with_hole] + [area_feature['rings'] for area_feature in area_features]:
+		all_points = np.concatenate(rings)
+		lonlats = np.column_stack([rng.uniform(all_points[:, 0].min(), all_points[:, 0].max(), num_points), rng.uniform(all_points[:, 1].min(), all_points[:, 1].max(), num_points)])
+		inside = scenario_generator.points_in_rings(lonlats, rings, max_block_elements=1000)
+		reference = np.array([point_in_rings_reference(lon, lat, rings) for lon, lat in lonlats.tolist()])
+		assert np.array_equal(inside, reference), f"points_in_rings differs from the reference for {np.count_nonzero(inside != reference)} points"
+	print(f"Points in polygons match the reference: {len(area_features) + 1} polygons, {num_points} points each")
+
+def read_scenario_files(sim_config):
+	files = {}
+	for name in ('pickup_sites_filename', 'depots_filename', 'terminals_filename'):
+		with open(sim_config[name]) as f:
+			files[name] = json.load(f)
+	return files
+
+def test_generate_scenario(num_pickup_sites = 500):
+	"""The same seed gives the same scenario, another seed another one, and all locations are inside the area"""
+	area_features = scenario_generator.load_area('geo_data/sim_test_area.geojson')
+	with tempfile.TemporaryDirectory() as directory:
+		scenarios = [read_scenario_files(scenario_generator.generate_scenario(
+			os.path.join(directory, str(index)), num_pickup_sites, 10, seed=seed, weight_property='Asukasluku',
+			population_centers_filename='geo_data/sim_test_terminals.geojson'
+		)) for index, seed in enumerate((1, 1, 2))]
+	assert scenarios[0] == scenarios[1], "The same seed gave different scenarios"
+	assert scenarios[0]['pickup_sites_filename'] != scenarios[2]['pickup_sites_filename'], "Different seeds gave the same pickup sites"
+	for scenario in scenarios:
+		lonlats = np.array([feature['geometry']['coordinates'] for files in scenario.values() for feature in files['features']])
+		assert len(lonlats) == num_pickup_sites + 4 and scenario_generator.points_in_area(lonlats, area_features).all(), "Locations outside the area"
+	print(f"Generated scenarios are deterministic and inside the area: {num_pickup_sites} pickup sites")
+
+test_points_in_rings(np.random.default_rng(42))
+test_generate_scenario()
@@ -0,0 +1,50 @@
+import time
+import simpy
+
+# The SimPy engine of the simulation: SimPy's environment, and an instrumented one. See also event_kernel.py
+
+Environment = simpy.Environment
+
+# Process name for events that resume no process, such as the event that ends env.run
+no_process_name = '(no process)'
+
+
+# SimPy environment that counts events and their wall time by the name of the process they resume, and keeps track of
+# the peak event queue length. The overhead is two clock reads and a few attribute lookups per event
+class InstrumentedEnvironment(simpy.Environment):
+
+	def __init__(self, initial_time = 0, sample_interval = 24*60):
+		"""sample_interval: simulation time between samples of the event queue length and event count"""
+		super().__init__(initial_time)
+		self.num_events = 0
+		self.peak_queue_length = 0
+		self.num_events_by_process = {}
+		self.wall_time_by_process = {}
+		self.sample_interval = sample_interval
+		self.next_sample_time = initial_time
+		self.samples = [] # (wall time, simulation time, event queue length, number of events)
+
+	def step(self):
+		queue = self._queue
+		queue_length = len(queue)
+		if queue_length > self.peak_queue_length:
+			self.peak_queue_length = queue_length
+		if queue_length == 0:
+			return super().step() # Raises EmptySchedule
+		next_time, _, _, event = queue[0]
+		if next_time >= self.next_sample_time:
+			self.samples.append((time.perf_counter(), next_time, queue_length, self.num_events))
+			self.next_sample_time = next_time + self.sample_interval
+		name = no_process_name
+		for callback in event.callbacks or ():
+			process = getattr(callback, '__self__', None)
+			if isinstance(process, simpy.Process):
+				name = process.name
+				break
+		start_time = time.perf_counter()
+		try:
+			super().step()
+		finally:
+			self.num_events += 1
+			self.num_events_by_process[name] = self.num_events_by_process.get(name, 0) + 1
+			self.wall_time_by_process[name] = self.wall_time_by_process.get(name, 0) + time.perf_counter() - start_time
@@ -0,0 +1,247 @@
+import numpy as np
+from haversine_matrix import haversine_distances
+from spatial_index import SpatialIndex
+
+# Sparse distance and duration matrixes for large numbers of locations. For each location, the matrix elements to its k
+# nearest neighbours are stored, and also all the rows and columns of dense locations such as depots and terminals.
+# Other elements are estimated from great-circle distances, with a detour factor and a duration by distance curve
+# fitted to the stored elements. Memory use is O(n*k + n*m) for n locations and m dense locations, instead of O(n^2).
+#
+# SparseTravelMatrixes.distance_matrix and .duration_matrix are indexed like 2d NumPy arrays: matrix[i, j] with
+# integers or with index arrays that are broadcast against each other.
+
+class SparseTravelMatrixes():
+
+	def __init__(self, lonlats, neighbour_indexes, neighbour_distances, neighbour_durations, dense_indexes, dense_row_distances, dense_row_durations, dense_column_distances, dense_column_durations, detour_factor = None, estimate_distances = None, estimate_durations = None):
+		"""
+		lonlats: (n, 2) location lonlats
+		neighbour_indexes: (n, k) location indexes of the nearest neighbours of each location, in increasing order
+		neighbour_distances, neighbour_durations: (n, k) matrix elements from each location to its neighbours
+		dense_indexes: (m,) location indexes of the dense locations
+		dense_row_distances, dense_row_durations: (m, n) matrix rows of the dense locations
+		dense_column_distances, dense_column_durations: (n, m) matrix columns of the dense locations
+		detour_factor: ratio of distance to great-circle distance, for estimating the other elements
+		estimate_distances, estimate_durations: increasing distances and their durations, interpolated for estimating the
+			other elements. By default these and the detour factor are fitted to the stored elements
+		"""
+		self.lonlats = np.asarray(lonlats, dtype=np.float64).reshape(-1, 2)
+		self.num_locations = len(self.lonlats)
+		self.neighbour_indexes = np.asarray(neighbour_indexes, dtype=np.int32)
+		self.values = {
+			'distance': {
+				'neighbour': np.asarray(neighbour_distances, dtype=np.float32),
+				'dense_row': np.asarray(dense_row_distances, dtype=np.float32),
+				'dense_column': np.asarray(dense_column_distances, dtype=np.float32)
+			},
+			'duration': {
+				'neighbour': np.asarray(neighbour_durations, dtype=np.float32),
+				'dense_row': np.asarray(dense_row_durations, dtype=np.float32),
+				'dense_column': np.asarray(dense_column_durations, dtype=np.float32)
+			}
+		}
+		self.dense_indexes = np.asarray(dense_indexes, dtype=np.int64)
+		self.dense_positions = np.full(self.num_locations, -1, dtype=np.int64)
+		self.dense_positions[self.dense_indexes] = np.arange(len(self.dense_indexes))
+
+		# Keys row*n + column of the neighbour elements, in increasing order because the neighbours are
+		self.neighbour_keys = (np.arange(self.num_locations, dtype=np.int64)[:, None]*self.num_locations + self.neighbour_indexes).ravel()
+
+		if detour_factor is None or estimate_distances is None or estimate_durations is None:
+			fitted_detour_factor, fitted_estimate_distances, fitted_estimate_durations = self.fit_estimate()
+			detour_factor = fitted_detour_factor if detour_factor is None else detour_factor
+			if estimate_distances is None or estimate_durations is None:
+				estimate_distances, estimate_durations = fitted_estimate_distances, fitted_estimate_durations
+		self.detour_factor = float(detour_factor)
+		self.estimate_distances = np.asarray(estimate_distances, dtype=np.float64)
+		self.estimate_durations = np.asarray(estimate_durations, dtype=np.float64)
+
+		self.distance_matrix = SparseMatrixView(self, 'distance')
+		self.duration_matrix = SparseMatrixView(self, 'duration')
+
+	def fit_estimate(self, max_samples = 1 << 20, num_bins = 64):
+		"""Fit the detour factor and the duration by distance curve to a sample of the stored elements"""
+		num_neighbour_elements = self.neighbour_indexes.size
+		num_dense_elements = 2*len(self.dense_indexes)*self.num_locations
+		step = max(1, (num_neighbour_elements + num_dense_elements) // max_samples)
+		rows = np.concatenate([
+			np.arange(self.num_locations).repeat(self.neighbour_indexes.shape[1])[::step],
+			self.dense_indexes.repeat(self.num_locations)[::step],
+			np.tile(np.arange(self.num_locations), len(self.dense_indexes))[::step]
+		])
+		columns = np.concatenate([
+			self.neighbour_indexes.ravel()[::step],
+			np.tile(np.arange(self.num_locations), len(self.dense_indexes))[::step],
+			self.dense_indexes.repeat(self.num_locations)[::step]
+		])
+		distances = np.concatenate([values.ravel()[::step] for values in (self.values['distance']['neighbour'], self.values['distance']['dense_row'], self.values['distance']['dense_column'].T)]).astype(np.float64)
+		durations = np.concatenate([values.ravel()[::step] for values in (self.values['duration']['neighbour'], self.values['duration']['dense_row'], self.values['duration']['dense_column'].T)]).astype(np.float64)
+		great_circle_distances = haversine_distances(self.lonlats[rows], self.lonlats[columns])
+		usable = (great_circle_distances > 1) & (distances > 0) & (durations > 0) & np.isfinite(durations)
+		if not np.any(usable):
+			return 1.3, np.array([0, 1000.0]), np.array([0, 1.0]) # 60 km/h
+		detour_factor = np.median(distances[usable]/great_circle_distances[usable])
+
+		# Median durations of distance bins of equal numbers of elements, made increasing
+		order = np.argsort(distances[usable])
+		bins = np.array_split(order, min(num_bins, len(order)))
+		estimate_distances = np.array([0] + [np.median(distances[usable][bin_indexes]) for bin_indexes in bins])
+		estimate_durations = np.maximum.accumulate(np.array([0] + [np.median(durations[usable][bin_indexes]) for bin_indexes in bins]))
+		return detour_factor, estimate_distances, estimate_durations
+
+	def estimate_durations_of(self, distances):
+		"""Durations of distances by the fitted curve, extrapolated at the speed of its last point"""
+		durations = np.interp(distances, self.estimate_distances, self.estimate_durations)
+		beyond = distances > self.estimate_distances[-1]
+		if self.estimate_distances[-1] > 0:
+			durations[beyond] = distances[beyond]*self.estimate_durations[-1]/self.estimate_distances[-1]
+		return durations
+
+	@property
+	def nbytes(self):
+		return self.neighbour_indexes.nbytes + self.neighbour_keys.nbytes + sum(array.nbytes for values in self.values.values() for array in values.values())
+
+	def lookup(self, rows, columns, quantity):
+		"""Get elements of the 'distance' or 'duration' matrix, with rows and columns broadcast against each other"""
+		rows, columns = np.broadcast_arrays(np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64))
+		shape = rows.shape
+		rows = rows.ravel()
+		columns = columns.ravel()
+		values = self.values[quantity]
+
+		# Neighbour elements, or estimates where not available
+		keys = rows*self.num_locations + columns
+		positions = np.minimum(np.searchsorted(self.neighbour_keys, keys), len(self.neighbour_keys) - 1)
+		found = self.neighbour_keys[positions] == keys if len(self.neighbour_keys) > 0 else np.zeros(len(keys), dtype=bool)
+		result = np.where(found, values['neighbour'].ravel()[positions] if len(self.neighbour_keys) > 0 else 0, 0).astype(np.float32)
+		estimated = np.nonzero(~found)[0]
+		if len(estimated) > 0:
+			estimated_distances = haversine_distances(self.lonlats[rows[estimated]], self.lonlats[columns[estimated]])*self.detour_factor
+			result[estimated] = estimated_distances if quantity == 'distance' else self.estimate_durations_of(estimated_distances)
+
+		# Rows and columns of dense locations
+		dense_row_positions = self.dense_positions[rows]
+		in_dense_row = np.nonzero(dense_row_positions >= 0)[0]
+		result[in_dense_row] = values['dense_row'][dense_row_positions[in_dense_row], columns[in_dense_row]]
+		dense_column_positions = self.dense_positions[columns]
+		in_dense_column = np.nonzero(dense_column_positions >= 0)[0]
+		result[in_dense_column] = values['dense_column'][rows[in_dense_column], dense_column_positions[in_dense_column]]
+
+		result[rows == columns] = 0
+		return result.reshape(shape)
+
+	def save(self, filename):
+		np.savez(
+			filename,
+			lonlats=self.lonlats,
+			neighbour_indexes=self.neighbour_indexes,
+			neighbour_distances=self.values['distance']['neighbour'],
+			neighbour_durations=self.values['duration']['neighbour'],
+			dense_indexes=self.dense_indexes,
+			dense_row_distances=self.values['distance']['dense_row'],
+			dense_row_durations=self.values['duration']['dense_row'],
+			dense_column_distances=self.values['distance']['dense_column'],
+			dense_column_durations=self.values['duration']['dense_column'],
+			detour_factor=self.detour_factor,
+			estimate_distances=self.estimate_distances,
+			estimate_durations=self.estimate_durations
+		)
+
+	@classmethod
+	def load(cls, filename):
+		with np.load(filename) as arrays:
+			return cls(**{name: arrays[name] for name in arrays.files})
+
+
+# A distance or duration matrix of SparseTravelMatrixes, indexed like a 2d NumPy array
+class SparseMatrixView():
+
+	def __init__(self, matrixes, quantity):
+		self.matrixes = matrixes
+		self.quantity = quantity
+		self.shape = (matrixes.num_locations, matrixes.num_locations)
+		self.ndim = 2
+		self.dtype = np.dtype(np.float32)
+
+	def __len__(self):
+		return self.matrixes.num_locations
+
+	def __getitem__(self, index):
+		rows, columns = index
+		result = self.matrixes.lookup(rows, columns, self.quantity)
+		return result[()] if result.ndim == 0 else result
+
+	def __array__(self, dtype = None, copy = None):
+		"""Dense matrix, for consumers that need one, such as the genetic algorithm routing optimizer"""
+		dense = np.empty(self.shape, dtype=np.float32)
+		block_size = max(1, (1 << 22) // max(self.shape[1], 1))
+		all_columns = np.arange(self.shape[1])
+		for block_start in range(0, self.shape[0], block_size):
+			rows = np.arange(block_start, min(block_start + block_size, self.shape[0]))
+			dense[rows] = self.matrixes.lookup(rows[:, None], all_columns[None, :], self.quantity)
+		return dense if dtype is None else dense.astype(dtype)
+
+
+def as_travel_matrix(matrix, dtype = None):
+	"""Keep a sparse float32 matrix view as is, and make anything else a NumPy array of dtype"""
+	return matrix if isinstance(matrix, SparseMatrixView) else np.asarray(matrix, dtype=dtype)
+
+def get_nearest_neighbours(lonlats, k, max_block_elements = 1 << 22):
+	"""Get the (n, k) indexes of the k nearest other locations of each location by great-circle distance, with a spatial index"""
+	lonlats = np.asarray(lonlats, dtype=np.float64).reshape(-1, 2)
+	neighbour_indexes, _ = SpatialIndex(lonlats).nearest(lonlats, k, np.arange(len(lonlats)), max_block_elements)
+	return neighbour_indexes.astype(np.int32)
+
+def get_spatial_order(lonlats):
+	"""Order of locations along a Z-order curve, which keeps nearby locations mostly near each other"""
+	lonlats = np.asarray(lonlats, dtype=np.float64).reshape(-1, 2)
+	span = np.maximum(lonlats.max(axis=0) - lonlats.min(axis=0), 1e-12)
+	cells = ((lonlats - lonlats.min(axis=0))/span*65535).astype(np.uint64)
+	codes = np.zeros(len(lonlats), dtype=np.uint64)
+	for bit in range(16):
+		codes |= ((cells[:, 0] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit)
+		codes |= ((cells[:, 1] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit + 1)
+	return np.argsort(codes, kind='stable')
+
+def build_sparse_travel_matrixes(lonlats, fetch, k = 50, dense_indexes = (), max_block_elements = 1 << 22):
+	"""
+	Build sparse travel matrixes for a list of locations. fetch(coords, source_indexes, destination_indexes) is as for
+	MatrixStore.get. Rows are fetched in blocks of nearby locations, against the union of the neighbours of the block
+	"""
+	lonlats = np.asarray(lonlats, dtype=np.float64).reshape(-1, 2)
+	coords = lonlats.tolist()
+	num_locations = len(lonlats)
+	neighbour_indexes = np.sort(get_nearest_neighbours(lonlats, k, max_block_elements), axis=1)
+	k = neighbour_indexes.shape[1]
+	neighbour_distances = np.empty(neighbour_indexes.shape, dtype=np.float32)
+	neighbour_durations = np.empty(neighbour_indexes.shape, dtype=np.float32)
+
+	# Blocks of rows of nearby locations have mostly the same neighbours
+	order = get_spatial_order(lonlats)
+	block_size = max(1, int(np.sqrt(max_block_elements/max(k, 1))))
+	for block_start in range(0, num_locations, block_size):
+		rows = order[block_start:block_start + block_size]
+		if k == 0:
+			break
+		columns = np.unique(neighbour_indexes[rows])
+		fetched = fetch(coords, rows, columns)
+		column_positions = np.searchsorted(columns, neighbour_indexes[rows])
+		block_rows = np.arange(len(rows))[:, None]
+		neighbour_distances[rows] = np.asarray(fetched['distance_matrix'])[block_rows, column_positions]
+		neighbour_durations[rows] = np.asarray(fetched['duration_matrix'])[block_rows, column_positions]
+
+	# Rows and columns of the dense locations
+	dense_indexes = np.asarray(dense_indexes, dtype=np.int64)
+	all_indexes = np.arange(num_locations)
+	dense_row_distances = np.empty((len(dense_indexes), num_locations), dtype=np.float32)
+	dense_row_durations = np.empty((len(dense_indexes), num_locations), dtype=np.float32)
+	dense_column_distances = np.empty((num_locations, len(dense_indexes)), dtype=np.float32)
+	dense_column_durations = np.empty((num_locations, len(dense_indexes)), dtype=np.float32)
+	if len(dense_indexes) > 0:
+		fetched = fetch(coords, dense_indexes, all_indexes)
+		dense_row_distances[:] = fetched['distance_matrix']
+		dense_row_durations[:] = fetched['duration_matrix']
+		fetched = fetch(coords, all_indexes, dense_indexes)
+		dense_column_distances[:] = fetched['distance_matrix']
+		dense_column_durations[:] = fetched['duration_matrix']
+
+	return SparseTravelMatrixes(lonlats, neighbour_indexes, neighbour_distances, neighbour_durations, dense_indexes, dense_row_distances, dense_row_durations, dense_column_distances, dense_column_durations)
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import numpy as np
+from haversine_matrix import HaversineMatrixBackend
+from spatial_index import SpatialIndex
+from sparse_travel_matrix import SparseTravelMatrixes, build_sparse_travel_matrixes
+
+# Checks of sparse travel matrixes against the dense matrixes of the haversine backend: the stored elements to the k
+# nearest neighbours and of the dense locations are looked up exactly, other elements are estimated, and the matrixes
+# are the same after saving and loading.
+# Run from the repository root: python sparse_travel_matrix_test.py
+
+def test_sparse_travel_matrix(rng, num_locations = 500, k = 10, dense_indexes = (0, 1)):
+	"""The stored elements of sparse travel matrixes are those of the dense matrixes"""
+	backend = HaversineMatrixBackend(speed_bands=((0, 40), (5000, 80)))
+	lonlats = np.column_stack([rng.uniform(23.5, 25.5, num_locations), rng.uniform(60.5, 61.5, num_locations)])
+	dense = backend.get_distance_and_duration_matrix(lonlats)
+	sparse = build_sparse_travel_matrixes(lonlats, backend.get_distance_and_duration_matrix, k, dense_indexes)
+	neighbour_indexes = SpatialIndex(lonlats).nearest(lonlats, k, np.arange(num_locations))[0]
+	rows = np.concatenate([np.repeat(np.arange(num_locations), k), np.repeat(dense_indexes, num_locations), np.tile(np.arange(num_locations), len(dense_indexes))])
+	columns = np.concatenate([neighbour_indexes.ravel(), np.tile(np.arange(num_locations), len(dense_indexes)), np.repeat(dense_indexes, num_locations)])
+	for quantity in ('distance', 'duration'):
+		assert np.allclose(sparse.lookup(rows, columns, quantity), dense[f"{quantity}_matrix"][rows, columns], rtol=1e-6), f"Sparse {quantity} matrix lookup differs from the dense matrix"
+	assert np.array_equal(np.asarray(sparse.distance_matrix[rows[:10], columns[:10]]), sparse.lookup(rows[:10], columns[:10], 'distance'))
+	# The haversine backend has a constant detour factor, which the estimate fits
+	all_rows, all_columns = np.meshgrid(np.arange(num_locations), np.arange(num_locations), indexing='ij')
+	assert np.allclose(sparse.lookup(all_rows, all_columns, 'distance'), dense['distance_matrix'], rtol=1e-3), "Estimated distances differ from the dense matrix"
+	with tempfile.TemporaryDirectory() as directory:
+		sparse.save(os.path.join(directory, 'sparse.npz'))
+		loaded = SparseTravelMatrixes.load(os.path.join(directory, 'sparse.npz'))
+		for quantity in ('distance', 'duration'):
+			assert np.array_equal(loaded.lookup(all_rows, all_columns, quantity), sparse.lookup(all_rows, all_columns, quantity)), f"Loaded sparse {quantity} matrix differs"
+	print(f"Sparse travel matrixes match the dense matrixes: {len(rows)} stored elements")
+
+test_sparse_travel_matrix(np.random.default_rng(42))
@@ -0,0 +1,123 @@
+import math
+import numpy as np
+
+from haversine_matrix import earth_radius
+
+# Spatial index over lonlats for nearest neighbour queries: a k-d tree of leaf buckets. Locations are split recursively
+# at the median of the longer side of their bounding box, in a local equirectangular projection scaled by the cosine of
+# the latitude farthest from the equator, so that projected distances within the area do not exceed great-circle
+# distances. The leaves adapt to the density of the locations, so clustered locations are as fast to query as evenly
+# spread ones. Queries are bucketed in the same way, and each bucket of queries is compared against the locations of
+# the nearest leaves, and then against those of any leaf whose bounding box is closer than the farthest kth nearest
+# location found. The results are the same as by comparing all pairs of locations.
+
+
+class SpatialIndex():
+
+	def __init__(self, lonlats, leaf_size = 64):
+		"""lonlats: (n, 2) locations. leaf_size: maximum number of locations in a leaf"""
+		self.lonlats = np.asarray(lonlats, dtype=np.float64).reshape(-1, 2)
+		self.leaf_size = leaf_size
+		self.unit_vectors = get_unit_vectors(self.lonlats)
+		self.x_scale = math.cos(math.radians(min(np.abs(self.lonlats[:, 1]).max(), 89.9))) if len(self.lonlats) > 0 else 1
+		points = self.project(self.lonlats)
+		self.leaves = split_into_leaves(points, leaf_size)
+		self.leaf_bounds = get_bounds(points, self.leaves)
+		self.leaf_sizes = np.array([len(leaf) for leaf in self.leaves], dtype=np.int64)
+
+	def __len__(self):
+		return len(self.lonlats)
+
+	def project(self, lonlats):
+		"""Equirectangular projection in meters"""
+		lonlats = np.radians(np.asarray(lonlats, dtype=np.float64).reshape(-1, 2))
+		return np.column_stack([lonlats[:, 0]*self.x_scale, lonlats[:, 1]])*earth_radius
+
+	def nearest(self, query_lonlats, k, exclude_indexes = None, max_block_elements = 1 << 22):
+		"""
+		Get the k nearest locations of each query lonlat by great-circle distance. exclude_indexes: a location index to
+		leave out for each query, for example the query location itself, or -1. k is limited to the number of locations
+		available to each query. Distances are computed in blocks of at most max_block_elements query and location pairs.
+		Returns (indexes, distances in meters), both (m, k) in increasing order of distance
+		"""
+		query_lonlats = np.asarray(query_lonlats, dtype=np.float64).reshape(-1, 2)
+		num_queries = len(query_lonlats)
+		exclude_indexes = np.full(num_queries, -1, dtype=np.int64) if exclude_indexes is None else np.asarray(exclude_indexes, dtype=np.int64)
+		k = max(min(k, len(self.lonlats) - (1 if np.any(exclude_indexes >= 0) else 0)), 0)
+		indexes = np.empty((num_queries, k), dtype=np.int64)
+		distances = np.empty((num_queries, k), dtype=np.float64)
+		if k == 0 or num_queries == 0:
+			return indexes, distances
+
+		query_points = self.project(query_lonlats)
+		query_unit_vectors = get_unit_vectors(query_lonlats)
+		query_buckets = split_into_leaves(query_points, self.leaf_size)
+		for bucket, bucket_bounds in zip(query_buckets, get_bounds(query_points, query_buckets)):
+			# The nearest leaves with enough locations, then all leaves that can have locations closer than the farthest kth
+			# nearest location found in those
+			leaf_distances = get_box_distances(bucket_bounds, self.leaf_bounds)
+			leaf_order = np.argsort(leaf_distances, kind='stable')
+			num_leaves = int(np.searchsorted(np.cumsum(self.leaf_sizes[leaf_order]), k + 1)) + 1
+			leaf_indexes = leaf_order[:num_leaves]
+			bucket_indexes, bucket_distances = self.nearest_in_leaves(query_unit_vectors[bucket], exclude_indexes[bucket], leaf_indexes, k, max_block_elements)
+			within_indexes = np.flatnonzero(leaf_distances <= bucket_distances[:, -1].max())
+			if len(within_indexes) > len(leaf_indexes):
+				bucket_indexes, bucket_distances = self.nearest_in_leaves(query_unit_vectors[bucket], exclude_indexes[bucket], within_indexes, k, max_block_elements)
+			indexes[bucket] = bucket_indexes
+			distances[bucket] = bucket_distances
+		return indexes, distances
+
+	def nearest_in_leaves(self, query_unit_vectors, exclude_indexes, leaf_indexes, k, max_block_elements):
+		candidates = np.concatenate([self.leaves[leaf_index] for leaf_index in leaf_indexes])
+		candidate_unit_vectors = self.unit_vectors[candidates]
+		indexes = np.empty((len(query_unit_vectors), k), dtype=np.int64)
+		distances = np.empty((len(query_unit_vectors), k), dtype=np.float64)
+		block_size = max(1, max_block_elements//len(candidates))
+		for block_start in range(0, len(query_unit_vectors), block_size):
+			block = slice(block_start, block_start + block_size)
+			# Great-circle distance increases with the chord distance between unit vectors, which decreases with their dot
+			# product
+			chords = np.sqrt(np.maximum(2 - 2*(query_unit_vectors[block] @ candidate_unit_vectors.T), 0))
+			chords[candidates[None, :] == exclude_indexes[block, None]] = np.inf
+			nearest = np.argpartition(chords, k - 1, axis=1)[:, :k] if k < len(candidates) else np.argsort(chords, axis=1)[:, :k]
+			nearest_chords = np.take_along_axis(chords, nearest, axis=1)
+			order = np.argsort(nearest_chords, axis=1, kind='stable')
+			indexes[block] = candidates[np.take_along_axis(nearest, order, axis=1)]
+			distances[block] = 2*earth_radius*np.arcsin(np.minimum(np.take_along_axis(nearest_chords, order, axis=1)/2, 1))
+		return indexes, distances
+
+
+def get_unit_vectors(lonlats):
+	lonlats = np.radians(np.asarray(lonlats, dtype=np.float64).reshape(-1, 2))
+	return np.column_stack([
+		np.cos(lonlats[:, 1])*np.cos(lonlats[:, 0]),
+		np.cos(lonlats[:, 1])*np.sin(lonlats[:, 0]),
+		np.sin(lonlats[:, 1])
+	])
+
+def split_into_leaves(points, leaf_size):
+	"""Split points recursively at the median of the longer side of their bounding box. Returns the point indexes of each leaf"""
+	leaves = []
+	stack = [np.arange(len(points))]
+	while len(stack) > 0:
+		indexes = stack.pop()
+		if len(indexes) <= leaf_size:
+			if len(indexes) > 0:
+				leaves.append(indexes)
+			continue
+		leaf_points = points[indexes]
+		axis = int(np.argmax(leaf_points.max(axis=0) - leaf_points.min(axis=0)))
+		half = len(indexes)//2
+		partition = np.argpartition(leaf_points[:, axis], half)
+		stack.append(indexes[partition[half:]])
+		stack.append(indexes[partition[:half]])
+	return leaves
+
+def get_bounds(points, leaves):
+	"""(number of leaves, 2, 2) minimum and maximum corners of the bounding box of each leaf"""
+	return np.array([(points[leaf].min(axis=0), points[leaf].max(axis=0)) for leaf in leaves]).reshape(-1, 2, 2)
+
+def get_box_distances(bounds, other_bounds):
+	"""Distances between a bounding box and other bounding boxes, 0 for overlapping boxes"""
+	gaps = np.maximum(np.maximum(bounds[0] - other_bounds[:, 1], other_bounds[:, 0] - bounds[1]), 0)
+	return np.sqrt((gaps**2).sum(axis=1))
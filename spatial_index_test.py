@@ -0,0 +1,32 @@
+import numpy as np
+from haversine_matrix import haversine_distance_matrix
+from spatial_index import SpatialIndex
+
+# Checks of the spatial index against comparing all pairs of locations, for evenly spread and clustered locations.
+# Run from the repository root: python spatial_index_test.py
+
+def test_spatial_index(rng, num_locations = 3000, num_queries = 500, k = 8):
+	"""The nearest locations of the spatial index are those of comparing all pairs"""
+	lonlats = np.column_stack([rng.uniform(23.5, 25.5, num_locations), rng.uniform(60.5, 61.5, num_locations)])
+	lonlats[:num_locations//2] = lonlats[0] + rng.normal(0, 0.01, (num_locations//2, 2)) # Clustered
+	query_indexes = rng.choice(num_locations, num_queries, replace=False)
+	indexes, distances = SpatialIndex(lonlats).nearest(lonlats[query_indexes], k, query_indexes)
+	brute_force_distances = haversine_distance_matrix(lonlats[query_indexes], lonlats)
+	brute_force_distances[np.arange(num_queries), query_indexes] = np.inf
+	# Within a centimeter, as the spatial index computes distances from unit vectors
+	assert np.allclose(distances, np.sort(brute_force_distances, axis=1)[:, :k], atol=0.01), "Spatial index distances differ from brute force"
+	assert np.allclose(np.take_along_axis(brute_force_distances, indexes, axis=1), distances, atol=0.01), "Spatial index indexes differ from brute force"
+	assert not np.any(indexes == query_indexes[:, None]), "Spatial index returned an excluded location"
+	print(f"Spatial index matches brute force: {num_queries} queries, k {k}")
+
+def test_few_locations(rng, num_locations = 5):
+	"""k is limited to the number of locations available to each query"""
+	lonlats = np.column_stack([rng.uniform(23.5, 25.5, num_locations), rng.uniform(60.5, 61.5, num_locations)])
+	indexes, distances = SpatialIndex(lonlats, leaf_size=2).nearest(lonlats, 10, np.arange(num_locations))
+	assert indexes.shape == (num_locations, num_locations - 1), f"Shape {indexes.shape} of the nearest of {num_locations} locations"
+	assert all(sorted(row) == [index for index in range(num_locations) if index != query_index] for query_index, row in enumerate(indexes.tolist()))
+	print(f"Spatial index limits k to the {num_locations - 1} other locations")
+
+rng = np.random.default_rng(42)
+test_spatial_index(rng)
+test_few_locations(rng)
@@ -1,17 +1,29 @@
 import math
 import time
-import simpy
+import bisect
 import random
 import numpy as np
 import queue as queue
 import json
 import functools
-from geopy.distance import geodesic
-from os.path import exists
+import concurrent.futures
+import threading
 from datetime import datetime
 import os
 
-from routing_api import get_distance_and_duration_matrix
+from matrix_store import MatrixStore, location_set_key
+from sparse_travel_matrix import as_travel_matrix
+from haversine_matrix import HaversineMatrixBackend
+from columnar_buffer import ColumnarBuffer, write_columns, log_formats
+from event_log import EventLog, DEBUG, INFO, WARNING
+from routing_optimizer_worker import RoutingOptimizerWorker
+from routing_executor import RoutingExecutor, get_current_routing_executor
+from routing_decomposition import RoutingDecomposition
+from routing_cache import RoutingCache, get_shared_routing_cache
+from heuristic_router import heuristic_router
+from local_search import LocalSearch
+from plan_evaluator import cost_function_from_components
+from instrumentation import Instrumentation
 
 
 def time_to_string(minutes):
@@ -30,70 +42,46 @@ def lonlat_to_string(lonlat):
 def to_percentage_string(number):
 	return f"{number*100:.0f}%"
 
-def heuristic_router(routing_input):
-#    "pickup_sites": [
-#        {
-#            "capacity": 2,
-#            "level": 0.9848136938048543,
-#            "growth_rate": 8.10984801062072e-05	
-
-	# Sort sites based on when they become full
-	indexes_and_times_when_full = []
-	for pickup_site_index, pickup_site in enumerate(routing_input['pickup_sites']):
-		time_when_full = (pickup_site['capacity'] - pickup_site['level'])/pickup_site['growth_rate']
-		indexes_and_times_when_full.append((pickup_site_index, time_when_full))
-	indexes_and_times_when_full.sort(key=lambda index_and_time_when_full: index_and_time_when_full[1])
-
-	# Assign destinations to vehicles, in interleaved order so that every vehicle gets the same number of sites
-	vehicle_routes = []
-
-	for vehicle in routing_input['vehicles']:
-		home_depot = routing_input['depots'][vehicle['home_depot_index']]
-		vehicle_routes.append([home_depot['location_index']])
-
-	vehicle_route_durations = [0 for _ in range(len(routing_input['vehicles']))]
-	durations_back_home = [0 for _ in range(len(routing_input['vehicles']))]
-	for index, pickup_site_index_and_time_when_full in enumerate(indexes_and_times_when_full):
-		vehicle_index = index % len(routing_input['vehicles'])
-		vehicle = routing_input['vehicles'][vehicle_index]
-		home_depot_location_index = routing_input['depots'][vehicle['home_depot_index']]['location_index']
-		proposed_location_index = routing_input['pickup_sites'][pickup_site_index_and_time_when_full[0]]['location_index']
-		# Calculate proposed route duration
-		to_proposed_location_duration = routing_input['duration_matrix'][vehicle_routes[vehicle_index][-1]][proposed_location_index]
-		from_proposed_location_to_home_depot_duration = routing_input['duration_matrix'][proposed_location_index][home_depot_location_index]
-		proposed_route_duration = vehicle_route_durations[vehicle_index] + to_proposed_location_duration + from_proposed_location_to_home_depot_duration
-		if proposed_route_duration <= vehicle['max_route_duration']:
-			vehicle_routes[vehicle_index].append(proposed_location_index)
-			vehicle_route_durations[vehicle_index] += to_proposed_location_duration
-			durations_back_home[vehicle_index] = from_proposed_location_to_home_depot_duration
-
-	for vehicle_index, vehicle in enumerate(routing_input['vehicles']):
-		home_depot = routing_input['depots'][vehicle['home_depot_index']]
-		vehicle_routes[vehicle_index].append(home_depot['location_index'])
-		vehicle_route_durations[vehicle_index] += durations_back_home[vehicle_index]
-
-	# Heuristic router only routes one day at a time.
-	routing_output = {
-		'days': [{
-			'vehicles': [{
-				'route': route
-			} for route in vehicle_routes]
-		}]
-	}
-	
-	#print(routing_output)
-
-	return routing_output
-
+# Text messages of the simulation event types, for printing the structured event log
+event_messages = {
+	'message': lambda e: e['message'],
+	'initial_level': lambda e: f"Initial level: {tons_to_string(e['pickup_site_level'])} of {tons_to_string(e['capacity'])} ({to_percentage_string(e['pickup_site_level'] / e['capacity'])}), growth rate: {tons_to_string(e['daily_growth_rate'])}/day",
+	'level_threshold_passed': lambda e: f"Level increase past threshold for {e['num_listeners']} listeners.",
+	'site_full': lambda e: f"Site #{e['pickup_site_index']} is full.",
+	'vehicle_location': lambda e: f"At {e['location_type']} #{e['location_type_index']}",
+	'load_increase': lambda e: f"Load level increased to {tons_to_string(e['load_level'])} / {tons_to_string(e['load_capacity'])} ({to_percentage_string(e['load_level']/e['load_capacity'])})",
+	'overload': lambda e: "Overload",
+	'depart': lambda e: f"Depart from {e['location_type']} #{e['location_type_index']}",
+	'arrive': lambda e: f"Arrive at {e['location_type']} #{e['location_type_index']}",
+	'pickup': lambda e: f"Pick up {tons_to_string(e['amount'])} from pickup site #{e['pickup_site_index']} with {tons_to_string(e['remaining'])} remaining. Vehicle load {tons_to_string(e['load_level'])} / {tons_to_string(e['load_capacity'])}",
+	'nothing_to_pick_up': lambda e: f"Nothing to pick up at pickup site #{e['pickup_site_index']}",
+	'dump': lambda e: f"Dumped the load {tons_to_string(e['load_level'])} at depot #{e['depot_index']}",
+	'monitored_levels': lambda e: f"Monitored levels: {', '.join(map(to_percentage_string, e['fill_ratios']))}",
+	'sim_finished': lambda e: f"Simulation finished with {e['computing_time']}s of computing",
+	'snapshot_saved': lambda e: f"Snapshot of day {e['day']} saved to {e['filename']}",
+	'snapshot_skipped': lambda e: f"No snapshot of day {e['day']}, vehicle #{e['vehicle_index']} is on a route",
+	'resumed': lambda e: f"Resumed from a snapshot of day {e['day']}",
+	'routes_optimized': lambda e: f"Routes optimized in {e['num_generations']} generations from a {'warm' if e['warm_start'] else 'random'} start, cost {e['cost']:.2f}",
+	'routing_cache': lambda e: f"Routing cache {e['kind'].replace('_', ' ')}"
+}
+
+snapshot_version = 1
+
+def load_snapshot(filename):
+	with open(filename) as f:
+		return json.load(f)
 
 # Any entity in the simulation that has an index which should be mentioned in logging. We don't have other kinds of entities.
 class IndexedSimEntity():
 
+	def log_event(self, level, event_type, /, **fields):
+		self.sim.event_log.record(level, self.sim.env.now, event_type, type(self).__name__, self.index, fields)
+
 	def log(self, message):
-		self.sim.log(f"{type(self).__name__} #{self.index}: {message}")
+		self.log_event(INFO, 'message', message=message)
 
 	def warn(self, message):
-		self.sim.warn(f"{type(self).__name__}e #{self.index}: {message}")
+		self.log_event(WARNING, 'message', message=message)
 
 	def __init__(self, sim, index):
 		self.sim = sim
@@ -115,37 +103,101 @@ class IndexedLocation(IndexedSimEntity):
 		self.lonlat = sim.config['location_lonlats'][location_index]
 		sim.locations[location_index] = self
 
-# Pickup site
+# Waste accumulation of all pickup sites. Levels, capacities and growth rates are kept in arrays indexed by pickup site
+# index, and all levels are increased in one step per day.
+class PickupSiteAccumulator():
+
+	def __init__(self, sim, pickup_site_configs):
+		self.sim = sim
+		self.levels = np.array([pickup_site['level'] for pickup_site in pickup_site_configs], dtype=np.float64)
+		self.capacities = np.array([pickup_site['capacity'] for pickup_site in pickup_site_configs], dtype=np.float64)
+		self.daily_growth_rates = np.array([pickup_site['daily_growth_rate'] for pickup_site in pickup_site_configs], dtype=np.float64)
+		self.location_indexes = np.array([pickup_site['location_index'] for pickup_site in pickup_site_configs], dtype=np.int64)
+
+		# Sigma of optional log-normal noise multiplying the daily growth, with the mean growth preserved. 0 = no noise
+		self.daily_growth_rate_noise_sigma = sim.config.get('daily_growth_rate_noise_sigma', 0)
+
+		# Lowest level listener threshold above the level of each pickup site, the next one a level increase can pass, to
+		# find the sites that need their listeners checked without looking at the others
+		self.next_listener_thresholds = np.full(len(self.levels), np.inf)
+
+		# Sum over days of the number of sites over capacity after the daily growth, as in routing_optimizer.cpp
+		self.num_overflow_days = 0
+
+	def get_daily_growth(self):
+		if self.daily_growth_rate_noise_sigma > 0:
+			sigma = self.daily_growth_rate_noise_sigma
+			return self.daily_growth_rates*self.sim.rng.lognormal(-sigma**2/2, sigma, len(self.daily_growth_rates))
+		return self.daily_growth_rates
+
+	# Put amounts into the containers at all sites
+	def put(self, amounts):
+		previous_levels = self.levels.copy()
+		self.levels += amounts
+		# Only check listeners of the sites where a threshold was passed
+		for pickup_site_index in np.flatnonzero(self.levels >= self.next_listener_thresholds).tolist():
+			self.sim.pickup_sites[pickup_site_index].notify_level_listeners(previous_levels[pickup_site_index])
+
+	def grow_daily(self):
+		self.put(self.get_daily_growth())
+		self.num_overflow_days += int(np.count_nonzero(self.levels > self.capacities))
+
+	def grow_daily_forever(self):
+		while True:
+			yield self.sim.env.timeout(24*60)
+			self.grow_daily()
+
+
+# Pickup site. The state is stored in the pickup site accumulator of the simulation.
 class PickupSite(IndexedLocation):
 
 	def __init__(self, sim, index):
 
 		super().__init__(sim, index, sim.config['pickup_sites'][index]['location_index'])
+		self.accumulator = sim.pickup_site_accumulator
+		# Level listeners sorted by threshold, as (listener, data), and their thresholds in the same order. The listeners
+		# whose thresholds a level increase passes are a slice found by bisection
+		self.level_listeners = []
+		self.level_listener_thresholds = []
+
+		self.log_event(DEBUG, 'initial_level', pickup_site_level=self.level, capacity=self.capacity, daily_growth_rate=self.daily_growth_rate)
 
-		self.capacity = sim.config['pickup_sites'][index]['capacity']
-		self.level = sim.config['pickup_sites'][index]['level']
-		self.levelListeners = []
+	@property
+	def level(self):
+		return float(self.accumulator.levels[self.index])
 
-		self.daily_growth_rate = sim.config['pickup_sites'][index]['daily_growth_rate']
-		self.log(f"Initial level: {tons_to_string(self.level)} of {tons_to_string(self.capacity)} ({to_percentage_string(self.level / self.capacity)}), growth rate: {tons_to_string(self.daily_growth_rate)}/day")
+	@property
+	def capacity(self):
+		return float(self.accumulator.capacities[self.index])
 
-		self.growth_process = sim.env.process(self.grow_daily_forever())
+	@property
+	def daily_growth_rate(self):
+		return float(self.accumulator.daily_growth_rates[self.index])
 
 	# Put some amount into the containers at the site
 	def put(self, amount):
-		listeners_to_message_maybe = list(filter(lambda x: self.level < x[1], self.levelListeners))
-		self.level += amount
-		listeners_to_message = list(filter(lambda x: self.level >= x[1], listeners_to_message_maybe))
+		previous_level = self.level
+		self.accumulator.levels[self.index] += amount
+		self.notify_level_listeners(previous_level)
+
+	# Message the listeners whose thresholds were passed by a level increase from previous_level
+	def notify_level_listeners(self, previous_level):
+		level = self.level
+		start = bisect.bisect_right(self.level_listener_thresholds, previous_level)
+		end = bisect.bisect_right(self.level_listener_thresholds, level)
+		listeners_to_message = self.level_listeners[start:end]
+		self.update_next_listener_threshold()
 		if len(listeners_to_message):
-			self.log(f"Level increase past threshold for {len(listeners_to_message)} listeners.")
-		for x in listeners_to_message:
-			x[0](**x[2])
+			self.log_event(DEBUG, 'level_threshold_passed', num_listeners=len(listeners_to_message))
+		for listener, data in listeners_to_message:
+			listener(**data)
 
 	# Get some amount from the containers at the site
 	def get(self, amount):
-		self.level -= amount
+		self.accumulator.levels[self.index] -= amount
+		self.update_next_listener_threshold()
 
-	def estimate_when_full():
+	def estimate_when_full(self):
 		# Solve:
 		# { level_at_time_x = level_now + (time_x - time_now)*growth_rate
 		# { capacity = level_at_time_x
@@ -154,22 +206,114 @@ class PickupSite(IndexedLocation):
 		return self.sim.env.now + 24*60*(self.capacity - self.level)/self.daily_growth_rate
 
 	def addLevelListener(self, listener, threshold, data = None):
-		#self.log("Added level listener")
-		listener_info = (listener, threshold, data)
-		self.levelListeners.append(listener_info)
-
-	def removeLevelListener(self, listener):
-		self.levelListeners = filter(lambda x: x[0] != listener, self.levelListeners)
-
-	def grow_daily_forever(self):
-		while True:
-			yield self.sim.env.timeout(24*60)
-			#self.log(f"Level increase to {tons_to_string(self.level + self.daily_growth_rate)} / {tons_to_string(self.capacity)}  ({to_percentage_string((self.level + self.daily_growth_rate) / self.capacity)})")
-			self.put(self.daily_growth_rate)
+		# After the listeners of the same threshold, to message them in the order they were added
+		position = bisect.bisect_right(self.level_listener_thresholds, threshold)
+		self.level_listener_thresholds.insert(position, threshold)
+		self.level_listeners.insert(position, (listener, data if data is not None else {}))
+		self.update_next_listener_threshold()
+
+	def removeLevelListener(self, listener, threshold):
+		# Among the listeners of the threshold, found by bisection
+		start = bisect.bisect_left(self.level_listener_thresholds, threshold)
+		end = bisect.bisect_right(self.level_listener_thresholds, threshold)
+		for position in reversed(range(start, end)):
+			if self.level_listeners[position][0] == listener:
+				self.level_listeners.pop(position)
+				self.level_listener_thresholds.pop(position)
+		self.update_next_listener_threshold()
+
+	def update_next_listener_threshold(self):
+		position = bisect.bisect_right(self.level_listener_thresholds, self.level)
+		self.accumulator.next_listener_thresholds[self.index] = self.level_listener_thresholds[position] if position < len(self.level_listener_thresholds) else np.inf
+
+
+# Route step segments of all vehicles, recorded as they happen. A segment is either travel between two locations or work
+# at a location (from and to location indexes are equal). Vehicle locations are interpolated from the segments afterwards.
+class VehicleTrajectories():
+
+	def __init__(self, location_lonlats, num_vehicles):
+		self.location_lonlats = np.asarray(location_lonlats, dtype=np.float64)
+		self.num_vehicles = num_vehicles
+		self.segments = ColumnarBuffer({
+			'vehicle_index': np.int32,
+			'start_time': np.float64,
+			'end_time': np.float64,
+			'from_location_index': np.int32,
+			'to_location_index': np.int32,
+			'load_level': np.float64
+		})
+
+	def record(self, vehicle_index, start_time, end_time, from_location_index, to_location_index, load_level):
+		self.segments.append(vehicle_index=vehicle_index, start_time=start_time, end_time=end_time, from_location_index=from_location_index, to_location_index=to_location_index, load_level=load_level)
+
+	def get_segments(self):
+		"""Get segments as arrays, sorted by vehicle index and start time"""
+		columns = self.segments.columns()
+		order = np.lexsort((columns['start_time'], columns['vehicle_index']))
+		return {name: column[order] for name, column in columns.items()}
+
+	def sample(self, times, segments=None):
+		"""
+		Interpolate the locations of all vehicles at the given times. Returns a dict of arrays of shape (num_vehicles, len(times)):
+		'active' (vehicle is on a route), 'lonlat' (with an extra last axis of length 2) and 'load_level'
+		"""
+		if segments is None:
+			segments = self.get_segments()
+		times = np.asarray(times, dtype=np.float64)
+		active = np.zeros((self.num_vehicles, len(times)), dtype=bool)
+		lonlat = np.full((self.num_vehicles, len(times), 2), np.nan)
+		load_level = np.zeros((self.num_vehicles, len(times)))
+		if len(segments['start_time']) == 0 or len(times) == 0:
+			return {'active': active, 'lonlat': lonlat, 'load_level': load_level}
+
+		# Find the last segment that started at or before each time, for all vehicles at once. Segments are sorted by
+		# vehicle and start time, so a key of vehicle index * time span + time keeps the vehicles apart.
+		time_span = max(times.max(), segments['end_time'].max()) - min(times.min(), 0) + 1
+		segment_keys = segments['vehicle_index']*time_span + segments['start_time']
+		query_keys = np.arange(self.num_vehicles)[:, None]*time_span + times[None, :]
+		segment_indexes = np.searchsorted(segment_keys, query_keys, side='right') - 1
+		found = segment_indexes >= 0
+		segment_indexes[~found] = 0
+		active = found & (segments['vehicle_index'][segment_indexes] == np.arange(self.num_vehicles)[:, None]) & (times[None, :] < segments['end_time'][segment_indexes])
+
+		# Interpolate between source and destination locations
+		start_times = segments['start_time'][segment_indexes]
+		durations = segments['end_time'][segment_indexes] - start_times
+		with np.errstate(divide='ignore', invalid='ignore'):
+			fractional_progress = np.where(durations > 0, (times[None, :] - start_times)/durations, 1)
+		fractional_progress = np.clip(fractional_progress, 0, 1)[..., None]
+		source_lonlats = self.location_lonlats[segments['from_location_index'][segment_indexes]]
+		destination_lonlats = self.location_lonlats[segments['to_location_index'][segment_indexes]]
+		lonlat = np.where(active[..., None], source_lonlats + fractional_progress*(destination_lonlats - source_lonlats), np.nan)
+		load_level = np.where(active, segments['load_level'][segment_indexes], 0)
+		return {'active': active, 'lonlat': lonlat, 'load_level': load_level}
+
+	def sample_frames(self, samples, end_time, frame_interval=1, frames_per_chunk=24*60, start_time=0):
+		"""
+		Sample active vehicles at a fixed frame interval from start_time to end_time (exclusive), in chunks of frames.
+		The samples are appended to the columnar buffer samples, ordered by vehicle and time
+		"""
+		segments = self.get_segments()
+		all_times = np.arange(start_time, end_time, frame_interval, dtype=np.float64)
+		chunks = ColumnarBuffer(samples.dtypes)
+		for chunk_start in range(0, len(all_times), frames_per_chunk):
+			times = all_times[chunk_start:chunk_start + frames_per_chunk]
+			chunk_samples = self.sample(times, segments)
+			vehicle_indexes, time_indexes = np.nonzero(chunk_samples['active'])
+			chunks.extend(
+				time=times[time_indexes],
+				index=vehicle_indexes,
+				lon=chunk_samples['lonlat'][vehicle_indexes, time_indexes, 0],
+				lat=chunk_samples['lonlat'][vehicle_indexes, time_indexes, 1],
+				level=chunk_samples['load_level'][vehicle_indexes, time_indexes],
+				capacity=0
+			)
+		order = np.argsort(chunks.column('index'), kind='stable')
+		samples.extend(**{name: column[order] for name, column in chunks.columns().items()})
 
 
 # Vehicle
-class Vehicle(IndexedSimEntity):	
+class Vehicle(IndexedSimEntity):
 
 	def __init__(self, sim, index, home_depot_index):
 		super().__init__(sim, index)
@@ -189,8 +333,9 @@ class Vehicle(IndexedSimEntity):
 		self.moving = False
 		self.location_index = sim.depots[self.home_depot_index].location_index
 		self.vehicle_odometer = 0	
+		self.overtime = 0
 
-		self.log(f"At {type(sim.locations[self.location_index]).__name__} #{sim.locations[self.location_index].index}")
+		self.log_event(DEBUG, 'vehicle_location', location_type=type(sim.locations[self.location_index]).__name__, location_type_index=sim.locations[self.location_index].index)
 
 
 	# Get current location
@@ -199,7 +344,7 @@ class Vehicle(IndexedSimEntity):
 			return self.sim.locations[self.location_index].lonlat
 		else:
 			# Interpolate between current source and destination locations
-			route_step_fractional_progress = (self.sim.env.now - self.route_step_departure_time) / self.sim.duration_matrix[self.route[self.route_step]][self.route[self.route_step + 1]]
+			route_step_fractional_progress = (self.sim.env.now - self.route_step_departure_time) / float(self.sim.duration_matrix[self.route[self.route_step], self.route[self.route_step + 1]])
 			if (route_step_fractional_progress > 1): 
 				route_step_fractional_progress = 1 # After travel there may be time spent working at pickup site
 			source_location_lonlats = self.sim.locations[self.route[self.route_step]].lonlat
@@ -211,9 +356,9 @@ class Vehicle(IndexedSimEntity):
 
 	def put_load(self, value):
 		self.load_level += value
-		self.log(f"Load level increased to {tons_to_string(self.load_level)} / {tons_to_string(self.load_capacity)} ({to_percentage_string(self.load_level/self.load_capacity)})")
-		if (self.load_level > self.capacity):
-			self.warn("Overload")
+		self.log_event(DEBUG, 'load_increase', load_level=self.load_level, load_capacity=self.load_capacity)
+		if (self.load_level > self.load_capacity):
+			self.log_event(WARNING, 'overload', load_level=self.load_level, load_capacity=self.load_capacity)
 
 	# Assign route for vehicle
 	def assign_route(self, route):
@@ -221,48 +366,61 @@ class Vehicle(IndexedSimEntity):
 
 	def run_assign_route(self, route):
 		if len(route) > 0:
+			env = self.sim.env
+			log_debug = self.sim.event_log.enabled(DEBUG) # Skip formatting the fields of dropped events
 			self.moving = True
-			moving_start_time = self.sim.env.now
+			moving_start_time = env.now
 			self.route = route
+			# Durations and distances of the route steps, looked up at once
+			step_durations = np.asarray(self.sim.duration_matrix[route[:-1], route[1:]], dtype=np.float64).reshape(-1).tolist()
+			step_distances = np.asarray(self.sim.distance_matrix[route[:-1], route[1:]], dtype=np.float64).reshape(-1).tolist()
 			for self.route_step in range(len(route) - 1):
-				self.route_step_departure_time = self.sim.env.now
+				self.route_step_departure_time = env.now
 				depart_location = self.sim.locations[self.route[self.route_step]]
 				arrive_location = self.sim.locations[self.route[self.route_step + 1]]
-				self.log(f"Depart from {type(depart_location).__name__} #{depart_location.index}")
-				yield self.sim.env.timeout(self.sim.duration_matrix[self.route[self.route_step]][self.route[self.route_step + 1]])
-				self.record_distance_travelled(self.sim.distance_matrix[self.route[self.route_step]][self.route[self.route_step + 1]])
-				self.log(f"Arrive at {type(arrive_location).__name__} #{arrive_location.index}")
+				if log_debug:
+					self.log_event(DEBUG, 'depart', location_type=type(depart_location).__name__, location_type_index=depart_location.index)
+				yield env.timeout(step_durations[self.route_step])
+				self.record_distance_travelled(step_distances[self.route_step])
+				self.sim.vehicle_trajectories.record(self.index, self.route_step_departure_time, env.now, depart_location.location_index, arrive_location.location_index, self.load_level)
+				if log_debug:
+					self.log_event(DEBUG, 'arrive', location_type=type(arrive_location).__name__, location_type_index=arrive_location.index)
 
 				if isinstance(arrive_location, PickupSite):
 					# Arrived at a pickup site
 					pickup_site = arrive_location
 					if pickup_site.level > 0:
-						if self.load_level + pickup_site.level > self.load_capacity: 
+						pickup_start_time = env.now
+						if self.load_level + pickup_site.level > self.load_capacity:
 							# Can only take some
 							get_amount = self.load_capacity - self.load_level
 							pickup_site.get(get_amount)
 							self.load_level = self.load_capacity
-							yield self.sim.env.timeout(self.pickup_duration)
+							yield env.timeout(self.pickup_duration)
 						else:
 							# Can take all
 							get_amount = pickup_site.level
 							self.load_level += get_amount
 							pickup_site.get(get_amount)
-							yield self.sim.env.timeout(self.pickup_duration)
-						self.log(f"Pick up {tons_to_string(get_amount)} from pickup site #{pickup_site.index} with {tons_to_string(pickup_site.level)} remaining. Vehicle load {tons_to_string(self.load_level)} / {tons_to_string(self.load_capacity)}")
-					else:
-						self.log(f"Nothing to pick up at pickup site #{pickup_site.index}")			
+							yield env.timeout(self.pickup_duration)
+						self.sim.vehicle_trajectories.record(self.index, pickup_start_time, env.now, pickup_site.location_index, pickup_site.location_index, self.load_level)
+						if log_debug:
+							self.log_event(DEBUG, 'pickup', amount=get_amount, pickup_site_index=pickup_site.index, remaining=pickup_site.level, load_level=self.load_level, load_capacity=self.load_capacity)
+					elif log_debug:
+						self.log_event(DEBUG, 'nothing_to_pick_up', pickup_site_index=pickup_site.index)
 
 				elif isinstance(arrive_location, Depot):
 					# Arrived at a depot
 					depot = arrive_location
-					self.log(f"Dumped the load {tons_to_string(self.load_level)} at depot #{depot.index}")
+					if log_debug:
+						self.log_event(DEBUG, 'dump', load_level=self.load_level, depot_index=depot.index)
 					self.load_level = 0
 
 			# Mark as not moving at final destination
 			self.moving = False
-			moving_end_time = self.sim.env.now
+			moving_end_time = env.now
 			self.total_run_time += moving_end_time - moving_start_time
+			self.overtime += max(moving_end_time - moving_start_time - self.max_route_duration, 0)
 			self.location_index = route[-1]
 
 
@@ -291,39 +449,77 @@ class Terminal(IndexedLocation):
 # Simulation
 class WastePickupSimulation():
 
+	def log_event(self, level, event_type, /, **fields):
+		self.event_log.record(level, self.env.now, event_type, None, None, fields)
+
 	def log(self, message):
-		log_message = f'{time_to_string(self.env.now)} - {message}'
-		print(log_message)
-		# Add to csv log for later vis
-		self.action_log.append(log_message)		
+		self.log_event(INFO, 'message', message=message)
 
 	def warn(self, message):
-		warn_message = f"{time_to_string(self.env.now)} WARNING - {message}"
-		print(warn_message)	
-		# Add to csv log for later vis
-		self.action_log.append(warn_message)
-		self.sim_records['warnings'].append(warn_message) 
+		self.log_event(WARNING, 'message', message=message)
+
+	def get_warnings(self):
+		"""Get the recorded warnings as text, kept in memory by the event log"""
+		return self.event_log.get_warnings()
 
 	def __init__(self, config):		
 		self.config = config
 		self.run_start = f"{datetime.now()}".replace(':', '-')
 
-		# Create SimPy environment
-		self.env = simpy.Environment()
-
-		# For gathering statistics
-		self.action_log = []
+		# Instrumentation of wall-time spans and SimPy events, exported in the sim record and a trace file. Config
+		# 'instrumentation' = False disables it
+		self.instrumentation = Instrumentation(config.get('instrumentation', True))
+
+		# Snapshot of a day boundary to resume from, set by config 'snapshot' as a dict or a filename. Config
+		# 'sim_runtime_days' is then still counted from day 0
+		snapshot = config.get('snapshot')
+		if isinstance(snapshot, str):
+			snapshot = load_snapshot(snapshot)
+		if snapshot is not None and snapshot.get('version') != snapshot_version:
+			raise ValueError(f"Unsupported snapshot version {snapshot.get('version')!r}, expected {snapshot_version}")
+		if snapshot is not None and None not in (snapshot.get('matrix_store_key'), config.get('matrix_store_key')) and snapshot['matrix_store_key'] != config['matrix_store_key']:
+			raise ValueError("The snapshot is of a different list of locations than the config")
+		self.start_time = snapshot['time'] if snapshot is not None else 0
+
+		# Create SimPy environment. Config 'engine' = 'kernel' uses the lighter event kernel of event_kernel.py instead,
+		# with the same processes and results
+		self.env = self.instrumentation.create_environment(self.start_time, config.get('engine', 'simpy'))
+
+		# Structured event log, streamed to a file in the log directory. Config 'log_level' ('DEBUG', 'INFO' or 'WARNING')
+		# sets the minimum level of recorded events, and config 'log_quiet' disables printing the events
+		self.log_dir = config.get('log_dir', 'log')
+		self.event_log = EventLog(
+			os.path.join(self.log_dir, f"sim_log_{self.run_start}.jsonl") if config.get('log_events_to_file', True) else None,
+			config.get('log_level', DEBUG),
+			config.get('log_quiet', False),
+			event_messages,
+			time_to_string
+		)
+
+		# For gathering statistics. Warnings are added from the event log in sim_record
 		self.sim_records = {'warnings' : []}
 
-		# Distance and duration matrixes
-		self.distance_matrix = config['distance_matrix']
-		self.duration_matrix = config['duration_matrix']
+		# Distance and duration matrixes, typically memory-mapped float32 arrays from a matrix store, or sparse matrixes
+		self.distance_matrix = as_travel_matrix(config['distance_matrix'])
+		self.duration_matrix = as_travel_matrix(config['duration_matrix'])
 
 		# Create a list of locations so that we can easily check the type of a location. These will be populated by any IndexedLocation
 		self.locations = [None for _ in config['location_lonlats']]
 
-		# Create pickup sites as objects
+		# Random number generator for stochastic parts of the simulation
+		self.rng = np.random.default_rng(config.get('seed'))
+		if snapshot is not None:
+			self.rng.bit_generator.state = snapshot['rng_state']
+
+		# Create pickup sites as objects, with their state in a common accumulator that grows all levels daily
+		self.pickup_site_accumulator = PickupSiteAccumulator(self, config['pickup_sites'])
+		if snapshot is not None:
+			if len(snapshot['pickup_sites']['levels']) != len(config['pickup_sites']):
+				raise ValueError(f"The snapshot has {len(snapshot['pickup_sites']['levels'])} pickup sites, the config {len(config['pickup_sites'])}")
+			self.pickup_site_accumulator.levels[:] = snapshot['pickup_sites']['levels']
+			self.pickup_site_accumulator.num_overflow_days = snapshot['pickup_sites']['num_overflow_days']
 		self.pickup_sites = [PickupSite(self, i) for i in range(len(config['pickup_sites']))]
+		self.pickup_site_accumulation_activity = self.env.process(self.pickup_site_accumulator.grow_daily_forever())
 
 		# Create depots as objects
 		self.depots = [Depot(self, i) for i in range(len(config['depots']))]
@@ -336,6 +532,18 @@ class WastePickupSimulation():
 		for depot_index, depot in enumerate(config['depots']):
 			for i in range(depot['num_vehicles']):
 				self.vehicles.append(Vehicle(self, len(self.vehicles), depot_index))
+		if snapshot is not None:
+			# Vehicles that are not in the snapshot, such as added ones, start from their home depot
+			for vehicle, vehicle_snapshot in zip(self.vehicles, snapshot['vehicles']):
+				if vehicle_snapshot['home_depot_index'] == vehicle.home_depot_index:
+					vehicle.location_index = vehicle_snapshot['location_index']
+					vehicle.load_level = vehicle_snapshot['load_level']
+				vehicle.vehicle_odometer = vehicle_snapshot['odometer']
+				vehicle.total_run_time = vehicle_snapshot['total_run_time']
+				vehicle.overtime = vehicle_snapshot['overtime']
+
+		# Vehicle route step segments, for vehicle trajectories
+		self.vehicle_trajectories = VehicleTrajectories(config['location_lonlats'], len(self.vehicles))
 
 		# Monitor pickup site levels
 		for site in self.pickup_sites:
@@ -344,92 +552,269 @@ class WastePickupSimulation():
 		
 		# Daily vehicle routing
 		self.routing_output = None # No routes planned yet. The value None will cause them to be planned
+		if snapshot is not None and snapshot['routing_output'] is not None and all(len(day['vehicles']) == len(self.vehicles) for day in snapshot['routing_output']['days']):
+			# Continue the routes planned before the snapshot, unless the fleet has changed
+			self.routing_output = snapshot['routing_output']
+		self.days_since_routing = snapshot.get('days_since_routing', 0) if snapshot is not None else 0
+		self.routing_optimizer_worker = None # Started on first use
+		self.routing_stats = None # Statistics of the last routing by the routing optimizer, logged with its routes
+		self.routing_stats_lock = threading.Lock()
+		# Config 'async_routing' = True optimizes the routes of the next day during the current day, in a routing
+		# executor, from the levels forecast for the next day boundary. Config 'async_routing_submit_time' is the time of
+		# day in minutes to submit the request, default the end of the longest shift. Config 'routing_executor' can be a
+		# RoutingExecutor shared with other simulations, otherwise the simulation has its own with one worker
+		self.async_routing = config.get('async_routing', False) or config.get('routing_executor') is not None
+		self.routing_executor = config.get('routing_executor')
+		self.owns_routing_executor = self.async_routing and self.routing_executor is None
+		if self.owns_routing_executor:
+			self.routing_executor = RoutingExecutor(1)
+		self.async_routing_submit_time = min(max(config.get('async_routing_submit_time', max((vehicle.max_route_duration for vehicle in self.vehicles), default=0)), 0), 24*60 - 1)
+		self.routing_future = None # Pending asynchronous routing, for the next day boundary
+		self.routing_due_time = None
+		# Routers by name. A router takes routing input and returns routing output of one or more days
+		self.routers = {
+			'genetic': self.genetic_router,
+			'heuristic': functools.partial(heuristic_router, num_days=self.config.get('heuristic_router_num_days', 14)),
+			'local_search': self.local_search_router
+		}
+		if self.config.get('router', 'genetic') not in self.routers:
+			raise ValueError(f"Unknown router {self.config['router']!r}, expected one of {', '.join(self.routers)}")
+		self.router = self.routers[self.config.get('router', 'genetic')]
+		# Config 'routing_decomposition' = True routes the pickup sites of each depot's cluster separately with the
+		# router, in parallel in a routing executor of config 'routing_decomposition_workers' workers (default the number
+		# of CPU cores), and merges the routes. Config 'routing_decomposition_overlap' (default 0.1) adds sites to the
+		# clusters of other depots at most that much farther than their nearest depot
+		self.routing_decomposition = None
+		self.decomposition_executor = None
+		if config.get('routing_decomposition', False):
+			self.routing_decomposition = RoutingDecomposition(
+				config['location_lonlats'],
+				self.pickup_site_accumulator.location_indexes,
+				[depot.location_index for depot in self.depots],
+				[terminal.location_index for terminal in self.terminals],
+				[vehicle.home_depot_index for vehicle in self.vehicles],
+				self.distance_matrix,
+				self.duration_matrix,
+				config.get('routing_decomposition_overlap', 0.1),
+				# The genetic algorithm router needs full matrixes, which are small for the locations of a cluster
+				local_matrixes=self.config.get('router', 'genetic') == 'genetic'
+			)
+			self.router = functools.partial(self.decomposed_router, self.router)
+		# Config 'local_search' = True improves the routes of the router with local search (see local_search.py) within
+		# config 'local_search_time_budget' seconds (default 1) per routing
+		if config.get('local_search', False):
+			self.router = functools.partial(self.local_search_post_pass, self.router)
+		# Config 'routing_cache' puts a routing cache in front of the router (see routing_cache.py): a RoutingCache, or
+		# True or a dict of RoutingCache settings for the one shared by the simulations of the process with those settings.
+		# Config 'routing_cache_dir' is the directory of its on-disk tier, shared by processes
+		self.routing_cache = config.get('routing_cache')
+		if self.routing_cache is not None and self.routing_cache is not False and not isinstance(self.routing_cache, RoutingCache):
+			routing_cache_settings = dict(self.routing_cache) if isinstance(self.routing_cache, dict) else {}
+			if config.get('routing_cache_dir') is not None:
+				routing_cache_settings['directory'] = config['routing_cache_dir']
+			self.routing_cache = get_shared_routing_cache(**routing_cache_settings)
+		self.routing_cache_counts = {'hit': 0, 'near_hit': 0, 'warm_start': 0, 'miss': 0} # Of this simulation
+		self.routing_cache_kind = None # Of the last routing, logged with its routes
+		if self.routing_cache:
+			# The router and its settings, which the cached plans are only valid for
+			self.routing_cache_namespace = {
+				'matrix_store_key': config.get('matrix_store_key'),
+				**{key: value for key, value in config.items() if key == 'router' or key.startswith(('routing_optimizer_', 'heuristic_router_', 'routing_decomposition', 'local_search'))}
+			}
+			self.router = functools.partial(self.cached_router, self.router)
 		self.daily_routing_activity = self.env.process(self.daily_routing())	
 
-		# Vehicle and pickup site tracking for animation on map
-		self.vehicle_tracking_activity = self.env.process(self.vehicle_animation_tracking())
-		self.pickup_site_tracking_activity = self.env.process(self.pickup_site_animation_tracking())
+		# Pickup site tracking for animation on map. Vehicles record their route steps as they happen, and their locations
+		# are interpolated from those at export.
+		# Config 'write_sample_logs' = False skips them, for example in ensemble runs.
+		self.write_sample_logs = config.get('write_sample_logs', True)
+		if self.write_sample_logs:
+			if hasattr(self.env, 'periodic'):
+				# The event kernel takes the samples between events in batches
+				self.pickup_site_tracking_activity = self.env.periodic(15, self.track_pickup_sites)
+			else:
+				self.pickup_site_tracking_activity = self.env.process(self.pickup_site_animation_tracking())
+
+		# Route and pickup site logs, one row per sample. The index column is the vehicle index or the pickup site index
+		sample_dtypes = {
+			'time': np.float64,
+			'index': np.int32,
+			'lon': np.float64,
+			'lat': np.float64,
+			'level': np.float64,
+			'capacity': np.float64
+		}
+		self.route_logs = ColumnarBuffer(sample_dtypes)
+		self.pickup_site_logs = ColumnarBuffer(sample_dtypes, len(self.pickup_sites)*(int(max(config['sim_runtime_days']*24*60 - self.start_time, 0))//15 + 1) if self.write_sample_logs else 0)
+		self.pickup_site_lonlats = np.array([pickup_site.lonlat for pickup_site in self.pickup_sites], dtype=np.float64).reshape(-1, 2)
+		self.pickup_site_indexes = np.arange(len(self.pickup_sites), dtype=np.int32)
 
-		# Route logs
-		self.route_logs = [[] for _ in self.vehicles]
+		# Format of route and pickup site logs: 'csv' or 'npz'
+		self.sample_log_format = config.get('sample_log_format', 'csv')
+		if self.sample_log_format not in log_formats:
+			raise ValueError(f"Unknown sample log format {self.sample_log_format!r}, expected one of {', '.join(log_formats)}")
 
-		# Pickup site logs
-		self.pickup_site_logs = [[] for _ in self.pickup_sites]
+		# The snapshot was taken before the events of its day boundary. The daily growth comes first of those
+		if snapshot is not None:
+			self.log_event(INFO, 'resumed', day=snapshot['day'])
+			self.pickup_site_accumulator.grow_daily()
 
 	def site_full(self, site):
-		self.warn(f"Site #{site.index} is full.")
-
-	def vehicle_animation_tracking(self):
-		while True:
-			#self.log(f"Vehicle locations: {', '.join(map(lambda x: lonlat_to_string(x.get_lonlat()), self.vehicles))}")
-			for vehicle in self.vehicles:
-				if vehicle.moving:
-					self.route_logs[vehicle.index].append({
-						"time": self.env.now,
-						"lonlat": vehicle.get_lonlat(),
-						"load_level": vehicle.load_level,
-						"load_capacity": vehicle.load_capacity
-					})
-			yield self.env.timeout(1)
+		self.log_event(WARNING, 'site_full', pickup_site_index=site.index)
+
+	def track_pickup_sites(self, times):
+		"""Sample the pickup site levels at times, during which they don't change"""
+		accumulator = self.pickup_site_accumulator
+		num_pickup_sites = len(self.pickup_site_indexes)
+		self.pickup_site_logs.extend(
+			time=np.repeat(np.asarray(times, dtype=np.float64), num_pickup_sites),
+			index=np.tile(self.pickup_site_indexes, len(times)),
+			lon=np.tile(self.pickup_site_lonlats[:, 0], len(times)),
+			lat=np.tile(self.pickup_site_lonlats[:, 1], len(times)),
+			level=np.tile(accumulator.levels, len(times)),
+			capacity=np.tile(accumulator.capacities, len(times))
+		)
 
 	def pickup_site_animation_tracking(self):
 		while True:
-			#self.log(f"Vehicle locations: {', '.join(map(lambda x: lonlat_to_string(x.get_lonlat()), self.vehicles))}")
-			for pickup_site in self.pickup_sites:
-				self.pickup_site_logs[pickup_site.index].append({
-					"time": self.env.now,
-					"lonlat": pickup_site.get_lonlat(),
-					"level": pickup_site.level,
-					"capacity": pickup_site.capacity
-				})
+			self.track_pickup_sites([self.env.now])
 			yield self.env.timeout(15)
 
 	def daily_monitoring(self):
 		while True:
-			self.log(f"Monitored levels: {', '.join(map(lambda x: to_percentage_string(x.level/x.capacity), self.pickup_sites))}")
+			if self.event_log.enabled(INFO):
+				self.log_event(INFO, 'monitored_levels', fill_ratios=(self.pickup_site_accumulator.levels/self.pickup_site_accumulator.capacities).tolist())
 			yield self.env.timeout(24*60)
 
-	def daily_routing(self):
-		while True:
-			# Request routing when not currently available
-			if self.routing_output == None or len(self.routing_output['days']) == 0:
-				# Input to routing optimizer
-				routing_input = {
-					'pickup_sites': list(map(lambda pickup_site: {
-						'capacity': pickup_site.capacity,
-						'level': pickup_site.level,
-						'growth_rate': pickup_site.daily_growth_rate/(24*60),
-						'location_index': pickup_site.location_index
-					}, self.pickup_sites)),
-					'depots': list(map(lambda depot: {
-						'location_index': depot.location_index
-					}, self.depots)),
-					'terminals': list(map(lambda terminal: {
-						'location_index': terminal.location_index
-					}, self.terminals)),
-					'vehicles': list(map(lambda vehicle: {
-						'load_capacity': vehicle.load_capacity,
-						'home_depot_index': vehicle.home_depot_index,
-						'max_route_duration': vehicle.max_route_duration,
-					}, self.vehicles)),
-					'distance_matrix': self.config['distance_matrix'],
-					'duration_matrix': self.config['duration_matrix']
+	def genetic_router(self, routing_input):
+		"""Genetic algorithm router, in a persistent worker process that keeps the matrixes"""
+		settings = (
+			self.config.get('routing_optimizer_path', 'routing_optimizer'),
+			os.path.join(self.log_dir, 'routing_optimizer_log.txt'),
+			self.config.get('routing_optimizer_generations', 40000),
+			self.config.get('routing_optimizer_finetune_generations', 20000)
+		)
+		routing_executor = get_current_routing_executor() or self.routing_executor
+		if routing_executor is not None:
+			# Called in a thread of a routing executor, which has workers of its own
+			routing_optimizer_worker = routing_executor.get_routing_optimizer_worker(*settings)
+		else:
+			if self.routing_optimizer_worker is None:
+				self.routing_optimizer_worker = RoutingOptimizerWorker(*settings)
+			routing_optimizer_worker = self.routing_optimizer_worker
+		# Config 'routing_optimizer_warm_start_stall_generations' ends the optimization phases of a warm start early when
+		# the best cost has not improved for that many generations. A random start runs all generations
+		warm_start = 'starting_plan' in routing_input
+		max_stall_generations = self.config.get('routing_optimizer_warm_start_stall_generations', 2000) if warm_start else 0
+		with self.instrumentation.span('routing_optimizer', warm_start=warm_start):
+			routing_output = routing_optimizer_worker.route(routing_input, max_stall_generations)
+		self.add_routing_stats({'num_generations': routing_optimizer_worker.last_num_generations, 'cost': routing_optimizer_worker.last_cost, 'warm_start': warm_start})
+		return routing_output
+
+	def add_routing_stats(self, routing_stats):
+		# The statistics of the subproblems of decomposed routing add up
+		with self.routing_stats_lock:
+			if self.routing_stats is None:
+				self.routing_stats = routing_stats
+			else:
+				self.routing_stats = {
+					'num_generations': self.routing_stats['num_generations'] + routing_stats['num_generations'],
+					'cost': self.routing_stats['cost'] + routing_stats['cost'],
+					'warm_start': self.routing_stats['warm_start'] and routing_stats['warm_start'],
+					'num_subproblems': self.routing_stats.get('num_subproblems', 1) + 1
 				}
 
-				filename = 'temp/routing_input.json'
-				os.makedirs(os.path.dirname(filename), exist_ok=True)
-				with open(filename, 'w') as outfile:
-					json.dump(routing_input, outfile, indent=4)
-
-				# Comment/uncomment: heuristic router
-				#self.routing_output = heuristic_router(routing_input)
+	def local_search_post_pass(self, router, routing_input):
+		"""Improve the routes of router with local search"""
+		routing_output = router(routing_input)
+		with self.instrumentation.span('local_search'):
+			return LocalSearch(routing_input, self.config.get('local_search_neighbours', 10)).improve(routing_output, self.config.get('local_search_time_budget', 1.0))
+
+	def local_search_router(self, routing_input):
+		"""Heuristic router followed by local search"""
+		return self.local_search_post_pass(self.routers['heuristic'], routing_input)
+
+	def decomposed_router(self, router, routing_input):
+		"""Route the depot clusters separately with router, in parallel"""
+		if self.decomposition_executor is None:
+			self.decomposition_executor = RoutingExecutor(self.config.get('routing_decomposition_workers'))
+		return self.routing_decomposition.route(routing_input, router, self.decomposition_executor)
+
+	def cached_router(self, router, routing_input):
+		"""Route with router through the routing cache"""
+		# Of the routers, only the genetic algorithm starts from routing_input['starting_plan']
+		routing_output, kind = self.routing_cache.route(self.routing_cache_namespace, routing_input, router, self.config.get('router', 'genetic') == 'genetic')
+		with self.routing_stats_lock:
+			self.routing_cache_counts[kind] += 1
+			self.routing_cache_kind = kind
+		return routing_output
+
+	def get_routing_input(self, levels):
+		"""Input to the router, with the given pickup site levels"""
+		accumulator = self.pickup_site_accumulator
+		routing_input = {
+			'pickup_sites': [{
+				'capacity': capacity,
+				'level': level,
+				'growth_rate': growth_rate,
+				'location_index': location_index
+			} for capacity, level, growth_rate, location_index in zip(accumulator.capacities.tolist(), levels.tolist(), (accumulator.daily_growth_rates/(24*60)).tolist(), accumulator.location_indexes.tolist())],
+			'depots': list(map(lambda depot: {
+				'location_index': depot.location_index
+			}, self.depots)),
+			'terminals': list(map(lambda terminal: {
+				'location_index': terminal.location_index
+			}, self.terminals)),
+			'vehicles': list(map(lambda vehicle: {
+				'load_capacity': vehicle.load_capacity,
+				'home_depot_index': vehicle.home_depot_index,
+				'max_route_duration': vehicle.max_route_duration,
+				'pickup_duration': vehicle.pickup_duration,
+			}, self.vehicles)),
+			'distance_matrix': self.distance_matrix,
+			'duration_matrix': self.duration_matrix
+		}
+		if self.routing_output is not None and len(self.routing_output['days']) > 0 and self.config.get('routing_warm_start', True):
+			# The remaining days of the previous plan, already shifted by the elapsed days
+			routing_input['starting_plan'] = {'days': self.routing_output['days']}
+		return routing_input
+
+	def route(self, routing_input, sim_time):
+		"""Run the router, in a thread of the routing executor with async routing"""
+		with self.instrumentation.span('routing', sim_time=sim_time):
+			return self.router(routing_input)
+
+	def needs_routing(self):
+		# Config 'replan_interval_days' replans every that many days, before the planned days run out. With config
+		# 'routing_warm_start' (default True) the remaining planned days seed the router, for routers that support it
+		replan_interval_days = self.config.get('replan_interval_days')
+		return self.routing_output == None or len(self.routing_output['days']) == 0 or bool(replan_interval_days and self.days_since_routing >= replan_interval_days)
+
+	def set_routing_output(self, routing_output):
+		self.routing_output = routing_output
+		self.days_since_routing = 0
+		if self.routing_stats is not None:
+			self.log_event(INFO, 'routes_optimized', **self.routing_stats)
+			self.routing_stats = None
+		if self.routing_cache_kind is not None:
+			self.log_event(INFO, 'routing_cache', kind=self.routing_cache_kind)
+			self.routing_cache_kind = None
+
+	def collect_routing(self):
+		"""Wait for the pending asynchronous routing, and take its routes into use"""
+		routing_future = self.routing_future
+		self.routing_future = None
+		with self.instrumentation.span('routing_wait', sim_time=self.env.now):
+			self.set_routing_output(routing_future.result())
 
-				# Comment/uncomment: genetic algorithm router
-				filename = 'log/routing_optimizer_log.txt'
-				os.makedirs(os.path.dirname(filename), exist_ok=True)
-				os.system(f"routing_optimizer>{filename}") # ***
-				with open('temp/routing_output.json') as infile:
-					self.routing_output = json.load(infile)
+	def daily_routing(self):
+		while True:
+			# Take the routes of asynchronous routing into use, or request routing when not currently available, or when it
+			# is time to replan
+			if self.routing_future is not None:
+				self.collect_routing()
+			elif self.needs_routing():
+				self.set_routing_output(self.route(self.get_routing_input(self.pickup_site_accumulator.levels), self.env.now))
 
 			# Assign routes
 			for vehicle_index, vehicle_routing_output in enumerate(self.routing_output['days'][0]['vehicles']):
@@ -437,46 +822,163 @@ class WastePickupSimulation():
 
 			# We have used the first day of multiple days of routing output. Remove that day from the routing output
 			self.routing_output['days'] = self.routing_output['days'][1:]
+			self.days_since_routing += 1
 
-			# Wait 24h until next route optimization
-			yield self.env.timeout(24*60)
+			next_routing_time = self.env.now + 24*60
+			if self.async_routing and self.needs_routing() and next_routing_time < self.config["sim_runtime_days"]*24*60:
+				# Submit the routing of the next day, with the levels forecast after the daily growth at the day boundary
+				yield self.env.timeout(self.async_routing_submit_time)
+				accumulator = self.pickup_site_accumulator
+				routing_input = self.get_routing_input(accumulator.levels + accumulator.daily_growth_rates)
+				self.routing_future = self.routing_executor.submit(self.route, routing_input, next_routing_time)
+				self.routing_due_time = next_routing_time
+
+			# Wait until next route optimization
+			yield self.env.timeout(next_routing_time - self.env.now)
 
 
 	def sim_run(self):
+		for routing_future in self.run_steps():
+			concurrent.futures.wait([routing_future])
+
+	def run_until(self, until):
+		"""Run the simulation until time until, yielding the pending routing future whenever it is due before it is done"""
+		while self.routing_future is not None and not self.routing_future.done() and self.routing_due_time <= until:
+			if self.env.now < self.routing_due_time:
+				self.env.run(until=self.routing_due_time)
+			yield self.routing_future
+		if self.env.now < until:
+			self.env.run(until=until)
+
+	def run_steps(self):
+		"""
+		Run the simulation as a generator that yields each pending routing future the simulation has to wait for, before
+		it can continue. sim_run waits for them, and routing_executor.run_interleaved runs other simulations meanwhile
+		"""
+		# Config 'profiler' = 'cprofile' profiles the run to a file in the log directory. Config 'profile_hook' can be a
+		# function that returns a context manager to enter around the run, for example for a sampling profiler
+		# Config 'snapshot_interval_days' saves snapshots at every day boundary divisible by it, to the log directory
 		start_time = time.time()
-		self.env.run(until=self.config["sim_runtime_days"]*24*60)
+		with self.instrumentation.span('sim_run'), self.instrumentation.profile(self.config.get('profiler'), os.path.join(self.log_dir, f"profile_{self.run_start}.prof"), self.config.get('profile_hook')):
+			snapshot_interval_days = self.config.get('snapshot_interval_days')
+			if snapshot_interval_days:
+				for day in range(int(self.env.now//(24*60)) + 1, self.config["sim_runtime_days"]):
+					if day % snapshot_interval_days == 0:
+						yield from self.run_until(day*24*60)
+						with self.instrumentation.span('snapshot'):
+							self.save_snapshot()
+			yield from self.run_until(self.config["sim_runtime_days"]*24*60)
 		end_time = time.time()
+		if self.routing_optimizer_worker is not None:
+			self.routing_optimizer_worker.close()
+			self.routing_optimizer_worker = None
+		if self.owns_routing_executor:
+			self.routing_executor.shutdown()
+		if self.decomposition_executor is not None:
+			self.decomposition_executor.shutdown()
+			self.decomposition_executor = None
 		self.total_time = end_time-start_time # Excuding config preprocessing
-		self.log(f"Simulation finished with {self.total_time}s of computing")
+		self.log_event(INFO, 'sim_finished', computing_time=self.total_time)
+		if self.write_sample_logs:
+			with self.instrumentation.span('export'):
+				self.write_sample_logs_to_files()
 
-		filename = f"log/routes_log_{self.run_start}.csv"
-		os.makedirs(os.path.dirname(filename), exist_ok=True)
-		with open(filename, 'w') as f:
-			print("x,y,t,v,l,c", file=f)
-			for vehicle_index, vehicle_log in enumerate(self.route_logs):
-				for sample in vehicle_log:
-					print(f"{sample['lonlat'][0]},{sample['lonlat'][1]},{sample['time']},{vehicle_index},{sample['load_level']},{sample['load_capacity']}", file=f)
+	def get_snapshot(self):
+		"""
+		Get the state of the simulation at a day boundary, before the events of the boundary, as a JSON-serializable dict.
+		All vehicles must have finished their routes
+		"""
+		if self.env.now % (24*60) != 0:
+			raise RuntimeError(f"Snapshots are taken at day boundaries, not at {time_to_string(self.env.now)}")
+		for vehicle in self.vehicles:
+			if vehicle.moving:
+				raise RuntimeError(f"Vehicle #{vehicle.index} is on a route at the day boundary")
+		if self.routing_future is not None:
+			# Routes of asynchronous routing for this day boundary
+			self.collect_routing()
+		return {
+			'version': snapshot_version,
+			'day': int(self.env.now//(24*60)),
+			'time': int(self.env.now),
+			'matrix_store_key': self.config.get('matrix_store_key'),
+			'rng_state': self.rng.bit_generator.state,
+			'pickup_sites': {
+				'levels': self.pickup_site_accumulator.levels.tolist(),
+				'num_overflow_days': self.pickup_site_accumulator.num_overflow_days
+			},
+			'vehicles': [{
+				'home_depot_index': vehicle.home_depot_index,
+				'location_index': int(vehicle.location_index),
+				'load_level': vehicle.load_level,
+				'odometer': vehicle.vehicle_odometer,
+				'total_run_time': vehicle.total_run_time,
+				'overtime': vehicle.overtime
+			} for vehicle in self.vehicles],
+			'routing_output': self.routing_output,
+			'days_since_routing': self.days_since_routing,
+			# Offsets of this run in its logs, for joining them with the logs of runs resumed from the snapshot
+			'log_offsets': {
+				'run_start': self.run_start,
+				'num_events': self.event_log.num_events,
+				'num_route_segments': len(self.vehicle_trajectories.segments),
+				'num_pickup_site_samples': len(self.pickup_site_logs)
+			}
+		}
 
-		filename = f"log/pickup_sites_log_{self.run_start}.csv"
-		os.makedirs(os.path.dirname(filename), exist_ok=True)
+	def save_snapshot(self, filename = None):
+		"""Save a snapshot to a JSON file, by default snapshot_*_day_*.json in the log directory. Returns the filename, or None if a vehicle is on a route"""
+		day = int(self.env.now//(24*60))
+		for vehicle in self.vehicles:
+			if vehicle.moving:
+				self.log_event(WARNING, 'snapshot_skipped', day=day, vehicle_index=vehicle.index)
+				return None
+		if filename is None:
+			filename = os.path.join(self.log_dir, f"snapshot_{self.run_start}_day_{day:03d}.json")
+		snapshot = self.get_snapshot()
+		os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
 		with open(filename, 'w') as f:
-			print("x,y,t,l,c", file=f)
-			for pickup_site_log in self.pickup_site_logs:
-				for sample in pickup_site_log:
-					print(f"{sample['lonlat'][0]},{sample['lonlat'][1]},{sample['time']},{sample['level']},{sample['capacity']}", file=f)
+			json.dump(snapshot, f)
+		self.log_event(INFO, 'snapshot_saved', day=day, filename=filename)
+		return filename
+
+	def write_sample_logs_to_files(self):
+		# Vehicle locations for animation, interpolated from the route step segments at a fixed frame interval
+		self.route_logs.truncate(0)
+		self.vehicle_trajectories.sample_frames(self.route_logs, self.env.now, self.config.get('vehicle_animation_frame_interval', 1), start_time=self.start_time)
+		load_capacities = np.array([vehicle.load_capacity for vehicle in self.vehicles], dtype=np.float64)
+		self.route_logs.column('capacity')[:] = load_capacities[self.route_logs.column('index')]
+
+		os.makedirs(self.log_dir, exist_ok=True)
+		extension = 'npz' if self.sample_log_format == 'npz' else 'csv'
+		route_logs = self.route_logs.columns()
+		write_columns(os.path.join(self.log_dir, f"routes_log_{self.run_start}.{extension}"), {
+			'x': route_logs['lon'],
+			'y': route_logs['lat'],
+			't': route_logs['time'],
+			'v': route_logs['index'],
+			'l': route_logs['level'],
+			'c': route_logs['capacity']
+		}, self.sample_log_format, {'t': '%g', 'v': '%d'})
+
+		# Samples are stored in time order. Write them grouped by pickup site
+		pickup_site_logs = self.pickup_site_logs.columns()
+		order = np.argsort(pickup_site_logs['index'], kind='stable')
+		pickup_site_logs = {name: column[order] for name, column in pickup_site_logs.items()}
+		write_columns(os.path.join(self.log_dir, f"pickup_sites_log_{self.run_start}.{extension}"), {
+			'x': pickup_site_logs['lon'],
+			'y': pickup_site_logs['lat'],
+			't': pickup_site_logs['time'],
+			'l': pickup_site_logs['level'],
+			'c': pickup_site_logs['capacity']
+		}, self.sample_log_format, {'t': '%g'})
 
 
 	def save_log(self):
 		"""
-		TODO: Log processor somwhere else
+		Finish writing the event log. The events are streamed to the file during the run, one JSON object per line
 		"""
-		# Get log from saved Save log as csv file
-		json_log = json.dumps(self.action_log)
-		filename = f"log/sim_log_{self.run_start}.json"
-		# TODO! select folder structure for saving data
-		os.makedirs(os.path.dirname(filename), exist_ok=True)
-		with open(f'{filename}', 'w') as f:
-			json.dump(json_log, f, indent=4)
+		with self.instrumentation.span('save_log'):
+			self.event_log.close()
 
 
 	def sim_record(self):
@@ -484,33 +986,48 @@ class WastePickupSimulation():
 		"""
 		# Create a dict (record_[time.now.to_string]that records
 		self.sim_records['computational_time'] = self.total_time # comptutational time
-		self.sim_records['vehicles_driving_stats'] = [{'index':v.index, 'runtime':v.total_run_time, 'distance':v.vehicle_odometer} for v in self.vehicles] # time of vehicles driving
+		self.sim_records['vehicles_driving_stats'] = [{'index':v.index, 'runtime':v.total_run_time, 'distance':v.vehicle_odometer, 'overtime':v.overtime} for v in self.vehicles] # time of vehicles driving
+		self.sim_records['pickup_site_overflow_days'] = self.pickup_site_accumulator.num_overflow_days
+		self.sim_records['cost'] = cost_function_from_components(sum(v.vehicle_odometer for v in self.vehicles), self.pickup_site_accumulator.num_overflow_days, sum(v.overtime for v in self.vehicles))
 		#self.sim_records['vehicles_distance'] = [[v.index, v.vehicle_odometer] for v in self.vehicles] # time of vehicles driving
 		# vechicle driving distance
 		# level listeners alerts # are added in warnings level
-		filename = f"log/sim_record_{self.run_start}.json"
+		self.sim_records['warnings'] = self.get_warnings()
+		if self.routing_cache:
+			self.sim_records['routing_cache'] = {**self.routing_cache_counts, 'cache': self.routing_cache.get_stats()}
+		if self.instrumentation.enabled:
+			self.sim_records['instrumentation'] = self.instrumentation.get_record(self.env, self.event_log)
+			trace_filename = os.path.join(self.log_dir, f"trace_{self.run_start}.json")
+			self.instrumentation.write_trace(trace_filename, self.env)
+			self.sim_records['instrumentation']['trace_filename'] = trace_filename
+		filename = os.path.join(self.log_dir, f"sim_record_{self.run_start}.json")
 
 		os.makedirs(os.path.dirname(filename), exist_ok=True)
 		with open(f'{filename}', 'w') as f:
 			json.dump(self.sim_records, f, indent=4)
 
-		print(f"Simulaton record saved to {filename}")
+		if not self.event_log.quiet:
+			print(f"Simulaton record saved to {filename}")
 
 
 def preprocess_sim_config(sim_config, sim_config_filename):
 
-	# Create configurations for pickup sites using known data and random values	
+	# Create configurations for pickup sites using known data and random values. Capacity, daily growth rate and level
+	# are drawn at random unless given as GeoJSON properties, as by scenario_generator.py
 	sim_config['pickup_sites'] = []
 	with open(sim_config['pickup_sites_filename']) as pickup_sites_file:
 		pickup_sites_geojson = json.load(pickup_sites_file)
 	for pickup_site in pickup_sites_geojson['features']:
 		pickup_site_config = {
 			**pickup_site['properties'],
-			'lonlats': tuple(pickup_site['geometry']['coordinates']),
-			'capacity': random.randrange(1, 4)
+			'lonlats': tuple(pickup_site['geometry']['coordinates'])
 		}
-		pickup_site_config['daily_growth_rate'] = pickup_site_config['capacity']*np.random.lognormal(np.log(1 / ((14 + 21) / 2)), 0.1) # Log-normal dist of 2 to 3 weeks to be full.
-		pickup_site_config['level'] = pickup_site_config['capacity']*np.random.uniform(0, 0.8)
+		if 'capacity' not in pickup_site_config:
+			pickup_site_config['capacity'] = random.randrange(1, 4)
+		if 'daily_growth_rate' not in pickup_site_config:
+			pickup_site_config['daily_growth_rate'] = pickup_site_config['capacity']*np.random.lognormal(np.log(1 / ((14 + 21) / 2)), 0.1) # Log-normal dist of 2 to 3 weeks to be full.
+		if 'level' not in pickup_site_config:
+			pickup_site_config['level'] = pickup_site_config['capacity']*np.random.uniform(0, 0.8)
 		sim_config['pickup_sites'].append(pickup_site_config)
 
 	# Create configurations for terminals using known data
@@ -542,33 +1059,70 @@ def preprocess_sim_config(sim_config, sim_config_filename):
 
 	sim_config['location_lonlats'] = list(map(lambda x: set_location_index_and_get_lonlats(x[1], x[0]), enumerate([*sim_config['pickup_sites'], *sim_config['terminals'], *sim_config['depots']])))
 
-	# Load previous sim config
-	try:
-		with open(sim_config_filename) as cached_sim_config_file:
-			cached_sim_config = json.load(cached_sim_config_file)
-	except:
-		cached_sim_config = None
-
-	# Use previous distance and duration matrixes if the locations match within 0.001 deg of absolute error
-	if cached_sim_config != None and np.sum(np.absolute(np.array(cached_sim_config['location_lonlats']) - np.array(sim_config['location_lonlats']))) < 0.001:
-		sim_config['distance_matrix'] = cached_sim_config['distance_matrix']
-		sim_config['duration_matrix'] = cached_sim_config['duration_matrix']
+	# Distance and duration matrixes are from a matrix backend set by config 'matrix_backend': 'routing_api' (default)
+	# or 'haversine' for offline great-circle based matrixes. They are kept as memory-mapped float32 files in a matrix
+	# store, keyed by the locations. Matrixes of the haversine backend are stored in a subdirectory named by its parameters
+	matrix_backend = sim_config.get('matrix_backend', 'routing_api')
+	matrix_store_dir = sim_config.get('matrix_store_dir', os.path.join(os.path.dirname(sim_config_filename), 'matrix_store'))
+	if matrix_backend == 'haversine':
+		haversine_matrix_backend = HaversineMatrixBackend(
+			sim_config.get('haversine_detour_factor', 1.3),
+			sim_config.get('haversine_speed_bands', [(0, 60)])
+		)
+		matrix_store = MatrixStore(os.path.join(matrix_store_dir, haversine_matrix_backend.name))
+		fetch = haversine_matrix_backend.get_distance_and_duration_matrix
+	elif matrix_backend == 'routing_api':
+		matrix_store = MatrixStore(matrix_store_dir)
+		if not matrix_store.contains(sim_config['location_lonlats']):
+			# Load previous sim config
+			try:
+				with open(sim_config_filename) as cached_sim_config_file:
+					cached_sim_config = json.load(cached_sim_config_file)
+			except:
+				cached_sim_config = None
+
+			# Import distance and duration matrixes from an older previous sim config that includes them, if the locations match
+			# within 0.001 deg of absolute error
+			if cached_sim_config != None and 'distance_matrix' in cached_sim_config and len(cached_sim_config['location_lonlats']) == len(sim_config['location_lonlats']) and np.sum(np.absolute(np.array(cached_sim_config['location_lonlats']) - np.array(sim_config['location_lonlats']))) < 0.001:
+				matrix_store.put(sim_config['location_lonlats'], cached_sim_config['distance_matrix'], cached_sim_config['duration_matrix'])
+			del cached_sim_config
+
+		# Routing API based distance and duration matrixes. The routing API client loads requests, so it is only imported
+		# and created if something is fetched
+		matrix_fetcher = None
+		def fetch(coords, source_indexes, destination_indexes):
+			nonlocal matrix_fetcher
+			if matrix_fetcher is None:
+				from routing_api import MatrixFetcher, openrouteservice_matrix_url
+				matrix_fetcher = MatrixFetcher(
+					url=sim_config.get('routing_api_url', openrouteservice_matrix_url),
+					api=sim_config.get('routing_api', 'openrouteservice'),
+					max_workers=sim_config.get('routing_api_max_workers', 4),
+					max_requests_per_minute=sim_config.get('routing_api_max_requests_per_minute', 40),
+					max_elements=sim_config.get('routing_api_max_elements', 2500)
+				)
+			return matrix_fetcher.get_distance_and_duration_matrix(coords, source_indexes, destination_indexes)
+	else:
+		raise ValueError(f"Unknown matrix backend {matrix_backend!r}, expected 'routing_api' or 'haversine'")
+
+	# Get the matrixes, fetching only for the locations that are not in the matrix store. With config 'sparse_matrix_k', only
+	# the elements to the k nearest neighbours of each location and the rows and columns of terminals and depots are
+	# fetched, and the other elements are estimated
+	sparse_matrix_k = sim_config.get('sparse_matrix_k')
+	if sparse_matrix_k is not None:
+		dense_indexes = [x['location_index'] for x in [*sim_config['terminals'], *sim_config['depots']]]
+		sparse_travel_matrixes = matrix_store.get_sparse(sim_config['location_lonlats'], fetch, sparse_matrix_k, dense_indexes)
+		sim_config['distance_matrix'] = sparse_travel_matrixes.distance_matrix
+		sim_config['duration_matrix'] = sparse_travel_matrixes.duration_matrix
+		sim_config['matrix_store_key'] = location_set_key(sim_config['location_lonlats'])
 	else:
-		# Calculate geodesic distance and duration matrixes
-		#geodesic_distance_matrix = np.ndarray((len(sim_config['location_lonlats']), len(sim_config['location_lonlats'])), dtype=np.float32)
-		#geodesic_duration_matrix = np.ndarray((len(sim_config['location_lonlats']), len(sim_config['location_lonlats'])), dtype=np.float32)
-		#for b_index, b in enumerate(sim_config['location_lonlats']):
-			#for a_index, a in enumerate(sim_config['location_lonlats']):
-				#geodesic_distance_matrix[b_index, a_index] = geodesic((a[1], a[0]), (b[1], b[0])).m  #geodesic() uses latlon
-				#geodesic_duration_matrix[b_index, a_index] = geodesic_distance_matrix[b_index, a_index] / 1000 / 60 * 60 # / 1000m/km / 60km/h / 60min/h
-		#sim_config['geodesic_distance_matrix'] = geodesic_distance_matrix.tolist()
-		#sim_config['geodesic_duration_matrix'] = geodesic_duration_matrix.tolist()
-
-		# Get routing API based distance and duration matrixes
-		distance_and_duration_matrixes = get_distance_and_duration_matrix(sim_config['location_lonlats'])
-		sim_config['distance_matrix'] = distance_and_duration_matrixes["distance_matrix"].tolist()
-		sim_config['duration_matrix'] = distance_and_duration_matrixes["duration_matrix"].tolist()
+		distance_and_duration_matrixes = matrix_store.get(sim_config['location_lonlats'], fetch)
+		sim_config['distance_matrix'] = distance_and_duration_matrixes["distance_matrix"]
+		sim_config['duration_matrix'] = distance_and_duration_matrixes["duration_matrix"]
+		sim_config['matrix_store_key'] = distance_and_duration_matrixes["key"]
+	sim_config['matrix_store_directory'] = matrix_store.directory
 
+	# Save the preprocessed sim config for reference, without the matrixes
 	os.makedirs(os.path.dirname(sim_config_filename), exist_ok=True)
 	with open(sim_config_filename, 'w') as outfile:
-		json.dump(sim_config, outfile, indent=4)
+		json.dump({key: value for key, value in sim_config.items() if key not in ('distance_matrix', 'duration_matrix')}, outfile, indent=4)
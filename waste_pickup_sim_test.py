@@ -1,5 +1,6 @@
 import numpy as np
 import waste_pickup_sim
+import ensemble
 import json
 import random
 
@@ -26,12 +27,11 @@ sim_config = {
 	]
 }
 
-def hypothesis_test():
+def hypothesis_test(num_runs = 8):
 	"""
+	Runs N simulations of the preprocessed sim config in parallel, and logs them to a list of jsons with a summary
 	"""
-	# Runs N simulation
-	# logs them to list of jsons 
-	pass 
+	return ensemble.run_ensemble(sim_config, num_runs, log_dir='log/ensemble')
 
 def test_record():
 	"""